@@ -1,3 +1,13 @@
 from .app import create_app
 
-application = create_app()
\ No newline at end of file
+
+# The WSGI app (`gunicorn agency`) is created on first access rather than
+# at import, so importing agency's modules doesn't build an app.
+def __getattr__(name):
+    global application
+    if name == 'application':
+        application = create_app()
+        return application
+    raise AttributeError(
+        "module %r has no attribute %r" % (__name__, name)
+    )
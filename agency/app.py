@@ -8,7 +8,27 @@ import os
 import unittest
 from flask import Flask, request, abort, jsonify
 from flask_cors import CORS
-from .models import Actor, Movie, setup_db
+from .bulk import (
+    read_records, validate_records, insert_records,
+    read_ids, read_updates, update_records, delete_records
+)
+from .cache import cached, item_cache, setup_cache
+from .embed import read_tables, wants_embed, with_embed
+from .events import setup_events, stream_events
+from .export import wants_stream, stream_rows
+from .filters import apply_filters, get_ordering
+from .groupcommit import setup_group_commit
+from .metrics import setup_metrics
+from .models import (
+    Actor, Movie, db, setup_db, db_health, parse_fields, create_tables
+)
+from .pagination import get_limit, paginate
+from .querylog import setup_query_log
+from .search import search
+from .serialize import format_rows, json_response, select_fields
+from .stats import check_counters, format_stats, read_counters
+from .sync import changes
+from .versions import conditional, setup_versions
 from .auth.auth import *
 
 # ---------------------------------------------------------
@@ -21,6 +41,12 @@ def create_app(test_config=None):
     app = Flask(__name__)
     app.url_map.strict_slashes = False
     setup_db(app)
+    setup_versions(app)
+    setup_cache(app)
+    setup_metrics(app)
+    setup_query_log(app)
+    setup_events(app)
+    setup_group_commit(app)
 
     # CORS app
     cors = CORS(app, resources={r"/api/*": {"origins": "*"}})
@@ -42,30 +68,143 @@ def create_app(test_config=None):
 # Routes
 # ---------------------------------------------------------
 
-    # GET endpoint for list of actors in database.
+    # GET endpoint for a page of actors in the database, or for the
+    # actors changed since a sync token with ?changed_since=.
     @app.route('/actors', methods=['GET'])
     def get_actors():
-        actors = Actor.query.all()
+        if 'changed_since' in request.args:
+            return jsonify(changes(Actor, 'actors')), 200
+        return list_actors()
+
+    @conditional(read_tables(Actor, Movie))
+    @cached(read_tables(Actor, Movie))
+    def list_actors():
+        embed = wants_embed(Actor)
+        query = apply_filters(Actor.query, Actor)
+        if wants_stream():
+            return stream_rows(query, Actor)
+
+        if embed:
+            query = with_embed(query, Actor)
+            actors, page = paginate(query, Actor, get_ordering(Actor))
+            actors = [actor.format(embed) for actor in actors]
+        else:
+            query = select_fields(query, Actor)
+            rows, page = paginate(query, Actor, get_ordering(Actor))
+            actors = format_rows(rows, Actor)
+
+        return json_response({
+            'success': True,
+            'actors': actors,
+            **page
+        }), 200
 
-        if not actors:
-            abort(404)
+    # GET endpoint for a page of movies in the database, or for the
+    # movies changed since a sync token with ?changed_since=.
+    @app.route('/movies', methods=['GET'])
+    def get_movies():
+        if 'changed_since' in request.args:
+            return jsonify(changes(Movie, 'movies')), 200
+        return list_movies()
+
+    @conditional(read_tables(Movie, Actor))
+    @cached(read_tables(Movie, Actor))
+    def list_movies():
+        embed = wants_embed(Movie)
+        query = apply_filters(Movie.query, Movie)
+        if wants_stream():
+            return stream_rows(query, Movie)
+
+        if embed:
+            query = with_embed(query, Movie)
+            movies, page = paginate(query, Movie, get_ordering(Movie))
+            movies = [movie.format(embed) for movie in movies]
+        else:
+            query = select_fields(query, Movie)
+            rows, page = paginate(query, Movie, get_ordering(Movie))
+            movies = format_rows(rows, Movie)
+
+        return json_response({
+            'success': True,
+            'movies': movies,
+            **page
+        }), 200
 
+    # GET endpoint streaming actor and movie write events as Server-Sent
+    # Events, resuming after the Last-Event-ID header when given.
+    @app.route('/events', methods=['GET'])
+    def get_events():
+        return stream_events()
+
+    # GET endpoint for catalog statistics, read from the counters that
+    # every write keeps up to date instead of scanning the tables.
+    @app.route('/stats', methods=['GET'])
+    @conditional('actors', 'movies')
+    @cached('actors', 'movies')
+    def get_stats():
         return jsonify({
             'success': True,
-            'actors': [actor.format() for actor in actors]
+            **format_stats(read_counters())
         }), 200
 
-    # GET endpoint for list of movies in database.
-    @app.route('/movies', methods=['GET'])
-    def get_movies():
-        movies = Movie.query.all()
+    # GET endpoint for ranked search over actor names and movie titles.
+    @app.route('/search', methods=['GET'])
+    @conditional('actors', 'movies')
+    @cached('actors', 'movies')
+    def search_catalog():
+        query = request.args.get('q', '').strip()
+        kind = request.args.get('type', 'all')
+        if not query or kind not in ('all', 'actors', 'movies'):
+            abort(422)
+
+        limit = get_limit()
+        try:
+            offset = int(request.args.get('offset', 0))
+        except ValueError:
+            abort(422)
+        if offset < 0:
+            abort(422)
+
+        results = {'success': True}
+        if kind in ('all', 'actors'):
+            results['actors'] = search(Actor, query, limit, offset)
+        if kind in ('all', 'movies'):
+            results['movies'] = search(Movie, query, limit, offset)
+
+        return jsonify(results), 200
+
+    # GET endpoint for a single actor, served from the item cache.
+    @app.route('/actors/<int:actor_id>', methods=['GET'])
+    @conditional(read_tables(Actor, Movie))
+    def get_actor(actor_id):
+        if wants_embed(Actor):
+            actor = with_embed(Actor.query, Actor).get(actor_id)
+            actor = actor.format(embed=True) if actor else None
+        else:
+            actor = item_cache.get(Actor, actor_id)
+        if not actor:
+            abort(404)
 
-        if not movies:
+        return jsonify({
+            'success': True,
+            'actor': actor
+        }), 200
+
+    # GET endpoint for a single movie, served from the item cache.
+    @app.route('/movies/<int:movie_id>', methods=['GET'])
+    @conditional(read_tables(Movie, Actor))
+    def get_movie(movie_id):
+        if wants_embed(Movie):
+            movie = with_embed(Movie.query, Movie).get(movie_id)
+            movie = movie.format(embed=True) if movie else None
+        else:
+            movie = item_cache.get(Movie, movie_id)
+        if not movie:
             abort(404)
 
         return jsonify({
             'success': True,
-            'movies': [movie.format() for movie in movies]
+            'movie': movie
         }), 200
 
     # POST endpoint to add an actor to the database.
@@ -74,11 +213,13 @@ def create_app(test_config=None):
     def add_actor():
         data = request.get_json()
 
-        if 'name' not in data:
-            abort(422)
-        if 'age' not in data:
-            abort(422)
-        if 'gender' not in data:
+        for field in Actor.required_fields:
+            if field not in data:
+                abort(422)
+
+        try:
+            data = parse_fields(Actor, data)
+        except ValueError:
             abort(422)
 
         actor = Actor(
@@ -99,9 +240,13 @@ def create_app(test_config=None):
     def add_movie():
         data = request.get_json()
 
-        if 'title' not in data:
-            abort(422)
-        if 'release' not in data:
+        for field in Movie.required_fields:
+            if field not in data:
+                abort(422)
+
+        try:
+            data = parse_fields(Movie, data)
+        except ValueError:
             abort(422)
 
         movie = Movie(title=data['title'], release=data['release'])
@@ -112,6 +257,38 @@ def create_app(test_config=None):
             'movie': movie.format()
         }), 200
 
+    # POST endpoint to add many actors in chunked transactions.
+    @app.route('/add-actors', methods=['POST'])
+    @requires_auth('post:actors')
+    def add_actors():
+        rows, errors = validate_records(read_records(), Actor)
+        if not rows:
+            abort(422)
+
+        created, insert_errors = insert_records(Actor, rows)
+
+        return jsonify({
+            'success': True,
+            'created': len(created),
+            'errors': errors + insert_errors
+        }), 200
+
+    # POST endpoint to add many movies in chunked transactions.
+    @app.route('/add-movies', methods=['POST'])
+    @requires_auth('post:movies')
+    def add_movies():
+        rows, errors = validate_records(read_records(), Movie)
+        if not rows:
+            abort(422)
+
+        created, insert_errors = insert_records(Movie, rows)
+
+        return jsonify({
+            'success': True,
+            'created': len(created),
+            'errors': errors + insert_errors
+        }), 200
+
     # PATCH endpoint to update an actor in the database.
     @app.route('/actors/<int:actor_id>', methods=['PATCH'])
     @requires_auth('patch:actor')
@@ -125,6 +302,11 @@ def create_app(test_config=None):
 
         data = request.get_json()
 
+        try:
+            data = parse_fields(Actor, {k: v for k, v in data.items() if v})
+        except ValueError:
+            abort(422)
+
         if 'name' in data and data['name']:
             actor.name = data['name']
 
@@ -154,6 +336,11 @@ def create_app(test_config=None):
 
         data = request.get_json()
 
+        try:
+            data = parse_fields(Movie, {k: v for k, v in data.items() if v})
+        except ValueError:
+            abort(422)
+
         if 'title' in data and data['title']:
             movie.title = data['title']
 
@@ -167,6 +354,80 @@ def create_app(test_config=None):
             'movie': movie.format(),
         }), 200
 
+    # PATCH endpoint to update many actors with set-based statements.
+    @app.route('/actors', methods=['PATCH'])
+    @requires_auth('patch:actor')
+    def update_actors():
+        updates = read_updates(request.get_json(silent=True), Actor)
+        updated, missing = update_records(Actor, updates)
+
+        return jsonify({
+            'success': True,
+            'updated': updated,
+            'missing': missing
+        }), 200
+
+    # PATCH endpoint to update many movies with set-based statements.
+    @app.route('/movies', methods=['PATCH'])
+    @requires_auth('patch:movie')
+    def update_movies():
+        updates = read_updates(request.get_json(silent=True), Movie)
+        updated, missing = update_records(Movie, updates)
+
+        return jsonify({
+            'success': True,
+            'updated': updated,
+            'missing': missing
+        }), 200
+
+    # POST endpoint to assign actors to a movie's cast.
+    @app.route('/movies/<int:movie_id>/cast', methods=['POST'])
+    @requires_auth('patch:movie')
+    def add_movie_cast(movie_id):
+        movie = Movie.query.get(movie_id)
+        if not movie:
+            abort(404)
+
+        data = request.get_json(silent=True) or {}
+        actor_ids = data.get('actor_ids', [data.get('actor_id')])
+        if not isinstance(actor_ids, list) or not actor_ids:
+            abort(422)
+        if not all(isinstance(i, int) and not isinstance(i, bool)
+                   for i in actor_ids):
+            abort(422)
+
+        actors = Actor.query.filter(Actor.id.in_(actor_ids)).all()
+        if len(actors) != len(set(actor_ids)):
+            abort(404)
+
+        movie.add_cast(actors)
+
+        return jsonify({
+            'success': True,
+            'movie': movie.format(embed=True)
+        }), 200
+
+    # DELETE endpoint to remove an actor from a movie's cast.
+    @app.route(
+        '/movies/<int:movie_id>/cast/<int:actor_id>', methods=['DELETE']
+    )
+    @requires_auth('patch:movie')
+    def delete_movie_cast(movie_id, actor_id):
+        movie = Movie.query.get(movie_id)
+        if not movie:
+            abort(404)
+
+        actor = Actor.query.get(actor_id)
+        if not actor or actor not in movie.cast:
+            abort(404)
+
+        movie.remove_cast(actor)
+
+        return jsonify({
+            'success': True,
+            'movie': movie.format(embed=True)
+        }), 200
+
     # DELETE endpoint to delete actors in the database.
     @app.route('/actors/<int:actor_id>', methods=['DELETE'])
     @requires_auth('delete:actor')
@@ -203,6 +464,49 @@ def create_app(test_config=None):
             'movie_id': movie_id
         }), 200
 
+    # DELETE endpoint to delete many actors by id.
+    @app.route('/actors', methods=['DELETE'])
+    @requires_auth('delete:actor')
+    def delete_actors():
+        ids = read_ids(request.get_json(silent=True))
+        deleted, missing = delete_records(Actor, ids)
+
+        return jsonify({
+            'success': True,
+            'deleted': deleted,
+            'missing': missing
+        }), 200
+
+    # DELETE endpoint to delete many movies by id.
+    @app.route('/movies', methods=['DELETE'])
+    @requires_auth('delete:movie')
+    def delete_movies():
+        ids = read_ids(request.get_json(silent=True))
+        deleted, missing = delete_records(Movie, ids)
+
+        return jsonify({
+            'success': True,
+            'deleted': deleted,
+            'missing': missing
+        }), 200
+
+    # GET endpoint reporting database latency and connection pool usage.
+    @app.route('/health/db', methods=['GET'])
+    def get_db_health():
+        try:
+            health = db_health()
+        except Exception:
+            return jsonify({
+                'success': False,
+                'error': 503,
+                'message': 'Database unavailable.'
+            }), 503
+
+        return jsonify({
+            'success': True,
+            **health
+        }), 200
+
 # ---------------------------------------------------------
 # Error Handling
 # ---------------------------------------------------------
@@ -238,6 +542,14 @@ def create_app(test_config=None):
             "message": "Request could not be processed."
         }), 422
 
+    @app.errorhandler(503)
+    def unavailable(error):
+        return jsonify({
+            "success": False,
+            "error": 503,
+            "message": "Service unavailable."
+        }), 503
+
     @app.errorhandler(AuthError)
     def auth_error(error):
         return jsonify({
@@ -246,6 +558,35 @@ def create_app(test_config=None):
             'message': error.error['description']
         }), error.status_code
 
+# ---------------------------------------------------------
+# Commands
+# ---------------------------------------------------------
+
+    # Creates any missing tables, for LAZY_STARTUP deployments that
+    # don't run the migrations.
+    @app.cli.command('create-db')
+    def create_db():
+        create_tables()
+        click.echo('Created missing tables.')
+
+    # Rebuilds the /stats counters from the tables and lists those that
+    # differ from the stored ones. Exits with status 1 on differences,
+    # unless --fix replaced the stored counters.
+    @app.cli.command('check-stats')
+    @click.option('--fix', is_flag=True, help='Replace the stored counters.')
+    def check_stats(fix):
+        differences = check_counters(fix)
+        for (metric, bucket), counts in sorted(differences.items()):
+            click.echo('%s %s: stored %d, expected %d' % (
+                (metric, bucket or '-') + counts))
+
+        if not differences:
+            click.echo('Counters are consistent.')
+        elif fix:
+            click.echo('Fixed %d counters.' % len(differences))
+        else:
+            raise SystemExit(1)
+
 # ---------------------------------------------------------
 # Launch
 # ---------------------------------------------------------
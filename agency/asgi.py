@@ -0,0 +1,521 @@
+# ---------------------------------------------------------
+# Imports
+# ---------------------------------------------------------
+
+import asyncio
+import datetime
+import os
+from contextlib import asynccontextmanager
+from functools import wraps
+import httpx
+from databases import Database
+from flask import Config
+from sqlalchemy import func, select
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response
+from starlette.routing import Route
+from werkzeug.exceptions import HTTPException, abort
+from .auth import auth
+from .backends import backend_from_config
+from .bulk import references_to
+from .events import event_broker
+from .filters import filter_clauses, parse_ordering
+from .models import (
+    Actor, Movie, movie_cast, tombstones, database_path, notify_write,
+    parse_fields
+)
+from .pagination import decode_cursor, encode_cursor, parse_limit
+from .serialize import dumps
+from .stats import delta_statements, stat_deltas, stat_rows_query
+from .versions import table_versions
+
+# ---------------------------------------------------------
+# Config
+# ---------------------------------------------------------
+
+# Same settings file as the Flask app.
+config = Config(os.path.dirname(os.path.abspath(__file__)))
+config.from_pyfile('config.py')
+
+# Relationship used by ?embed=, per model: the related model and the
+# movie_cast columns pointing at each side.
+EMBEDS = {
+    Actor: (Movie, movie_cast.c.actor_id, movie_cast.c.movie_id),
+    Movie: (Actor, movie_cast.c.movie_id, movie_cast.c.actor_id),
+}
+
+ERROR_MESSAGES = {
+    401: 'Authentication error.',
+    403: 'Forbidden.',
+    404: 'Item not found.',
+    422: 'Request could not be processed.',
+}
+
+
+# asyncpg only accepts postgresql:// URLs; Heroku hands out postgres://.
+# Accepts: url (string)
+# Returns: url (string)
+def async_database_url(url):
+    if url.startswith('postgres://'):
+        return 'postgresql://' + url[len('postgres://'):]
+    return url
+
+
+# Opens a pool sized like the sync app's (DB_POOL_SIZE + DB_MAX_OVERFLOW)
+# on Postgres, through asyncpg.
+# Accepts: url (string)
+# Returns: Database
+def create_database(url):
+    options = {}
+    if url.startswith('postgres'):
+        options = {
+            'min_size': 1,
+            'max_size': config['DB_POOL_SIZE'] + config['DB_MAX_OVERFLOW']
+        }
+    return Database(async_database_url(url), **options)
+
+# ---------------------------------------------------------
+# Responses
+# ---------------------------------------------------------
+
+
+def json_response(data, status=200):
+    return Response(
+        dumps(data, config['JSON_BACKEND']) + b'\n',
+        status_code=status, media_type='application/json'
+    )
+
+
+async def http_error(request, error):
+    status = error.code
+    return json_response({
+        'success': False,
+        'error': status,
+        'message': ERROR_MESSAGES.get(status, error.description)
+    }, status)
+
+
+async def auth_error(request, error):
+    return json_response({
+        'success': False,
+        'error': error.status_code,
+        'message': error.error['description']
+    }, error.status_code)
+
+
+# Returns: request body (dictionary); 400 if it isn't a JSON object.
+async def read_json(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        abort(400)
+    if not isinstance(data, dict):
+        abort(400)
+    return data
+
+
+# Formats a row selected with the model's list_fields like format().
+def format_record(record, model):
+    return {field: record[field] for field in model.list_fields}
+
+# ---------------------------------------------------------
+# Auth
+# ---------------------------------------------------------
+
+jwks_lock = None
+
+
+# Fetches the JSON web key set without blocking the event loop.
+# Accepts: url (string), timeout (seconds)
+# Returns: key set (dictionary)
+async def fetch_jwks(url, timeout=auth.JWKS_FETCH_TIMEOUT):
+    async with httpx.AsyncClient(timeout=timeout) as client:
+        response = await client.get(url)
+        response.raise_for_status()
+        return response.json()
+
+
+# Makes sure the shared key cache can check a token signed with `kid`,
+# fetching the key set with non-blocking HTTP when get_key() would
+# otherwise fetch it synchronously. One coroutine fetches at a time.
+# Accepts: kid (string or None)
+async def ensure_jwks(kid):
+    global jwks_lock
+    cache = auth.jwks_cache
+    if not cache.needs_refresh(kid):
+        return
+
+    if jwks_lock is None:
+        jwks_lock = asyncio.Lock()
+    async with jwks_lock:
+        if cache.needs_refresh(kid):
+            cache.fetches += 1
+            try:
+                jwks_data = await fetch_jwks(cache.url)
+            except Exception:
+                jwks_data = None
+            cache.load(jwks_data)
+
+    # Without any keys get_key() would retry the fetch synchronously, or
+    # fail while failed fetches cool down.
+    if cache.needs_refresh() or not cache.has_keys():
+        raise auth.AuthError({
+            'code': 'invalid_auth_api',
+            'description': 'Invalid authorization API.'
+        }, 422)
+
+
+def token_kid(token):
+    from jose import jwt
+    try:
+        return jwt.get_unverified_headers(token).get('kid')
+    except Exception:
+        return None
+
+
+# Async counterpart of auth.requires_auth, sharing its token cache.
+def requires_auth(permission=''):
+    def requires_auth_decorator(f):
+        @wraps(f)
+        async def wrapper(request):
+            token = auth.parse_auth_header(
+                request.headers.get('Authorization')
+            )
+            await ensure_jwks(token_kid(token))
+            payload = auth.verify_decode_jwt(token)
+            auth.check_permissions(permission, payload)
+            return await f(request)
+
+        return wrapper
+    return requires_auth_decorator
+
+# ---------------------------------------------------------
+# Queries
+# ---------------------------------------------------------
+
+
+# Returns: ?embed= was given and valid for the model (boolean); 422 for
+# any other value.
+def wants_embed(request, model):
+    embed = request.query_params.get('embed')
+    if embed is None:
+        return False
+    if embed != model.embed_field:
+        abort(422)
+    return True
+
+
+# Adds the related rows (movies of actors, cast of movies) to formatted
+# items, with one query for the whole page.
+# Accepts: database (Database), model (db.Model), items (list)
+async def embed_related(database, model, items):
+    related, own_key, other_key = EMBEDS[model]
+    by_id = {item['id']: item for item in items}
+    for item in items:
+        item[model.embed_field] = []
+    if not items:
+        return
+
+    columns = [getattr(related, field) for field in related.list_fields]
+    query = (
+        select([own_key] + columns)
+        .select_from(movie_cast.join(related.__table__, other_key == related.id))
+        .where(own_key.in_(list(by_id)))
+        .order_by(related.id)
+    )
+    for record in await database.fetch_all(query):
+        by_id[record[own_key.name]][model.embed_field].append(
+            format_record(record, related)
+        )
+
+
+# Pages through a model's rows like pagination.paginate(): keyset
+# cursors in id order, offset cursors with ?order_by=.
+# Accepts: database (Database), request, model (db.Model)
+# Returns: formatted rows (list) and page metadata (dictionary)
+async def list_records(database, request, model):
+    args = request.query_params
+    limit = parse_limit(args.get('limit'), config)
+    ordering = parse_ordering(model, args.get('order_by'))
+    cursor = args.get('cursor')
+    try:
+        offset = int(args.get('offset', 0))
+    except ValueError:
+        abort(422)
+    if offset < 0 or (cursor is not None and offset):
+        abort(422)
+
+    clauses = filter_clauses(model, args)
+    query = select([getattr(model, field) for field in model.list_fields])
+    for clause in clauses:
+        query = query.where(clause)
+
+    query = query.order_by(*(ordering or [model.id]))
+    if cursor is not None and not ordering:
+        query = query.where(model.id > decode_cursor(cursor, 'id'))
+    else:
+        if cursor is not None:
+            offset = decode_cursor(cursor, 'offset')
+        if offset:
+            query = query.offset(offset)
+
+    rows = await database.fetch_all(query.limit(limit + 1))
+    has_more = len(rows) > limit
+    items = [format_record(row, model) for row in rows[:limit]]
+
+    next_cursor = None
+    if has_more and ordering:
+        next_cursor = encode_cursor({'offset': offset + limit})
+    elif has_more:
+        next_cursor = encode_cursor({'id': items[-1]['id']})
+
+    page = {'next_cursor': next_cursor}
+    if args.get('total', '').lower() in ('1', 'true'):
+        total = select([func.count()]).select_from(model.__table__)
+        for clause in clauses:
+            total = total.where(clause)
+        page['total'] = await database.fetch_val(total)
+
+    return items, page
+
+
+# Returns: the formatted row (dictionary) or None if it doesn't exist.
+async def get_record(database, model, item_id):
+    query = select(
+        [getattr(model, field) for field in model.list_fields]
+    ).where(model.id == item_id)
+    record = await database.fetch_one(query)
+    return format_record(record, model) if record else None
+
+
+# Checks and parses the body of a create request.
+# Returns: column values (dictionary)
+async def read_new_record(request, model):
+    data = await read_json(request)
+    for field in model.required_fields:
+        if field not in data:
+            abort(422)
+    try:
+        data = parse_fields(model, data)
+    except ValueError:
+        abort(422)
+    return {field: data[field] for field in model.required_fields}
+
+
+# Tells the write listeners about a committed write. Some of them block
+# (pg_notify for /events, Redis for the table versions), so they run in
+# the thread pool rather than on the event loop.
+async def notify_committed(table, action, ids=()):
+    await run_in_threadpool(notify_write, table, action, ids)
+
+
+# Adds counter deltas for /stats in the current transaction.
+async def update_stats(database, deltas):
+    for statement in delta_statements(deltas, database.url.dialect):
+        await database.execute(statement)
+
+
+# Returns: id of the inserted row (int)
+async def insert_record(database, model, values):
+    table = model.__table__
+    # databases doesn't run Python-side column defaults.
+    now = datetime.datetime.utcnow()
+    query = table.insert().values(created_at=now, updated_at=now, **values)
+    if database.url.dialect == 'postgresql':
+        query = query.returning(table.c.id)
+    async with database.transaction():
+        item_id = await database.execute(query)
+        await update_stats(database, stat_deltas(model, new_rows=[values]))
+    await notify_committed(table.name, 'insert', [item_id])
+    return item_id
+
+
+# Applies the non-empty fields of a PATCH body, like the sync endpoints.
+async def update_record(database, request, model, item_id):
+    if await get_record(database, model, item_id) is None:
+        abort(404)
+
+    data = await read_json(request)
+    try:
+        data = parse_fields(model, {k: v for k, v in data.items() if v})
+    except ValueError:
+        abort(422)
+
+    values = {
+        field: data[field] for field in model.required_fields
+        if data.get(field)
+    }
+    if values:
+        table = model.__table__
+        async with database.transaction():
+            old = await database.fetch_one(stat_rows_query(model, [item_id]))
+            if old is None:
+                abort(404)
+            old = dict(old)
+            await database.execute(
+                table.update().where(table.c.id == item_id).values(
+                    updated_at=datetime.datetime.utcnow(), **values
+                )
+            )
+            await update_stats(database, stat_deltas(
+                model, [old], [dict(old, **values)]
+            ))
+        await notify_committed(table.name, 'update', [item_id])
+
+    return await get_record(database, model, item_id)
+
+
+# Deletes a row and the rows referencing it in one transaction.
+async def delete_record(database, model, item_id):
+    table = model.__table__
+    references = references_to(table)
+    async with database.transaction():
+        old = await database.fetch_one(stat_rows_query(model, [item_id]))
+        if old is None:
+            abort(404)
+        await update_stats(database, stat_deltas(model, old_rows=[dict(old)]))
+        for other, column in references:
+            await database.execute(other.delete().where(column == item_id))
+        await database.execute(table.delete().where(table.c.id == item_id))
+        await database.execute(tombstones.insert().values(
+            table_name=table.name, row_id=item_id,
+            deleted_at=datetime.datetime.utcnow()
+        ))
+
+    for other in {other for other, _ in references}:
+        await notify_committed(other.name, 'delete')
+    await notify_committed(table.name, 'delete', [item_id])
+
+# ---------------------------------------------------------
+# App
+# ---------------------------------------------------------
+
+
+# Builds the ASGI app. It serves the list, item, create, update and
+# delete endpoints of the Flask app with the same response shapes, over
+# an async database driver and non-blocking JWKS fetches. Search, bulk,
+# cast and export endpoints are only served by the Flask app.
+# Accepts: url (database URL string)
+# Returns: Starlette app
+def create_asgi_app(url=database_path):
+    database = create_database(url)
+    table_versions.backend = backend_from_config(config)
+    # Writes reach the Flask workers' /events clients through NOTIFY.
+    event_broker.configure({**config, 'SQLALCHEMY_DATABASE_URI': url})
+
+    @asynccontextmanager
+    async def lifespan(app):
+        await database.connect()
+        try:
+            yield
+        finally:
+            await database.disconnect()
+
+    def list_endpoint(model, name):
+        async def endpoint(request):
+            embed = wants_embed(request, model)
+            items, page = await list_records(database, request, model)
+            if embed:
+                await embed_related(database, model, items)
+            return json_response({'success': True, name: items, **page})
+        return endpoint
+
+    def item_endpoint(model, name):
+        async def endpoint(request):
+            item_id = request.path_params['item_id']
+            embed = wants_embed(request, model)
+            item = await get_record(database, model, item_id)
+            if item is None:
+                abort(404)
+            if embed:
+                await embed_related(database, model, [item])
+            return json_response({'success': True, name: item})
+        return endpoint
+
+    def create_endpoint(model, name, permission):
+        @requires_auth(permission)
+        async def endpoint(request):
+            values = await read_new_record(request, model)
+            item_id = await insert_record(database, model, values)
+            return json_response({
+                'success': True,
+                name: await get_record(database, model, item_id)
+            })
+        return endpoint
+
+    def update_endpoint(model, name, permission):
+        @requires_auth(permission)
+        async def endpoint(request):
+            item_id = request.path_params['item_id']
+            item = await update_record(database, request, model, item_id)
+            return json_response({'success': True, name: item})
+        return endpoint
+
+    def delete_endpoint(model, name, permission):
+        @requires_auth(permission)
+        async def endpoint(request):
+            item_id = request.path_params['item_id']
+            await delete_record(database, model, item_id)
+            return json_response({'success': True, name + '_id': item_id})
+        return endpoint
+
+    async def get_db_health(request):
+        try:
+            await database.fetch_val('SELECT 1')
+        except Exception:
+            return json_response({
+                'success': False,
+                'error': 503,
+                'message': 'Database unavailable.'
+            }, 503)
+        return json_response({'success': True})
+
+    routes = [
+        Route('/actors', list_endpoint(Actor, 'actors'), methods=['GET']),
+        Route('/movies', list_endpoint(Movie, 'movies'), methods=['GET']),
+        Route('/actors/{item_id:int}', item_endpoint(Actor, 'actor'),
+              methods=['GET']),
+        Route('/movies/{item_id:int}', item_endpoint(Movie, 'movie'),
+              methods=['GET']),
+        Route('/add-actor', create_endpoint(Actor, 'actor', 'post:actors'),
+              methods=['POST']),
+        Route('/add-movie', create_endpoint(Movie, 'movie', 'post:movies'),
+              methods=['POST']),
+        Route('/actors/{item_id:int}',
+              update_endpoint(Actor, 'actor', 'patch:actor'),
+              methods=['PATCH']),
+        Route('/movies/{item_id:int}',
+              update_endpoint(Movie, 'movie', 'patch:movie'),
+              methods=['PATCH']),
+        Route('/actors/{item_id:int}',
+              delete_endpoint(Actor, 'actor', 'delete:actor'),
+              methods=['DELETE']),
+        Route('/movies/{item_id:int}',
+              delete_endpoint(Movie, 'movie', 'delete:movie'),
+              methods=['DELETE']),
+        Route('/health/db', get_db_health, methods=['GET']),
+    ]
+
+    app = Starlette(
+        routes=routes,
+        lifespan=lifespan,
+        exception_handlers={
+            HTTPException: http_error,
+            auth.AuthError: auth_error,
+        }
+    )
+    app.state.database = database
+    return app
+
+
+# The ASGI app (`gunicorn agency.asgi:app`) is created on first access,
+# so importing the module doesn't read the config or build the pool.
+def __getattr__(name):
+    global app
+    if name == 'app':
+        app = create_asgi_app()
+        return app
+    raise AttributeError(
+        "module %r has no attribute %r" % (__name__, name)
+    )
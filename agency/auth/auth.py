@@ -1,7 +1,12 @@
+import hashlib
 import json
-from flask import request, _request_ctx_stack
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from flask import g, request, _request_ctx_stack
 from functools import wraps
-from jose import jwt
 from urllib.request import urlopen
 
 # ---------------------------------------------------------
@@ -13,11 +18,25 @@ ALGORITHMS = ['RS256']
 API_AUDIENCE = 'agency_dev'
 JWKS_URL = f'https://{AUTH0_DOMAIN}/.well-known/jwks.json'
 
+# Seconds a fetched key set is trusted before it is fetched again.
+JWKS_CACHE_TTL = int(os.environ.get('JWKS_CACHE_TTL', 600))
+# Minimum seconds between refreshes forced by an unknown "kid".
+JWKS_REFRESH_COOLDOWN = int(os.environ.get('JWKS_REFRESH_COOLDOWN', 30))
+# Seconds to wait for Auth0 before a key set fetch fails.
+JWKS_FETCH_TIMEOUT = float(os.environ.get('JWKS_FETCH_TIMEOUT', 5))
+# Fraction of the TTL after which the background refresher refetches.
+JWKS_REFRESH_AHEAD = float(os.environ.get('JWKS_REFRESH_AHEAD', 0.8))
+# Bounds in seconds of the backoff between failed background fetches.
+JWKS_RETRY_MIN = float(os.environ.get('JWKS_RETRY_MIN', 1))
+JWKS_RETRY_MAX = float(os.environ.get('JWKS_RETRY_MAX', 60))
+# Maximum number of verified tokens kept in memory.
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
+
 
 # Gets JSON data from URL
 # Source: https://bit.ly/3cbBd5y
-def get_json_data(url):
-    operUrl = urlopen(url)
+def get_json_data(url, timeout=JWKS_FETCH_TIMEOUT):
+    operUrl = urlopen(url, timeout=timeout)
     if(operUrl.getcode() != 200):
         return False
 
@@ -25,6 +44,285 @@ def get_json_data(url):
     jsonData = json.loads(data)
     return jsonData
 
+# ---------------------------------------------------------
+# Key cache
+# ---------------------------------------------------------
+
+
+# Process-wide cache of the JSON web key set, indexed by "kid".
+# Keys are refetched once the TTL runs out, or early when a token names a
+# "kid" we have not seen (at most once per cooldown, so bad tokens cannot
+# cause a refresh storm). After a failed fetch, requests also wait out
+# the cooldown before fetching again. Only one thread fetches at a time;
+# the others wait for it and reuse its result.
+# Accepts: url (string), fetcher (callable taking a url), ttl and
+# refresh_cooldown (seconds), clock (callable returning seconds).
+class JWKSCache:
+    def __init__(self, url, fetcher=None, ttl=JWKS_CACHE_TTL,
+                 refresh_cooldown=JWKS_REFRESH_COOLDOWN, clock=time.monotonic):
+        self.url = url
+        self.fetcher = fetcher or get_json_data
+        self.ttl = ttl
+        self.refresh_cooldown = refresh_cooldown
+        self.clock = clock
+        # Bumped whenever the fetched key set differs from the previous one.
+        self.version = 0
+        self.fetches = 0
+        self._keys = {}
+        self._fetched_at = None
+        self._failed_at = None
+        self._lock = threading.Lock()
+
+    def _is_fresh(self):
+        return (
+            self._fetched_at is not None and
+            self.clock() - self._fetched_at < self.ttl
+        )
+
+    # Fetches the key set unless another thread already did so after
+    # `seen_fetch` (the fetch time the caller based its decision on).
+    # Returns: False if a fetch was attempted and failed, else True.
+    def refresh(self, seen_fetch=None, force=False):
+        with self._lock:
+            if self._fetched_at != seen_fetch:
+                return True
+            if not force and self._is_fresh():
+                return True
+
+            self.fetches += 1
+            try:
+                jwks_data = self.fetcher(self.url)
+            except Exception:
+                jwks_data = None
+            return self._load(jwks_data)
+
+    # Stores a fetched key set. Without one (a failed fetch), the last
+    # known key set is kept and trusted for another TTL.
+    # Returns: False if jwks_data holds no key set, else True.
+    def _load(self, jwks_data):
+        if not jwks_data or 'keys' not in jwks_data:
+            # An empty cache surfaces as an error in get_key().
+            self._failed_at = self.clock()
+            if self._keys:
+                self._fetched_at = self.clock()
+            return False
+
+        self._failed_at = None
+
+        keys = {key['kid']: key for key in jwks_data['keys']}
+        if keys != self._keys:
+            self.version += 1
+        self._keys = keys
+        self._fetched_at = self.clock()
+        return True
+
+    # Stores a key set fetched outside the cache, e.g. by the async app.
+    def load(self, jwks_data):
+        with self._lock:
+            return self._load(jwks_data)
+
+    # Checks whether get_key(kid) would fetch: the TTL ran out, or the kid
+    # is unknown, and the cooldown since the last fetch, or failed fetch,
+    # has passed.
+    # Returns: boolean
+    def needs_refresh(self, kid=None):
+        if self._failed_at is not None and \
+                self.clock() - self._failed_at < self.refresh_cooldown:
+            return False
+        if not self._is_fresh():
+            return True
+        return (
+            kid is not None and kid not in self._keys and
+            self.clock() - self._fetched_at >= self.refresh_cooldown
+        )
+
+    # Returns: True once a key set was loaded (boolean).
+    def has_keys(self):
+        return bool(self._keys)
+
+    # Refreshes the key set if its TTL ran out.
+    # Returns: version (int) of the key set in use.
+    def current_version(self):
+        if self.needs_refresh():
+            self.refresh(self._fetched_at)
+        return self.version
+
+    # Returns: key (dictionary) or None if the "kid" is unknown.
+    def get_key(self, kid):
+        seen_fetch = self._fetched_at
+        if self.needs_refresh(kid):
+            self.refresh(seen_fetch, force=True)
+
+        if not self._keys:
+            raise AuthError({
+                'code': 'invalid_auth_api',
+                'description': 'Invalid authorization API.'
+            }, 422)
+
+        return self._keys.get(kid)
+
+    def clear(self):
+        with self._lock:
+            self._keys = {}
+            self._fetched_at = None
+            self._failed_at = None
+            self.version += 1
+
+
+jwks_cache = JWKSCache(JWKS_URL)
+
+
+# Keeps a JWKSCache warm from a daemon thread, so that request threads
+# don't wait on Auth0. The key set is fetched at start, then again after
+# `refresh_ahead` of its TTL (with +/-10% jitter, so workers don't fetch
+# in lockstep). Failed fetches are retried with jittered exponential
+# backoff while requests keep using the last known good keys.
+# Accepts: cache (JWKSCache), refresh_ahead (fraction of the TTL),
+# retry_min and retry_max (seconds), rand (callable returning [0, 1)).
+class JWKSRefresher:
+    def __init__(self, cache, refresh_ahead=JWKS_REFRESH_AHEAD,
+                 retry_min=JWKS_RETRY_MIN, retry_max=JWKS_RETRY_MAX,
+                 rand=random.random):
+        self.cache = cache
+        self.refresh_ahead = refresh_ahead
+        self.retry_min = retry_min
+        self.retry_max = retry_max
+        self.rand = rand
+        # Consecutive failed fetches.
+        self.failures = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    # Returns: seconds to wait before the next fetch (float).
+    def next_delay(self):
+        if self.failures:
+            backoff = min(
+                self.retry_max, self.retry_min * 2 ** (self.failures - 1)
+            )
+            return backoff * (0.5 + self.rand() / 2)
+        return self.cache.ttl * self.refresh_ahead * (0.9 + self.rand() / 5)
+
+    def refresh(self):
+        if self.cache.refresh(self.cache._fetched_at, force=True):
+            self.failures = 0
+        else:
+            self.failures += 1
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.refresh()
+            self._stop.wait(self.next_delay())
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name='jwks-refresher', daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+jwks_refresher = None
+
+
+# Starts refreshing the process's key set in the background. Called from
+# the gunicorn post_fork hook, since threads don't survive a fork.
+# Returns: JWKSRefresher
+def start_jwks_refresher():
+    global jwks_refresher
+    if jwks_refresher is None or jwks_refresher.cache is not jwks_cache:
+        if jwks_refresher is not None:
+            jwks_refresher.stop()
+        jwks_refresher = JWKSRefresher(jwks_cache)
+    jwks_refresher.start()
+    return jwks_refresher
+
+
+# Bounded LRU cache of decoded token payloads, keyed by a SHA-256 digest of
+# the raw token. Entries live until the token's "exp" claim and are dropped
+# wholesale when the JWKS key set changes.
+# Accepts: maxsize (int), clock (callable returning epoch seconds).
+class TokenCache:
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE, clock=time.time):
+        self.maxsize = maxsize
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._jwks_version = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _digest(token):
+        return hashlib.sha256(token.encode()).digest()
+
+    def _check_version(self, jwks_version):
+        if jwks_version != self._jwks_version:
+            self.evictions += len(self._entries)
+            self._entries.clear()
+            self._jwks_version = jwks_version
+
+    # Returns: payload (dictionary) or None on a miss.
+    def get(self, token, jwks_version):
+        digest = self._digest(token)
+        with self._lock:
+            self._check_version(jwks_version)
+            entry = self._entries.get(digest)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            payload, expires_at = entry
+            if expires_at <= self.clock():
+                del self._entries[digest]
+                self.evictions += 1
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(digest)
+            self.hits += 1
+            return payload
+
+    def set(self, token, payload, jwks_version):
+        expires_at = payload.get('exp')
+        if not isinstance(expires_at, (int, float)) or self.maxsize <= 0:
+            return
+
+        digest = self._digest(token)
+        with self._lock:
+            self._check_version(jwks_version)
+            self._entries[digest] = (payload, expires_at)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self.evictions += len(self._entries)
+            self._entries.clear()
+
+    # Returns: hit, miss and eviction counters (dictionary).
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self._entries),
+            'maxsize': self.maxsize
+        }
+
+
+token_cache = TokenCache()
+
 # ---------------------------------------------------------
 # Authorization
 # ---------------------------------------------------------
@@ -41,8 +339,13 @@ class AuthError(Exception):
 # Gets auth header.
 # Returns: split_auth_header (string)
 def get_token_auth_header():
-    auth_header = request.headers.get('Authorization', None)
+    return parse_auth_header(request.headers.get('Authorization', None))
+
 
+# Extracts the bearer token from an Authorization header value.
+# Accepts: auth_header (string or None)
+# Returns: token (string)
+def parse_auth_header(auth_header):
     if not auth_header:
         raise AuthError({
             'code': 'invalid_header',
@@ -92,20 +395,21 @@ def check_permissions(permission, payload):
     return True
 
 
-# Fetches JSON web key set from Auth0
+# Looks up the signing key in the cached JSON web key set from Auth0.
 # Accepts: token (string)
 # Returns: rsa_key (dictionary)
 # Link: https://auth0.com/docs/tokens/concepts/jwks
 def get_rsa_key(token):
-    jwks_data = get_json_data(JWKS_URL)
-
-    if not jwks_data:
+    # jose is imported on first use; it adds ~60 ms to worker startup.
+    from jose import jwt
+    try:
+        jwt_headers = jwt.get_unverified_headers(token)
+    except Exception:
         raise AuthError({
-            'code': 'invalid_auth_api',
-            'description': 'Invalid authorization API.'
-        }, 422)
+            'code': 'invalid_header',
+            'description': 'Invalid token header.'
+        }, 401)
 
-    jwt_headers = jwt.get_unverified_headers(token)
     if 'kid' not in jwt_headers:
         raise AuthError({
             'code': 'invalid_header',
@@ -113,9 +417,8 @@ def get_rsa_key(token):
         }, 422)
 
     rsa_key = None
-    for key in jwks_data['keys']:
-        if key['kid'] != jwt_headers['kid']:
-            continue
+    key = jwks_cache.get_key(jwt_headers['kid'])
+    if key:
         rsa_key = {
             'kty': key['kty'],
             'kid': key['kid'],
@@ -134,9 +437,16 @@ def get_rsa_key(token):
 
 
 # Verification and decoding of JWT.
+# Tokens verified before are served from token_cache, skipping the RSA
+# signature check until they expire or the key set rotates.
 # Receives: token (string)
 # Returns: payload (dictionary)
 def verify_decode_jwt(token):
+    payload = token_cache.get(token, jwks_cache.current_version())
+    if payload is not None:
+        return payload
+
+    from jose import jwt
     rsa_key = get_rsa_key(token)
 
     try:
@@ -147,6 +457,7 @@ def verify_decode_jwt(token):
             audience=API_AUDIENCE,
             issuer=f'https://{AUTH0_DOMAIN}/'
         )
+        token_cache.set(token, payload, jwks_cache.version)
         return payload
 
     except jwt.ExpiredSignatureError:
@@ -169,13 +480,18 @@ def verify_decode_jwt(token):
 
 
 # Decorator to check permissions and authentication on endpoints.
+# The time spent is kept in g.auth_duration for request metrics.
 def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            start = time.perf_counter()
+            try:
+                token = get_token_auth_header()
+                payload = verify_decode_jwt(token)
+                check_permissions(permission, payload)
+            finally:
+                g.auth_duration = time.perf_counter() - start
             return f(*args, **kwargs)
 
         return wrapper
@@ -0,0 +1,114 @@
+# ---------------------------------------------------------
+# Imports
+# ---------------------------------------------------------
+
+import threading
+import time
+from collections import OrderedDict
+
+# ---------------------------------------------------------
+# Key-value backends
+# ---------------------------------------------------------
+
+
+# In-process key-value store, optionally bounded as an LRU.
+# Only visible to the worker process that created it.
+# Accepts: maxsize (int or None for unbounded), clock (callable).
+class MemoryBackend:
+    def __init__(self, maxsize=None, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.clock = clock
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        item = self._items.get(key)
+        if item is None:
+            return None
+
+        value, expires_at = item
+        if expires_at is not None and expires_at <= self.clock():
+            del self._items[key]
+            return None
+
+        self._items.move_to_end(key)
+        return value
+
+    def get(self, key):
+        with self._lock:
+            return self._get(key)
+
+    def get_many(self, keys):
+        with self._lock:
+            return [self._get(key) for key in keys]
+
+    # Stores a value; with only_new=True, only if the key is not set yet.
+    # Returns: boolean, True if the value was stored.
+    def set(self, key, value, ttl=None, only_new=False):
+        with self._lock:
+            if only_new and self._get(key) is not None:
+                return False
+
+            expires_at = self.clock() + ttl if ttl else None
+            self._items[key] = (value, expires_at)
+            self._items.move_to_end(key)
+            if self.maxsize:
+                while len(self._items) > self.maxsize:
+                    self._items.popitem(last=False)
+            return True
+
+    def incr(self, key):
+        with self._lock:
+            value = int(self._get(key) or 0) + 1
+            self._items[key] = (value, None)
+            return value
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+# Key-value store shared by every worker through Redis.
+# Accepts: client (redis.Redis or any object with the same get, mget, set,
+# incr and delete methods), prefix (string).
+class RedisBackend:
+    def __init__(self, client, prefix='agency:'):
+        self.client = client
+        self.prefix = prefix
+
+    # Connects to Redis; the redis package is only needed for this backend.
+    @classmethod
+    def from_url(cls, url, prefix='agency:'):
+        import redis
+        return cls(redis.Redis.from_url(url), prefix)
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def get_many(self, keys):
+        return self.client.mget([self.prefix + key for key in keys])
+
+    def set(self, key, value, ttl=None, only_new=False):
+        stored = self.client.set(
+            self.prefix + key, value, ex=ttl or None, nx=only_new
+        )
+        return bool(stored)
+
+    def incr(self, key):
+        return self.client.incr(self.prefix + key)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+
+# Builds the backend named in the app config.
+# Accepts: config (dictionary), maxsize (int) for the memory backend.
+# Returns: MemoryBackend or RedisBackend
+def backend_from_config(config, maxsize=None):
+    if config.get('CACHE_BACKEND', 'memory') == 'redis':
+        return RedisBackend.from_url(config['CACHE_REDIS_URL'])
+    return MemoryBackend(maxsize)
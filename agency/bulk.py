@@ -0,0 +1,288 @@
+# ---------------------------------------------------------
+# Imports
+# ---------------------------------------------------------
+
+import json
+from flask import request, abort, current_app
+from sqlalchemy import func
+from .export import NDJSON_MIMETYPE
+from .models import db, notify_write, parse_fields, record_deletes
+from .stats import apply_deltas, stat_deltas, stat_fields, stat_rows
+
+# ---------------------------------------------------------
+# Request parsing
+# ---------------------------------------------------------
+
+
+# Reads a list of records from the request body, sent either as a JSON
+# array or as newline-delimited JSON (one object per line).
+# Lines that are not valid JSON are kept as None so they can be reported
+# by index.
+# Returns: records (list)
+def read_records():
+    if request.mimetype == NDJSON_MIMETYPE:
+        records = []
+        for line in request.get_data(as_text=True).splitlines():
+            if not line.strip():
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                records.append(None)
+    else:
+        records = request.get_json(silent=True)
+
+    if not isinstance(records, list) or not records:
+        abort(422)
+
+    max_records = current_app.config.get('BULK_MAX_RECORDS', 50000)
+    if len(records) > max_records:
+        abort(422)
+
+    return records
+
+
+# Checks each record against the model's required fields and field
+# parsers, the same rules the single-item endpoints apply.
+# Accepts: records (list), model (db.Model)
+# Returns: valid rows (list of (index, dictionary)) and errors (list)
+def validate_records(records, model):
+    rows = []
+    errors = []
+
+    for index, record in enumerate(records):
+        if not isinstance(record, dict):
+            errors.append({'index': index, 'message': 'Invalid record.'})
+            continue
+
+        missing = [f for f in model.required_fields if f not in record]
+        if missing:
+            errors.append({
+                'index': index,
+                'message': 'Missing fields: %s.' % ', '.join(missing)
+            })
+            continue
+
+        try:
+            row = parse_fields(
+                model, {f: record[f] for f in model.required_fields}
+            )
+        except ValueError as error:
+            errors.append({'index': index, 'message': str(error)})
+            continue
+
+        rows.append((index, row))
+
+    return rows, errors
+
+
+# Reads a list of ids from the "ids" key of a JSON body.
+# Accepts: data (dictionary)
+# Returns: ids (list of int)
+def read_ids(data):
+    ids = data.get('ids') if isinstance(data, dict) else None
+    if not isinstance(ids, list) or not ids:
+        abort(422)
+    if not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+        abort(422)
+
+    max_records = current_app.config.get('BULK_MAX_RECORDS', 50000)
+    if len(ids) > max_records:
+        abort(422)
+
+    return list(dict.fromkeys(ids))
+
+
+# Keeps the editable fields of a partial update, skipping empty values the
+# same way the single-item PATCH endpoints do. Fields without a parser
+# must be strings, as changes are grouped by value.
+def clean_changes(changes, model):
+    if not isinstance(changes, dict):
+        abort(422)
+
+    changes = {
+        f: changes[f] for f in model.required_fields
+        if f in changes and changes[f]
+    }
+    for field, value in changes.items():
+        if field not in model.field_parsers and not isinstance(value, str):
+            abort(422)
+    try:
+        return parse_fields(model, changes)
+    except ValueError:
+        abort(422)
+
+
+# Reads a batch update, sent either as {"ids": [...], "changes": {...}} to
+# apply one change to every id, or as {"updates": {"<id>": {...}}}.
+# Accepts: data (dictionary), model (db.Model)
+# Returns: list of (ids, changes) groups
+def read_updates(data, model):
+    if not isinstance(data, dict):
+        abort(422)
+
+    if 'updates' not in data:
+        changes = clean_changes(data.get('changes'), model)
+        if not changes:
+            abort(422)
+        return [(read_ids(data), changes)]
+
+    updates = data['updates']
+    if not isinstance(updates, dict) or not updates:
+        abort(422)
+
+    # Ids sharing the same changes are updated with a single statement.
+    groups = {}
+    for key, changes in updates.items():
+        try:
+            item_id = int(key)
+        except ValueError:
+            abort(422)
+        changes = clean_changes(changes, model)
+        if changes:
+            groups.setdefault(tuple(sorted(changes.items())), []).append(item_id)
+
+    if not groups:
+        abort(422)
+
+    return [(ids, dict(changes)) for changes, ids in groups.items()]
+
+# ---------------------------------------------------------
+# Bulk writes
+# ---------------------------------------------------------
+
+
+# Inserts one chunk of rows in the current transaction.
+# Postgres returns the new ids from a multi-row INSERT ... RETURNING.
+# SQLite doesn't support RETURNING here, but the insert holds its write
+# lock and numbers the rows consecutively, so they end at max(id).
+# Returns: ids of the inserted rows (list)
+def insert_chunk(table, rows):
+    if db.session.get_bind().dialect.name == 'postgresql':
+        result = db.session.execute(
+            table.insert().values(rows).returning(table.c.id)
+        )
+        return [row_id for row_id, in result]
+
+    db.session.execute(table.insert(), rows)
+    last_id = db.session.query(func.max(table.c.id)).scalar()
+    return list(range(last_id - len(rows) + 1, last_id + 1))
+
+
+# Inserts rows in chunks, one multi-row INSERT and one commit per chunk.
+# A chunk the database rejects is rolled back and reported, and the
+# remaining chunks are still inserted.
+# Accepts: model (db.Model), rows (list of (index, dictionary))
+# Returns: ids of the created rows (list) and errors (list)
+def insert_records(model, rows):
+    chunk_size = current_app.config.get('BULK_CHUNK_SIZE', 1000)
+    table = model.__table__
+    created = []
+    errors = []
+
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        try:
+            chunk_rows = [row for _, row in chunk]
+            ids = insert_chunk(table, chunk_rows)
+            apply_deltas(stat_deltas(model, new_rows=chunk_rows))
+            db.session.commit()
+            created += ids
+        except Exception:
+            db.session.rollback()
+            errors += [
+                {'index': index, 'message': 'Could not be inserted.'}
+                for index, _ in chunk
+            ]
+
+    if created:
+        notify_write(table.name, 'insert', created)
+
+    return created, errors
+
+
+# Splits ids into lists short enough for one IN (...) clause.
+def chunk_ids(ids):
+    chunk_size = current_app.config.get('BULK_CHUNK_SIZE', 1000)
+    for start in range(0, len(ids), chunk_size):
+        yield ids[start:start + chunk_size]
+
+
+# Returns: the subset of ids present in the model's table (set).
+def existing_ids(model, ids):
+    found = set()
+    for chunk in chunk_ids(ids):
+        rows = db.session.query(model.id).filter(model.id.in_(chunk))
+        found.update(row_id for row_id, in rows)
+    return found
+
+
+# Applies each group of changes with one UPDATE ... WHERE id IN (...)
+# statement, all in one transaction.
+# Accepts: model (db.Model), updates (list of (ids, changes))
+# Returns: updated ids (list) and missing ids (list)
+def update_records(model, updates):
+    table = model.__table__
+    all_ids = list(dict.fromkeys(i for ids, _ in updates for i in ids))
+    found = existing_ids(model, all_ids)
+
+    for ids, changes in updates:
+        ids = [i for i in ids if i in found]
+        counted = set(changes) & set(stat_fields(model))
+        for chunk in chunk_ids(ids):
+            if counted:
+                old = stat_rows(model, chunk).values()
+                new = [dict(row, **changes) for row in old]
+                apply_deltas(stat_deltas(model, old, new))
+            db.session.execute(
+                table.update().where(table.c.id.in_(chunk)).values(**changes)
+            )
+    db.session.commit()
+
+    updated = [i for i in all_ids if i in found]
+    if updated:
+        notify_write(table.name, 'update', updated)
+
+    return updated, [i for i in all_ids if i not in found]
+
+
+# Finds the foreign keys pointing at a table, such as cast assignments.
+# Accepts: table (Table)
+# Returns: (referencing table, column) pairs (list)
+def references_to(table):
+    return [
+        (other, key.parent)
+        for other in db.metadata.sorted_tables
+        for key in other.foreign_keys
+        if key.column.table is table
+    ]
+
+
+# Deletes rows with DELETE ... WHERE id IN (...) in one transaction.
+# Accepts: model (db.Model), ids (list)
+# Returns: deleted ids (list) and missing ids (list)
+def delete_records(model, ids):
+    table = model.__table__
+    found = existing_ids(model, ids)
+
+    # Rows referencing the deleted ones (such as cast assignments) are
+    # removed first, for databases that don't enforce ON DELETE CASCADE.
+    references = references_to(table)
+
+    deleted = [i for i in ids if i in found]
+    for chunk in chunk_ids(deleted):
+        apply_deltas(stat_deltas(
+            model, old_rows=stat_rows(model, chunk).values()
+        ))
+        for other, column in references:
+            db.session.execute(other.delete().where(column.in_(chunk)))
+        db.session.execute(table.delete().where(table.c.id.in_(chunk)))
+        record_deletes(table.name, chunk)
+    db.session.commit()
+
+    if deleted:
+        for other in {other for other, _ in references}:
+            notify_write(other.name, 'delete')
+        notify_write(table.name, 'delete', deleted)
+
+    return deleted, [i for i in ids if i not in found]
@@ -0,0 +1,156 @@
+# ---------------------------------------------------------
+# Imports
+# ---------------------------------------------------------
+
+import json
+from functools import wraps
+from flask import Response, make_response
+from .backends import MemoryBackend, backend_from_config
+from .models import write_listeners
+from .versions import current_etag, resolve_tables, table_versions
+
+# ---------------------------------------------------------
+# Response cache
+# ---------------------------------------------------------
+
+
+# Headers stored with a cached response and sent again on every hit.
+# Server-Timing isn't one of them: a hit reports its own timings.
+CACHED_HEADERS = ('Content-Type', 'Cache-Control', 'Vary')
+
+
+# Caches rendered read responses in a key-value backend.
+# Keys are built from the versions of the tables a route reads, so a
+# committed write to a table moves every reader of that table to new keys
+# and stale entries are never served; they just age out.
+# Entries are the JSON-encoded CACHED_HEADERS, a newline and the body.
+class ResponseCache:
+    def __init__(self, backend=None, ttl=None):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if self.backend is None:
+            return None
+
+        cached = self.backend.get('responses:' + key)
+        if cached is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        headers, _, body = cached.partition(b'\n')
+        return Response(body, headers=json.loads(headers))
+
+    def set(self, key, response):
+        if self.backend is None:
+            return
+
+        headers = [
+            (name, value) for name, value in response.headers
+            if name in CACHED_HEADERS
+        ]
+        value = json.dumps(headers).encode() + b'\n' + response.get_data()
+        self.backend.set('responses:' + key, value, ttl=self.ttl)
+
+    # Returns: hit and miss counters (dictionary).
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+response_cache = ResponseCache()
+
+
+# Per-process primary-key cache of formatted rows for single-item reads.
+# Entries are dropped when a model's update() or delete() commits in this
+# process, and carry the table version they were read at, so writes made
+# by other workers (seen through a shared version backend) also retire
+# them.
+# Accepts: maxsize (int)
+class ItemCache:
+    def __init__(self, maxsize=None):
+        self.items = MemoryBackend(maxsize)
+        self.hits = 0
+        self.misses = 0
+
+    # Returns: the formatted row (dictionary) or None if it doesn't exist.
+    def get(self, model, item_id):
+        if not table_versions.enabled:
+            item = model.query.get(item_id)
+            return item.format() if item is not None else None
+
+        table = model.__tablename__
+        _, versions = table_versions.get([table])
+        version = versions[table][0]
+        key = '%s:%s' % (table, item_id)
+
+        entry = self.items.get(key)
+        if entry is not None and entry[0] == version:
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        item = model.query.get(item_id)
+        if item is None:
+            return None
+
+        data = item.format()
+        self.items.set(key, (version, data))
+        return data
+
+    def evict(self, table, ids):
+        for item_id in ids:
+            self.items.delete('%s:%s' % (table, item_id))
+
+    # Returns: hit and miss counters (dictionary).
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+item_cache = ItemCache()
+
+
+def evict_items(table, action, ids):
+    if action != 'insert':
+        item_cache.evict(table, ids)
+
+
+write_listeners.append(evict_items)
+
+
+# Configures the response cache from CACHE_BACKEND ('memory', 'redis' or
+# 'none'), CACHE_SIZE and CACHE_TTL.
+def setup_cache(app, backend=None):
+    config = app.config
+    if backend is None and config.get('CACHE_BACKEND', 'none') != 'none':
+        backend = backend_from_config(config, config.get('CACHE_SIZE'))
+
+    response_cache.backend = backend
+    response_cache.ttl = config.get('CACHE_TTL')
+    item_cache.items = MemoryBackend(config.get('ITEM_CACHE_SIZE'))
+
+
+# Decorator serving a GET route from the response cache.
+# Only complete 200 responses are stored; streamed exports bypass it.
+# Accepts: tables (strings, or one callable) read by the route.
+def cached(*tables):
+    def cached_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if response_cache.backend is None:
+                return f(*args, **kwargs)
+
+            key, _ = current_etag(resolve_tables(tables))
+            response = response_cache.get(key)
+            if response is not None:
+                return response
+
+            response = make_response(f(*args, **kwargs))
+            if response.status_code == 200 and not response.is_streamed:
+                response_cache.set(key, response)
+            return response
+
+        return wrapper
+    return cached_decorator
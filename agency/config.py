@@ -13,3 +13,81 @@ SQLALCHEMY_TRACK_MODIFICATIONS = True
 # Connect to the database
 # DONE IMPLEMENT DATABASE URL
 SQLALCHEMY_DATABASE_URI = 'postgres://postgres@localhost:5432/agency'
+
+# Default and maximum number of rows returned by list endpoints.
+PAGE_SIZE = int(os.environ.get('PAGE_SIZE', 50))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 500))
+
+# Rows fetched per round trip when streaming NDJSON exports.
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 1000))
+
+# Rows per INSERT statement and transaction for the bulk endpoints, and
+# the maximum number of records accepted in one request. Postgres takes
+# at most 65535 parameters per statement, about 13000 rows of 5 columns.
+BULK_CHUNK_SIZE = int(os.environ.get('BULK_CHUNK_SIZE', 1000))
+BULK_MAX_RECORDS = int(os.environ.get('BULK_MAX_RECORDS', 50000))
+
+# Response cache and table version backend: 'redis' (shared by all
+# workers, needs CACHE_REDIS_URL), 'memory' (per process, only for a
+# single worker) or 'none', which also turns off ETags and 304s.
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'none')
+CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL', 'redis://localhost:6379/0')
+# Entries kept by the memory backend and seconds each entry lives.
+CACHE_SIZE = int(os.environ.get('CACHE_SIZE', 1024))
+CACHE_TTL = int(os.environ.get('CACHE_TTL', 300))
+# Rows kept per process for single-item reads.
+ITEM_CACHE_SIZE = int(os.environ.get('ITEM_CACHE_SIZE', 10000))
+
+# Connection pool settings for Postgres. Keep
+# workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) under the server's limit.
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 30))
+# Seconds after which a connection is replaced, and whether connections
+# are tested with a ping before use.
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', '1') == '1'
+# Milliseconds before Postgres cancels a statement; 0 disables it.
+DB_STATEMENT_TIMEOUT = int(os.environ.get('DB_STATEMENT_TIMEOUT', 0))
+
+# Fraction of requests that get detailed DB, auth and serialization
+# timings and a Server-Timing header.
+METRICS_SAMPLE_RATE = float(os.environ.get('METRICS_SAMPLE_RATE', 0.1))
+
+# Slow-query and N+1 detector: statements slower than SLOW_QUERY_MS are
+# logged, as are requests repeating one statement shape more than
+# N_PLUS_ONE_THRESHOLD times.
+QUERY_LOG = os.environ.get('QUERY_LOG', '0') == '1'
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 100))
+N_PLUS_ONE_THRESHOLD = int(os.environ.get('N_PLUS_ONE_THRESHOLD', 10))
+
+# JSON encoder for list responses: 'auto' uses orjson when it is
+# installed, 'orjson' requires it, 'stdlib' always uses the json module.
+JSON_BACKEND = os.environ.get('JSON_BACKEND', 'auto')
+
+# Lazy startup: skip db.create_all() and optional extensions when the app
+# is created, so workers boot without touching the database. The schema
+# then comes from `flask db upgrade` or `flask create-db`.
+LAZY_STARTUP = os.environ.get('LAZY_STARTUP', '0') == '1'
+
+# Seconds a change must be old before ?changed_since= returns it, longer
+# than any write transaction takes to commit.
+SYNC_LAG = float(os.environ.get('SYNC_LAG', 2))
+
+# Write events for /events: 'auto' fans them out to every worker with
+# Postgres LISTEN/NOTIFY when the database is Postgres, 'memory' keeps
+# them in-process. Events kept for Last-Event-ID resumes, and seconds
+# between keep-alive comments on idle streams.
+EVENTS_BACKEND = os.environ.get('EVENTS_BACKEND', 'auto')
+EVENTS_HISTORY = int(os.environ.get('EVENTS_HISTORY', 1000))
+EVENTS_HEARTBEAT = float(os.environ.get('EVENTS_HEARTBEAT', 15))
+# Open /events streams per worker; each holds a thread, so keep this
+# below GUNICORN_THREADS to leave threads for other requests.
+EVENTS_MAX_STREAMS = int(os.environ.get('EVENTS_MAX_STREAMS', 4))
+
+# Group commit: concurrent single-row inserts (/add-actor, /add-movie)
+# share one transaction, gathered for up to GROUP_COMMIT_WINDOW_MS
+# milliseconds or GROUP_COMMIT_MAX_SIZE rows.
+GROUP_COMMIT = os.environ.get('GROUP_COMMIT', '0') == '1'
+GROUP_COMMIT_WINDOW_MS = float(os.environ.get('GROUP_COMMIT_WINDOW_MS', 2))
+GROUP_COMMIT_MAX_SIZE = int(os.environ.get('GROUP_COMMIT_MAX_SIZE', 64))
@@ -0,0 +1,47 @@
+# ---------------------------------------------------------
+# Imports
+# ---------------------------------------------------------
+
+from flask import request, abort
+from sqlalchemy.orm import selectinload
+from .models import movie_cast
+
+# ---------------------------------------------------------
+# Embedded relationships
+# ---------------------------------------------------------
+
+
+# Checks ?embed= against the relationship the model can embed.
+# Returns: boolean
+def wants_embed(model):
+    embed = request.args.get('embed')
+    if embed is None:
+        return False
+    if embed != model.embed_field:
+        abort(422)
+    return True
+
+
+# Adds eager loading of the embedded relationship to a query.
+# selectinload fetches the related rows of a whole page with one extra
+# query, instead of one query per row.
+# Accepts: query (Query), model (db.Model)
+# Returns: query (Query)
+def with_embed(query, model):
+    relationship = getattr(model, model.embed_field)
+    return query.options(selectinload(relationship))
+
+
+# Builds the function listing the tables a read depends on, for the
+# conditional GET and response cache decorators. Embedded reads also
+# depend on the related table and the cast assignments.
+# Accepts: model (db.Model), related (db.Model)
+# Returns: callable returning a tuple of table names
+def read_tables(model, related):
+    def tables():
+        if request.args.get('embed') == model.embed_field:
+            return (
+                model.__tablename__, related.__tablename__, movie_cast.name
+            )
+        return (model.__tablename__,)
+    return tables
@@ -0,0 +1,325 @@
+# ---------------------------------------------------------
+# Imports
+# ---------------------------------------------------------
+
+import json
+import logging
+import select
+import threading
+import time
+import uuid
+from collections import deque
+from flask import Response, abort, current_app, request
+from sqlalchemy import create_engine, text
+from .models import write_listeners
+
+logger = logging.getLogger('agency.events')
+
+# Event names for committed writes, per table and action.
+TABLE_EVENTS = {'actors': 'actor', 'movies': 'movie'}
+ACTION_EVENTS = {'insert': 'created', 'update': 'updated', 'delete': 'deleted'}
+
+# Ids per event, keeping NOTIFY payloads under Postgres' 8000 bytes.
+MAX_EVENT_IDS = 500
+
+# ---------------------------------------------------------
+# Subscriptions
+# ---------------------------------------------------------
+
+
+# Builds an event telling a client it missed events and should resync,
+# e.g. with ?changed_since=.
+# Accepts: event_id (string or None) the client can resume after.
+def reset_event(event_id=None):
+    return {'id': event_id, 'event': 'reset', 'data': {}}
+
+
+# Events waiting to be sent to one /events client. A client that falls
+# more than maxsize events behind gets a single reset event instead.
+# Accepts: maxsize (int)
+class Subscription:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.events = deque()
+        self._ready = threading.Condition()
+
+    def put(self, event):
+        with self._ready:
+            if len(self.events) >= self.maxsize:
+                self.events.clear()
+                event = reset_event(event['id'])
+            self.events.append(event)
+            self._ready.notify()
+
+    # Waits up to timeout seconds for the next event.
+    # Returns: event (dictionary) or None
+    def get(self, timeout):
+        with self._ready:
+            if not self.events:
+                self._ready.wait(timeout)
+            return self.events.popleft() if self.events else None
+
+# ---------------------------------------------------------
+# Channels
+# ---------------------------------------------------------
+
+
+# Fans events out to every worker through Postgres LISTEN/NOTIFY.
+# Publishing is a pg_notify() on its own small connection pool, so it
+# also works outside a Flask app context (the async app). Notifications
+# are delivered to every listener in commit order, so all workers see the
+# same event sequence. The listening thread starts with the first /events
+# client of the worker, and reconnects with backoff; events missed while
+# disconnected are reported as a reset. `listening` is set once LISTEN
+# has run, and `stopped` once the channel was replaced.
+# Accepts: url (string), name (string) of the NOTIFY channel
+class PostgresChannel:
+    def __init__(self, url, name='agency_events'):
+        self.url = url
+        self.name = name
+        self.engine = None
+        self.thread = None
+        self.listening = threading.Event()
+        self.stopped = threading.Event()
+        self._lock = threading.Lock()
+
+    def _engine(self):
+        with self._lock:
+            if self.stopped.is_set():
+                raise RuntimeError('Event channel %s is stopped.' % self.name)
+            if self.engine is None:
+                self.engine = create_engine(
+                    self.url, pool_size=1, max_overflow=4,
+                    pool_pre_ping=True
+                )
+            return self.engine
+
+    def publish(self, event):
+        with self._engine().connect() as connection:
+            connection.execution_options(autocommit=True).execute(
+                text('SELECT pg_notify(:channel, :payload)'),
+                channel=self.name, payload=json.dumps(event)
+            )
+
+    # Starts the listening thread once, calling deliver(event) for every
+    # notification.
+    def listen(self, deliver):
+        with self._lock:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._run, args=(deliver,),
+                    name='event-listener'
+                )
+                self.thread.daemon = True
+                self.thread.start()
+
+    # Stops listening and closes the channel's connections. The listening
+    # thread exits within its 5 second poll, without delivering more.
+    def stop(self):
+        self.stopped.set()
+        with self._lock:
+            if self.engine is not None:
+                self.engine.dispose()
+                self.engine = None
+
+    def _run(self, deliver):
+        delay = 1
+        connected_before = False
+        while not self.stopped.is_set():
+            proxy = None
+            try:
+                # A dedicated connection, detached from the pool.
+                proxy = self._engine().raw_connection()
+                proxy.detach()
+                connection = proxy.connection
+                connection.autocommit = True
+                connection.cursor().execute('LISTEN %s' % self.name)
+                if connected_before:
+                    deliver(reset_event())
+                connected_before = True
+                delay = 1
+                self.listening.set()
+
+                while not self.stopped.is_set():
+                    if select.select([connection], [], [], 5)[0]:
+                        connection.poll()
+                        while connection.notifies:
+                            note = connection.notifies.pop(0)
+                            if not self.stopped.is_set():
+                                deliver(json.loads(note.payload))
+                connection.close()
+            except Exception:
+                self.listening.clear()
+                if proxy is not None:
+                    proxy.connection.close()
+                if self.stopped.is_set():
+                    break
+                logger.exception('Event listener lost its connection')
+                self.stopped.wait(delay)
+                delay = min(delay * 2, 60)
+
+# ---------------------------------------------------------
+# Broker
+# ---------------------------------------------------------
+
+
+# Publishes write events to the /events clients of every worker.
+# Events are kept in a bounded history, in delivery order, so clients can
+# resume after the Last-Event-ID they saw. Without a channel (SQLite,
+# tests, EVENTS_BACKEND=memory) events only reach this process.
+class EventBroker:
+    def __init__(self):
+        self.config = {}
+        self.channel = None
+        self.history = deque(maxlen=1000)
+        self.subscriptions = set()
+        self._configured = False
+        self._lock = threading.Lock()
+
+    # Remembers the app config; the channel is picked on first use, once
+    # the database URL is final. A channel from an earlier configuration
+    # is stopped, so its listener doesn't deliver events twice.
+    def configure(self, config):
+        with self._lock:
+            if self.channel is not None:
+                self.channel.stop()
+            self.config = config
+            self.channel = None
+            self._configured = False
+            self.history = deque(maxlen=config.get('EVENTS_HISTORY', 1000))
+
+    def _channel(self):
+        with self._lock:
+            if not self._configured:
+                backend = self.config.get('EVENTS_BACKEND', 'auto')
+                url = self.config.get('SQLALCHEMY_DATABASE_URI') or ''
+                if backend == 'postgres' or (
+                        backend == 'auto' and url.startswith('postgres')):
+                    self.channel = PostgresChannel(url)
+                self._configured = True
+            return self.channel
+
+    def publish(self, name, data):
+        event = {'id': uuid.uuid4().hex[:16], 'event': name, 'data': data}
+        channel = self._channel()
+        if channel is None:
+            self.deliver(event)
+        else:
+            channel.publish(event)
+
+    # Records an event and hands it to this process' subscriptions.
+    def deliver(self, event):
+        with self._lock:
+            if event['id'] is not None:
+                self.history.append(event)
+            subscriptions = list(self.subscriptions)
+        for subscription in subscriptions:
+            subscription.put(event)
+
+    # Returns: subscription and the events after last_event_id (list),
+    # or a reset if that event is no longer in the history; None when
+    # max_streams subscriptions are already open.
+    def subscribe(self, last_event_id=None, max_streams=None):
+        channel = self._channel()
+        if channel is not None:
+            channel.listen(self.deliver)
+
+        subscription = Subscription(self.history.maxlen)
+        with self._lock:
+            if max_streams is not None and \
+                    len(self.subscriptions) >= max_streams:
+                return None
+            self.subscriptions.add(subscription)
+            ids = [event['id'] for event in self.history]
+            if not last_event_id:
+                backlog = []
+            elif last_event_id in ids:
+                backlog = list(self.history)[ids.index(last_event_id) + 1:]
+            else:
+                backlog = [reset_event(ids[-1] if ids else None)]
+        return subscription, backlog
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self.subscriptions.discard(subscription)
+
+
+event_broker = EventBroker()
+
+
+# Publishes one event per chunk of ids for writes to actors and movies.
+def publish_write(table, action, ids):
+    if table not in TABLE_EVENTS:
+        return
+    name = '%s.%s' % (TABLE_EVENTS[table], ACTION_EVENTS[action])
+    try:
+        for start in range(0, max(len(ids), 1), MAX_EVENT_IDS):
+            event_broker.publish(
+                name, {'ids': ids[start:start + MAX_EVENT_IDS]}
+            )
+    except Exception:
+        logger.exception('Could not publish %s', name)
+
+
+write_listeners.append(publish_write)
+
+
+def setup_events(app):
+    event_broker.configure(app.config)
+
+# ---------------------------------------------------------
+# Server-Sent Events
+# ---------------------------------------------------------
+
+
+# Formats an event as a text/event-stream message.
+# Returns: message (string)
+def format_event(event):
+    lines = []
+    if event['id'] is not None:
+        lines.append('id: %s' % event['id'])
+    lines.append('event: %s' % event['event'])
+    lines.append('data: %s' % json.dumps(event['data']))
+    return '\n'.join(lines) + '\n\n'
+
+
+# Streams write events to the client until it disconnects, starting after
+# the Last-Event-ID header (or ?last_event_id=) when given. A comment is
+# sent every EVENTS_HEARTBEAT seconds so proxies keep the stream open.
+# Each stream holds a server thread, so a worker serves at most
+# EVENTS_MAX_STREAMS of them and answers 503 beyond that.
+# Returns: Response
+def stream_events():
+    config = current_app.config
+    heartbeat = config.get('EVENTS_HEARTBEAT', 15)
+    last_event_id = (
+        request.headers.get('Last-Event-ID') or
+        request.args.get('last_event_id')
+    )
+
+    subscribed = event_broker.subscribe(
+        last_event_id, config.get('EVENTS_MAX_STREAMS', 4)
+    )
+    if subscribed is None:
+        abort(503)
+    subscription, backlog = subscribed
+
+    def generate():
+        yield 'retry: 3000\n\n'
+        for event in backlog:
+            yield format_event(event)
+        while True:
+            event = subscription.get(heartbeat)
+            if event is None:
+                yield ': keep-alive\n\n'
+            else:
+                yield format_event(event)
+
+    response = Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    # The server closes the response when the client goes away, even if
+    # the stream was never started.
+    response.call_on_close(lambda: event_broker.unsubscribe(subscription))
+    return response
@@ -0,0 +1,61 @@
+# ---------------------------------------------------------
+# Imports
+# ---------------------------------------------------------
+
+from flask import Response, request, current_app, stream_with_context
+from .serialize import dumps, format_rows, select_fields
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+# ---------------------------------------------------------
+# Streaming export
+# ---------------------------------------------------------
+
+
+# Checks whether the client asked for a streamed export, either with
+# ?stream=1 or with an Accept header preferring NDJSON.
+# Returns: boolean
+def wants_stream():
+    if request.args.get('stream', '').lower() in ('1', 'true'):
+        return True
+
+    best = request.accept_mimetypes.best_match(
+        ['application/json', NDJSON_MIMETYPE]
+    )
+    return best == NDJSON_MIMETYPE
+
+
+def encode_lines(rows, model):
+    return b''.join(dumps(row) + b'\n' for row in format_rows(rows, model))
+
+
+# Streams every row of a query as newline-delimited JSON.
+# Rows are read from a server-side cursor in batches and written out as
+# they arrive, so memory use and time to first byte don't depend on the
+# size of the table.
+# Accepts: query (Query), model (db.Model)
+# Returns: Response
+def stream_rows(query, model):
+    batch_size = current_app.config.get('EXPORT_BATCH_SIZE', 1000)
+
+    def generate():
+        rows = (
+            select_fields(query, model).order_by(model.id)
+            .execution_options(stream_results=True)
+            .yield_per(batch_size)
+        )
+
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                yield encode_lines(batch, model)
+                batch = []
+
+        if batch:
+            yield encode_lines(batch, model)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype=NDJSON_MIMETYPE
+    )
@@ -0,0 +1,78 @@
+# ---------------------------------------------------------
+# Imports
+# ---------------------------------------------------------
+
+from flask import request, abort
+
+# ---------------------------------------------------------
+# Filtering and sorting
+# ---------------------------------------------------------
+
+OPERATORS = {
+    'eq': lambda column, value: column == value,
+    'ge': lambda column, value: column >= value,
+    'le': lambda column, value: column <= value,
+    'prefix': lambda column, value: column.startswith(value, autoescape=True),
+}
+
+
+# Turns filter arguments into WHERE clauses.
+# Only the arguments listed in the model's filter_fields are used, so
+# every filter lands on an indexed column.
+# Accepts: model (db.Model), args (mapping of query arguments)
+# Returns: clauses (list)
+def filter_clauses(model, args):
+    clauses = []
+    for argument, (field, operator) in model.filter_fields.items():
+        value = args.get(argument)
+        if value is None:
+            continue
+        if value == '':
+            abort(422)
+
+        parser = model.field_parsers.get(field)
+        if parser:
+            try:
+                value = parser(value)
+            except ValueError:
+                abort(422)
+
+        column = getattr(model, field)
+        clauses.append(OPERATORS[operator](column, value))
+
+    return clauses
+
+
+# Applies the filter arguments of the request to a query.
+# Accepts: query (Query), model (db.Model)
+# Returns: filtered query (Query)
+def apply_filters(query, model):
+    return query.filter(*filter_clauses(model, request.args))
+
+
+# Parses an order_by argument: <field>, or -<field> for descending order.
+# Fields must be listed in the model's sort_fields; id breaks ties so the
+# order is stable across pages.
+# Accepts: model (db.Model), order_by (string or None)
+# Returns: ORDER BY clauses (list) or None when sorting by id.
+def parse_ordering(model, order_by):
+    if not order_by or order_by == 'id':
+        return None
+
+    descending = order_by.startswith('-')
+    field = order_by.lstrip('-')
+    if field not in model.sort_fields:
+        abort(422)
+
+    column = getattr(model, field)
+    id_column = model.id
+    if descending:
+        return [column.desc(), id_column.desc()]
+    return [column.asc(), id_column.asc()]
+
+
+# Reads ?order_by= from the request.
+# Accepts: model (db.Model)
+# Returns: ORDER BY clauses (list) or None when sorting by id.
+def get_ordering(model):
+    return parse_ordering(model, request.args.get('order_by'))
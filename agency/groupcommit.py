@@ -0,0 +1,188 @@
+# ---------------------------------------------------------
+# Imports
+# ---------------------------------------------------------
+
+import logging
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+from . import models
+from .models import db, notify_write
+from .stats import delta_statements, stat_deltas
+
+logger = logging.getLogger('agency.groupcommit')
+
+# ---------------------------------------------------------
+# Group commit
+# ---------------------------------------------------------
+
+
+# One INSERT statement object per table, so that its compiled form can
+# be cached.
+INSERTS = {}
+
+
+def insert_statement(table):
+    if table not in INSERTS:
+        INSERTS[table] = table.insert()
+    return INSERTS[table]
+
+
+# A row waiting for the committer thread.
+class PendingInsert:
+    def __init__(self, model, values):
+        self.model = model
+        self.values = values
+        self.future = Future()
+
+
+# Coalesces concurrent single-row inserts into shared transactions, so
+# that many requests pay for one commit (and one fsync) together.
+# A committer thread takes the first waiting row, then keeps collecting
+# for up to `window` seconds or until `max_size` rows, inserts them all
+# in one transaction and commits once. Each row gets its own savepoint
+# on Postgres, where a failed statement would otherwise abort the whole
+# transaction; SQLite only undoes the failed statement. Every caller
+# gets its own id, or its own exception, once the commit is done.
+class GroupCommitter:
+    def __init__(self, window=0.002, max_size=64):
+        self.app = None
+        self.window = window
+        self.max_size = max_size
+        self.queue = queue.Queue()
+        self.thread = None
+        self.commits = 0
+        self.inserts = 0
+        # Compiled INSERT statements, reused across groups.
+        self.compiled = {}
+        self._lock = threading.Lock()
+
+    def configure(self, app):
+        self.app = app
+        self.window = app.config.get('GROUP_COMMIT_WINDOW_MS', 2) / 1000
+        self.max_size = app.config.get('GROUP_COMMIT_MAX_SIZE', 64)
+
+    # Starts the committer thread once, in the process that uses it.
+    def start(self):
+        with self._lock:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._run, name='group-committer'
+                )
+                self.thread.daemon = True
+                self.thread.start()
+
+    # Inserts a model instance through the next group commit.
+    # Returns: id of the inserted row (int); raises the insert's error.
+    def insert(self, instance):
+        model = type(instance)
+        pending = PendingInsert(model, {
+            field: getattr(instance, field) for field in model.required_fields
+        })
+        self.start()
+        self.queue.put(pending)
+        return pending.future.result()
+
+    # Waits for the next group of rows.
+    # Returns: pending inserts (list)
+    def collect(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_size:
+            try:
+                batch.append(self.queue.get_nowait())
+                continue
+            except queue.Empty:
+                pass
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self.collect()
+            try:
+                with self.app.app_context():
+                    self.commit(batch)
+            except Exception as error:
+                logger.exception('Group commit of %d rows failed', len(batch))
+                for pending in batch:
+                    if not pending.future.done():
+                        pending.future.set_exception(error)
+
+    # Inserts a group of rows in one transaction, with the /stats
+    # counters, then tells the write listeners and the callers.
+    def commit(self, batch):
+        inserted = []
+        with db.engine.connect() as connection:
+            connection = connection.execution_options(
+                compiled_cache=self.compiled
+            )
+            savepoints = connection.dialect.name == 'postgresql'
+            transaction = connection.begin()
+            try:
+                for pending in batch:
+                    table = pending.model.__table__
+                    savepoint = connection.begin_nested() if savepoints else None
+                    try:
+                        result = connection.execute(
+                            insert_statement(table), pending.values
+                        )
+                    except Exception as error:
+                        if savepoint is not None:
+                            savepoint.rollback()
+                        pending.future.set_exception(error)
+                        continue
+                    if savepoint is not None:
+                        savepoint.commit()
+                    inserted.append((pending, result.inserted_primary_key[0]))
+
+                deltas = Counter()
+                for pending, _ in inserted:
+                    deltas.update(stat_deltas(
+                        pending.model, new_rows=[pending.values]
+                    ))
+                for statement in delta_statements(
+                        deltas, connection.dialect.name):
+                    connection.execute(statement)
+
+                transaction.commit()
+            except Exception:
+                transaction.rollback()
+                raise
+
+        self.commits += 1
+        self.inserts += len(inserted)
+
+        ids = {}
+        for pending, item_id in inserted:
+            ids.setdefault(pending.model.__tablename__, []).append(item_id)
+        for table, table_ids in ids.items():
+            notify_write(table, 'insert', table_ids)
+
+        for pending, item_id in inserted:
+            pending.future.set_result(item_id)
+
+    # Returns: commit and row counters (dictionary).
+    def stats(self):
+        return {'commits': self.commits, 'inserts': self.inserts}
+
+
+group_committer = GroupCommitter()
+
+
+# Routes Actor.insert() and Movie.insert() through the group committer
+# when GROUP_COMMIT is on.
+def setup_group_commit(app):
+    group_committer.configure(app)
+    if app.config.get('GROUP_COMMIT'):
+        models.group_commit = group_committer.insert
+    else:
+        models.group_commit = None
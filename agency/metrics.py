@@ -0,0 +1,245 @@
+# ---------------------------------------------------------
+# Imports
+# ---------------------------------------------------------
+
+import random
+import threading
+import time
+from flask import Response, g, has_request_context, request
+from flask.json import JSONEncoder
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from .auth import auth
+from .cache import item_cache, response_cache
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# ---------------------------------------------------------
+# Registry
+# ---------------------------------------------------------
+
+
+# Cumulative histogram in the Prometheus sense.
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+# Per-process request metrics, labelled by route and method.
+class Metrics:
+    def __init__(self):
+        self.latency = {}
+        self.requests = {}
+        self.sampled = {}
+        self.db_queries = {}
+        self.timings = {}
+        self._lock = threading.Lock()
+
+    def record(self, route, method, status, duration, sample=None):
+        labels = (route, method)
+        with self._lock:
+            self.latency.setdefault(labels, Histogram()).observe(duration)
+            key = labels + (status,)
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+            if sample is None:
+                return
+            self.sampled[labels] = self.sampled.get(labels, 0) + 1
+            self.db_queries[labels] = (
+                self.db_queries.get(labels, 0) + sample['db_count']
+            )
+            for name in ('db', 'auth', 'serialize'):
+                key = labels + (name,)
+                self.timings[key] = self.timings.get(key, 0) + sample[name]
+
+    # Renders every metric in the Prometheus text exposition format.
+    # Returns: string
+    def render(self):
+        lines = []
+
+        def add(name, kind, help_text, samples):
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for suffix, labels, value in samples:
+                lines.append('%s%s{%s} %s' % (
+                    name, suffix, format_labels(labels), value
+                ))
+
+        with self._lock:
+            histogram = []
+            for (route, method), hist in sorted(self.latency.items()):
+                labels = [('route', route), ('method', method)]
+                for bound, count in zip(hist.buckets, hist.counts):
+                    histogram.append(
+                        ('_bucket', labels + [('le', bound)], count)
+                    )
+                histogram += [
+                    ('_bucket', labels + [('le', '+Inf')], hist.count),
+                    ('_sum', labels, hist.sum),
+                    ('_count', labels, hist.count),
+                ]
+            add('agency_request_duration_seconds', 'histogram',
+                'Request latency.', histogram)
+
+            add('agency_requests_total', 'counter', 'Requests served.', [
+                ('', [('route', r), ('method', m), ('status', s)], v)
+                for (r, m, s), v in sorted(self.requests.items())
+            ])
+            add('agency_sampled_requests_total', 'counter',
+                'Requests with detailed timings.', [
+                    ('', [('route', r), ('method', m)], v)
+                    for (r, m), v in sorted(self.sampled.items())
+                ])
+            add('agency_db_queries_total', 'counter',
+                'SQL statements run by sampled requests.', [
+                    ('', [('route', r), ('method', m)], v)
+                    for (r, m), v in sorted(self.db_queries.items())
+                ])
+            add('agency_phase_seconds_total', 'counter',
+                'Time spent per phase by sampled requests.', [
+                    ('', [('route', r), ('method', m), ('phase', p)], v)
+                    for (r, m, p), v in sorted(self.timings.items())
+                ])
+
+        token_stats = auth.token_cache.stats()
+        add('agency_token_cache_total', 'counter',
+            'Verified-token cache lookups and evictions.', [
+                ('', [('result', name)], token_stats[name])
+                for name in ('hits', 'misses', 'evictions')
+            ])
+        add('agency_jwks_fetches_total', 'counter',
+            'Fetches of the JSON web key set.',
+            [('', [], auth.jwks_cache.fetches)])
+        add('agency_cache_total', 'counter', 'Read cache lookups.', [
+            ('', [('cache', cache), ('result', name)], stats[name])
+            for cache, stats in (
+                ('response', response_cache.stats()),
+                ('item', item_cache.stats())
+            )
+            for name in ('hits', 'misses')
+        ])
+
+        return '\n'.join(lines) + '\n'
+
+
+# Returns: Prometheus label set such as route="/actors",method="GET".
+def format_labels(labels):
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+    return ','.join('%s="%s"' % (key, escape(value)) for key, value in labels)
+
+
+metrics = Metrics()
+
+# ---------------------------------------------------------
+# Instrumentation
+# ---------------------------------------------------------
+
+
+# Returns: timings of the current request (dictionary) when it is
+# sampled, otherwise None.
+def current_sample():
+    if has_request_context():
+        return g.get('metrics_sample')
+    return None
+
+
+# Adds time to one phase of the current sampled request.
+def add_timing(phase, seconds):
+    sample = current_sample()
+    if sample is not None:
+        sample[phase] += seconds
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    if current_sample() is not None:
+        conn.info.setdefault('metrics_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    sample = current_sample()
+    starts = conn.info.get('metrics_start')
+    if sample is None or not starts:
+        return
+
+    sample['db'] += time.perf_counter() - starts.pop()
+    sample['db_count'] += 1
+
+
+# JSON encoder that records how long jsonify() spends serializing.
+class TimedJSONEncoder(JSONEncoder):
+    def encode(self, o):
+        start = time.perf_counter()
+        try:
+            return super().encode(o)
+        finally:
+            add_timing('serialize', time.perf_counter() - start)
+
+
+# Formats the sampled timings as a Server-Timing header value.
+def server_timing(sample, total):
+    return ', '.join([
+        'db;dur=%.2f;desc="%d queries"' % (
+            sample['db'] * 1000, sample['db_count']
+        ),
+        'auth;dur=%.2f' % (sample['auth'] * 1000),
+        'serialize;dur=%.2f' % (sample['serialize'] * 1000),
+        'total;dur=%.2f' % (total * 1000),
+    ])
+
+
+# Hooks request timing into the app and adds the /metrics endpoint.
+# METRICS_SAMPLE_RATE is the fraction of requests that get the detailed
+# DB, auth and serialization timings and a Server-Timing header; latency
+# and counts are recorded for every request.
+def setup_metrics(app):
+    app.json_encoder = TimedJSONEncoder
+
+    @app.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+        sample_rate = app.config.get('METRICS_SAMPLE_RATE', 0.1)
+        if sample_rate and random.random() < sample_rate:
+            g.metrics_sample = {
+                'db': 0.0, 'db_count': 0, 'auth': 0.0, 'serialize': 0.0
+            }
+
+    @app.after_request
+    def record_request(response):
+        start = g.get('metrics_start')
+        if start is None:
+            return response
+
+        total = time.perf_counter() - start
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        sample = g.get('metrics_sample')
+        if sample is not None:
+            sample['auth'] = g.get('auth_duration', 0.0)
+        metrics.record(
+            route, request.method, response.status_code, total, sample
+        )
+        if sample is not None:
+            response.headers['Server-Timing'] = server_timing(sample, total)
+        return response
+
+    @app.route('/metrics', methods=['GET'])
+    def get_metrics():
+        return Response(
+            metrics.render(), mimetype='text/plain; version=0.0.4'
+        )
@@ -2,46 +2,279 @@
 # Imports
 # ---------------------------------------------------------
 
+import datetime
 import os
+import re
+import time
 from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
-from flask_moment import Moment
+from sqlalchemy.orm import make_transient_to_detached
 
 # ---------------------------------------------------------
 # App Config.
 # ---------------------------------------------------------
 
+MIGRATIONS_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'migrations'
+)
+
 database_path = os.environ.get('DATABASE_URL')
 if not database_path:
     database_name = "agency"
     database_path = "postgres://{}/{}".format('localhost:5432', database_name)
 
 db = SQLAlchemy()
-moment = Moment()
+# Flask-Migrate and Flask-Moment pull in alembic and pkg_resources, so
+# they are imported by setup_db() only when needed.
+migrate = None
+moment = None
+
+# Callbacks run after a write to a table is committed, used to keep
+# caches and version counters in step with the database.
+# Signature: listener(table (string), action (string), ids (list))
+write_listeners = []
+
+
+# Inserts a model instance for Model.insert() when group commit is on;
+# set by agency.groupcommit. The committed instance is then attached to
+# the session like after a regular insert.
+# Signature: group_commit(instance) -> id
+group_commit = None
+
+
+# Tells every write listener that rows of a table changed.
+def notify_write(table, action, ids=()):
+    for listener in write_listeners:
+        listener(table, action, list(ids))
+
+
+# Builds the SQLAlchemy engine options from the pool settings in config.
+# Pool sizing and the statement timeout only apply to Postgres.
+# Returns: options (dictionary)
+def engine_options(config, database_path):
+    options = {'pool_pre_ping': config.get('DB_POOL_PRE_PING', True)}
+
+    if database_path.startswith('postgres'):
+        options.update({
+            'pool_size': config.get('DB_POOL_SIZE', 5),
+            'max_overflow': config.get('DB_MAX_OVERFLOW', 10),
+            'pool_timeout': config.get('DB_POOL_TIMEOUT', 30),
+            'pool_recycle': config.get('DB_POOL_RECYCLE', 1800)
+        })
+        statement_timeout = config.get('DB_STATEMENT_TIMEOUT')
+        if statement_timeout:
+            options['connect_args'] = {
+                'options': '-c statement_timeout=%d' % statement_timeout
+            }
+
+    return options
+
+
+# Registers Flask-Migrate, which provides the `flask db` commands.
+def setup_migrate(app):
+    global migrate
+    from flask_migrate import Migrate
+    migrate = Migrate(app, db, directory=MIGRATIONS_DIR)
 
 
 # Set-up database-related Flask modules.
+# With LAZY_STARTUP the schema is left to `flask db upgrade` (or
+# `flask create-db`) and no connection is opened until the first query.
+# Migrations are still registered when the app runs under the flask CLI.
 def setup_db(app, database_path=database_path):
+    global moment
     app.config.from_pyfile('config.py', silent=False)
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(
+        app.config, database_path
+    )
     db.app = app
-    moment.app = app
     db.init_app(app)
+
+    if app.config.get('LAZY_STARTUP'):
+        if os.environ.get('FLASK_RUN_FROM_CLI'):
+            setup_migrate(app)
+        return
+
+    from flask_moment import Moment
+    moment = Moment()
+    moment.app = app
+    setup_migrate(app)
+    create_tables()
+
+
+# Creates the missing tables, and on Postgres the pg_trgm extension
+# that /search needs (migration 0004 creates it otherwise).
+def create_tables():
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        db.session.commit()
     db.create_all()
 
+
+# Reports connection pool usage and the latency of a trivial query.
+# Returns: health report (dictionary); raises if the database is down.
+def db_health():
+    start = time.perf_counter()
+    db.session.execute('SELECT 1')
+    latency = time.perf_counter() - start
+
+    pool = db.engine.pool
+    stats = {'class': type(pool).__name__}
+    for name in ('size', 'checkedin', 'checkedout', 'overflow'):
+        if hasattr(pool, name):
+            stats[name] = getattr(pool, name)()
+
+    return {
+        'latency_ms': round(latency * 1000, 3),
+        'pool': stats
+    }
+
+# ---------------------------------------------------------
+# Field parsing.
+# ---------------------------------------------------------
+
+RELEASE_FORMATS = ('%Y-%m-%d', '%B %d, %Y', '%b %d, %Y', '%B %d %Y')
+
+
+# Parses an age given as a number or a string of digits.
+# Returns: age (int); raises ValueError when invalid.
+def parse_age(value):
+    if isinstance(value, bool):
+        raise ValueError('Invalid age.')
+    if isinstance(value, str) and value.strip().isdigit():
+        value = int(value)
+    if not isinstance(value, int) or not 0 <= value <= 150:
+        raise ValueError('Invalid age.')
+    return value
+
+
+# Parses a release date given as YYYY-MM-DD or as e.g. "May 23rd, 1980".
+# Returns: release (date); raises ValueError when invalid.
+def parse_release(value):
+    if isinstance(value, datetime.date):
+        return value
+    if not isinstance(value, str):
+        raise ValueError('Invalid release date.')
+
+    value = re.sub(r'(\d)(st|nd|rd|th)\b', r'\1', value.strip())
+    for release_format in RELEASE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, release_format).date()
+        except ValueError:
+            continue
+
+    raise ValueError('Invalid release date.')
+
+
+# Converts the typed fields of a record with the model's field parsers.
+# Accepts: model (db.Model), data (dictionary)
+# Returns: cleaned copy (dictionary); raises ValueError when invalid.
+def parse_fields(model, data):
+    cleaned = dict(data)
+    for field, parser in model.field_parsers.items():
+        if field in cleaned:
+            cleaned[field] = parser(cleaned[field])
+    return cleaned
+
 # ---------------------------------------------------------
 # Models.
 # ---------------------------------------------------------
 
 
+# Association table for casting assignments between movies and actors.
+movie_cast = db.Table(
+    'movie_cast',
+    db.Column(
+        'movie_id', db.Integer,
+        db.ForeignKey('movies.id', ondelete='CASCADE'), primary_key=True
+    ),
+    db.Column(
+        'actor_id', db.Integer,
+        db.ForeignKey('actors.id', ondelete='CASCADE'), primary_key=True
+    ),
+    db.Index('ix_movie_cast_actor_id', 'actor_id')
+)
+
+# Deleted rows, kept so that ?changed_since= can report deletions.
+tombstones = db.Table(
+    'tombstones',
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('table_name', db.String, nullable=False),
+    db.Column('row_id', db.Integer, nullable=False),
+    db.Column(
+        'deleted_at', db.DateTime, nullable=False,
+        default=datetime.datetime.utcnow
+    ),
+    db.Index('ix_tombstones_table_deleted_at', 'table_name', 'deleted_at', 'id')
+)
+
+
+# Catalog statistics for /stats: one counter per metric and bucket, such
+# as ('actors.by_gender', 'female'), kept up to date by agency.stats in
+# the transaction of every write.
+catalog_stats = db.Table(
+    'catalog_stats',
+    db.Column('metric', db.String, primary_key=True),
+    db.Column('bucket', db.String, primary_key=True),
+    db.Column('count', db.Integer, nullable=False, default=0)
+)
+
+
+# Records deleted rows as tombstones in the current transaction.
+# Accepts: table name (string), ids (list)
+def record_deletes(table_name, ids):
+    if ids:
+        db.session.execute(tombstones.insert(), [
+            {'table_name': table_name, 'row_id': row_id} for row_id in ids
+        ])
+
+
+# Creation and last modification times (UTC), set on every insert and
+# update, including bulk statements.
+class Timestamps:
+    created_at = db.Column(
+        db.DateTime, nullable=False, default=datetime.datetime.utcnow
+    )
+    updated_at = db.Column(
+        db.DateTime, nullable=False, default=datetime.datetime.utcnow,
+        onupdate=datetime.datetime.utcnow
+    )
+
+
 # Creating the debatase for Actors
-class Actor(db.Model):
+class Actor(Timestamps, db.Model):
     __tablename__ = 'actors'
+    __table_args__ = (
+        db.Index(
+            'ix_actors_name', 'name',
+            postgresql_ops={'name': 'text_pattern_ops'}
+        ),
+        db.Index('ix_actors_gender_age', 'gender', 'age'),
+        db.Index('ix_actors_age', 'age'),
+        db.Index('ix_actors_updated_at', 'updated_at', 'id'),
+    )
+    required_fields = ('name', 'age', 'gender')
+    field_parsers = {'age': parse_age}
+    # Query arguments accepted by the list endpoint, mapped to the
+    # indexed column and comparison they filter on.
+    filter_fields = {
+        'name': ('name', 'prefix'),
+        'gender': ('gender', 'eq'),
+        'min_age': ('age', 'ge'),
+        'max_age': ('age', 'le'),
+    }
+    sort_fields = ('id', 'name', 'age', 'gender')
+    search_field = 'name'
+    # Columns of format(), loaded without ORM objects for list responses.
+    list_fields = ('id', 'name', 'age', 'gender')
+    # Relationship that ?embed= can include in responses.
+    embed_field = 'movies'
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String)
-    age = db.Column(db.String)
+    age = db.Column(db.Integer)
     gender = db.Column(db.String)
 
     def __repr__(self):
@@ -49,58 +282,124 @@ class Actor(db.Model):
 
     def __init__(self, name, age, gender):
         self.name = name
-        self.age = age
+        self.age = parse_age(age)
         self.gender = gender
 
     def insert(self):
+        if group_commit is not None:
+            self.id = group_commit(self)
+            make_transient_to_detached(self)
+            db.session.add(self)
+            return
         db.session.add(self)
         db.session.commit()
+        notify_write(self.__tablename__, 'insert', [self.id])
 
     def update(self):
         db.session.commit()
+        notify_write(self.__tablename__, 'update', [self.id])
 
     def delete(self):
+        item_id = self.id
         db.session.delete(self)
+        record_deletes(self.__tablename__, [item_id])
         db.session.commit()
+        notify_write(self.__tablename__, 'delete', [item_id])
 
-    def format(self):
-        return{
+    # Accepts: embed (boolean) to include the actor's movies.
+    def format(self, embed=False):
+        actor = {
             'id': self.id,
             'name': self.name,
             'age': self.age,
             'gender': self.gender
         }
+        if embed:
+            actor['movies'] = [movie.format() for movie in self.movies]
+        return actor
 
 
 # Creating the database for Movies
-class Movie(db.Model):
+class Movie(Timestamps, db.Model):
     __tablename__ = 'movies'
+    __table_args__ = (
+        db.Index(
+            'ix_movies_title', 'title',
+            postgresql_ops={'title': 'text_pattern_ops'}
+        ),
+        db.Index('ix_movies_release', 'release'),
+        db.Index('ix_movies_updated_at', 'updated_at', 'id'),
+    )
+    required_fields = ('title', 'release')
+    field_parsers = {'release': parse_release}
+    filter_fields = {
+        'title': ('title', 'prefix'),
+        'release_from': ('release', 'ge'),
+        'release_to': ('release', 'le'),
+    }
+    sort_fields = ('id', 'title', 'release')
+    search_field = 'title'
+    list_fields = ('id', 'title', 'release')
+    embed_field = 'cast'
 
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String)
-    release = db.Column(db.String)
+    release = db.Column(db.Date)
+    cast = db.relationship(
+        'Actor',
+        secondary=movie_cast,
+        order_by='Actor.id',
+        backref=db.backref('movies', order_by='Movie.id')
+    )
 
     def __repr__(self):
         return f"<Movie id='{self.id}' title='{self.title}'>"
 
     def __init__(self, title, release):
         self.title = title
-        self.release = release
+        self.release = parse_release(release)
 
     def insert(self):
+        if group_commit is not None:
+            self.id = group_commit(self)
+            make_transient_to_detached(self)
+            db.session.add(self)
+            return
         db.session.add(self)
         db.session.commit()
+        notify_write(self.__tablename__, 'insert', [self.id])
 
     def update(self):
         db.session.commit()
+        notify_write(self.__tablename__, 'update', [self.id])
 
     def delete(self):
+        item_id = self.id
         db.session.delete(self)
+        record_deletes(self.__tablename__, [item_id])
+        db.session.commit()
+        notify_write(self.__tablename__, 'delete', [item_id])
+
+    # Assigns actors to the movie's cast, skipping those already in it.
+    def add_cast(self, actors):
+        for actor in actors:
+            if actor not in self.cast:
+                self.cast.append(actor)
+        db.session.commit()
+        notify_write('movie_cast', 'insert', [self.id])
+
+    def remove_cast(self, actor):
+        self.cast.remove(actor)
         db.session.commit()
+        notify_write('movie_cast', 'delete', [self.id])
 
-    def format(self):
-        return {
+    # Accepts: embed (boolean) to include the movie's cast.
+    def format(self, embed=False):
+        movie = {
             'id': self.id,
             'title': self.title,
-            'release': self.release,
+            'release': self.release.isoformat() if self.release else None,
         }
+        if embed:
+            movie['cast'] = [actor.format() for actor in self.cast]
+        return movie
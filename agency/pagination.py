@@ -0,0 +1,113 @@
+# ---------------------------------------------------------
+# Imports
+# ---------------------------------------------------------
+
+import base64
+import json
+from flask import request, abort, current_app
+
+# ---------------------------------------------------------
+# Cursors
+# ---------------------------------------------------------
+
+
+# Encodes the position after a page into an opaque cursor.
+# Accepts: position (dictionary), either {'id': last_id} or {'offset': n}
+# Returns: cursor (string)
+def encode_cursor(position):
+    raw = json.dumps(position).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+# Decodes a cursor produced by encode_cursor().
+# Accepts: cursor (string), kind ('id' or 'offset')
+# Returns: last id or offset (int); 0 for an empty cursor.
+def decode_cursor(cursor, kind):
+    if not cursor:
+        return 0
+
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        value = json.loads(base64.urlsafe_b64decode(padded))[kind]
+    except Exception:
+        abort(422)
+
+    if not isinstance(value, int) or value < 0:
+        abort(422)
+
+    return value
+
+# ---------------------------------------------------------
+# Pagination
+# ---------------------------------------------------------
+
+
+# Reads and validates the page size from the request.
+# Returns: limit (int)
+def get_limit():
+    return parse_limit(request.args.get('limit'), current_app.config)
+
+
+# Validates a page size against PAGE_SIZE and MAX_PAGE_SIZE.
+# Accepts: limit (string or None), config (mapping)
+# Returns: limit (int)
+def parse_limit(limit, config):
+    maximum = config.get('MAX_PAGE_SIZE', 500)
+    if limit is None:
+        limit = config.get('PAGE_SIZE', 50)
+
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        abort(422)
+
+    if limit < 1 or limit > maximum:
+        abort(422)
+
+    return limit
+
+
+# Pages through a query ordered by id, or by the given ordering.
+# With ?cursor= in id order the page starts after the id stored in the
+# cursor (keyset pagination), which costs the same at any depth. With a
+# custom ordering the cursor stores an offset instead. Without a cursor
+# ?offset= is used. ?total=1 adds the number of matching rows.
+# Accepts: query (Query), model (db.Model), ordering (list or None)
+# Returns: rows (list) and page metadata (dictionary)
+def paginate(query, model, ordering=None):
+    limit = get_limit()
+    cursor = request.args.get('cursor')
+
+    try:
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        abort(422)
+
+    if offset < 0 or (cursor is not None and offset):
+        abort(422)
+
+    page_query = query.order_by(*(ordering or [model.id]))
+    if cursor is not None and not ordering:
+        page_query = page_query.filter(model.id > decode_cursor(cursor, 'id'))
+    else:
+        if cursor is not None:
+            offset = decode_cursor(cursor, 'offset')
+        if offset:
+            page_query = page_query.offset(offset)
+
+    # Fetch one extra row to know whether another page follows.
+    rows = page_query.limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    next_cursor = None
+    if has_more and ordering:
+        next_cursor = encode_cursor({'offset': offset + limit})
+    elif has_more:
+        next_cursor = encode_cursor({'id': rows[-1].id})
+
+    page = {'next_cursor': next_cursor}
+    if request.args.get('total', '').lower() in ('1', 'true'):
+        page['total'] = query.order_by(None).count()
+
+    return rows, page
@@ -0,0 +1,181 @@
+# ---------------------------------------------------------
+# Imports
+# ---------------------------------------------------------
+
+import logging
+import re
+import threading
+import time
+from collections import Counter
+from flask import abort, g, has_request_context, jsonify, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from .auth.auth import requires_auth
+
+logger = logging.getLogger('agency.queries')
+
+# ---------------------------------------------------------
+# Fingerprints
+# ---------------------------------------------------------
+
+FINGERPRINT_RULES = [
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'%\(\w+\)s|:\w+|\$\d+|%s'), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)'), '(...)'),
+    (re.compile(r'\s+'), ' '),
+]
+
+
+# Normalizes a SQL statement so that statements differing only in
+# literal values, bind parameters or IN-list length share a fingerprint.
+# Accepts: statement (string)
+# Returns: fingerprint (string)
+def fingerprint(statement):
+    statement = statement.strip().lower()
+    for pattern, replacement in FINGERPRINT_RULES:
+        statement = pattern.sub(replacement, statement)
+    return statement
+
+# ---------------------------------------------------------
+# Report
+# ---------------------------------------------------------
+
+
+# Per-process statistics of slow statements and N+1 patterns,
+# aggregated by fingerprint.
+class QueryReport:
+    def __init__(self):
+        self.entries = {}
+        self._lock = threading.Lock()
+
+    def _entry(self, shape):
+        return self.entries.setdefault(shape, {
+            'fingerprint': shape,
+            'slow_count': 0,
+            'slow_total_ms': 0.0,
+            'slow_max_ms': 0.0,
+            'n_plus_one_count': 0,
+            'n_plus_one_max_repeats': 0,
+            'routes': set()
+        })
+
+    def add_slow(self, shape, route, duration_ms):
+        with self._lock:
+            entry = self._entry(shape)
+            entry['slow_count'] += 1
+            entry['slow_total_ms'] += duration_ms
+            entry['slow_max_ms'] = max(entry['slow_max_ms'], duration_ms)
+            entry['routes'].add(route)
+
+    def add_n_plus_one(self, shape, route, repeats):
+        with self._lock:
+            entry = self._entry(shape)
+            entry['n_plus_one_count'] += 1
+            entry['n_plus_one_max_repeats'] = max(
+                entry['n_plus_one_max_repeats'], repeats
+            )
+            entry['routes'].add(route)
+
+    # Returns: entries sorted by slow time, then N+1 occurrences (list).
+    def summary(self):
+        with self._lock:
+            entries = [
+                dict(entry, routes=sorted(entry['routes']),
+                     slow_total_ms=round(entry['slow_total_ms'], 3),
+                     slow_max_ms=round(entry['slow_max_ms'], 3))
+                for entry in self.entries.values()
+            ]
+        entries.sort(key=lambda e: (-e['slow_total_ms'],
+                                    -e['n_plus_one_count']))
+        return entries
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+
+query_report = QueryReport()
+
+# ---------------------------------------------------------
+# Hooks
+# ---------------------------------------------------------
+
+
+# Returns: the statement counter of the current request when the
+# detector is on, otherwise None.
+def current_shapes():
+    if has_request_context():
+        return g.get('query_shapes')
+    return None
+
+
+def current_route():
+    return request.url_rule.rule if request.url_rule else request.path
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query(conn, cursor, statement, parameters, context, executemany):
+    if current_shapes() is not None:
+        conn.info.setdefault('querylog_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def end_query(conn, cursor, statement, parameters, context, executemany):
+    shapes = current_shapes()
+    starts = conn.info.get('querylog_start')
+    if shapes is None or not starts:
+        return
+
+    duration_ms = (time.perf_counter() - starts.pop()) * 1000
+    shape = fingerprint(statement)
+    shapes[shape] += 1
+
+    if duration_ms >= g.slow_query_ms:
+        route = current_route()
+        query_report.add_slow(shape, route, duration_ms)
+        logger.warning(
+            'Slow query (%.1f ms) on %s %s: %s',
+            duration_ms, request.method, route, shape
+        )
+
+
+# Turns the detector on when QUERY_LOG is set. Statements slower than
+# SLOW_QUERY_MS are logged with their route, and requests running the
+# same statement shape more than N_PLUS_ONE_THRESHOLD times are flagged.
+# GET /debug/queries returns the aggregated report to tokens with the
+# get:queries permission, since it shows the statements and routes.
+def setup_query_log(app):
+    @app.before_request
+    def start_query_log():
+        if app.config.get('QUERY_LOG'):
+            g.query_shapes = Counter()
+            g.slow_query_ms = app.config.get('SLOW_QUERY_MS', 100)
+
+    @app.after_request
+    def check_query_log(response):
+        shapes = g.get('query_shapes')
+        if not shapes:
+            return response
+
+        threshold = app.config.get('N_PLUS_ONE_THRESHOLD', 10)
+        for shape, repeats in shapes.items():
+            if repeats > threshold:
+                route = current_route()
+                query_report.add_n_plus_one(shape, route, repeats)
+                logger.warning(
+                    'Possible N+1: %d runs on %s %s of: %s',
+                    repeats, request.method, route, shape
+                )
+        return response
+
+    @app.route('/debug/queries', methods=['GET'])
+    @requires_auth('get:queries')
+    def get_query_report():
+        if not app.config.get('QUERY_LOG'):
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'queries': query_report.summary()
+        }), 200
@@ -0,0 +1,204 @@
+# ---------------------------------------------------------
+# Imports
+# ---------------------------------------------------------
+
+import bisect
+import re
+import threading
+from collections import defaultdict
+from sqlalchemy import desc, func, or_
+from .models import db
+from .versions import table_versions
+
+# ---------------------------------------------------------
+# Text helpers
+# ---------------------------------------------------------
+
+WORD = re.compile(r'\w+', re.UNICODE)
+
+# Minimum trigram similarity for a fuzzy match, as pg_trgm's default.
+SIMILARITY_THRESHOLD = 0.3
+
+
+# Returns: lowercase words of a text (list of strings).
+def tokenize(text):
+    return WORD.findall((text or '').lower())
+
+
+# Returns: trigrams of a word padded like pg_trgm does (set of strings).
+def trigrams(word):
+    padded = '  %s ' % word
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+# Returns: trigram similarity of two texts, from 0 to 1 (float).
+def similarity(a, b):
+    a_grams = set().union(*[trigrams(w) for w in tokenize(a)] or [set()])
+    b_grams = set().union(*[trigrams(w) for w in tokenize(b)] or [set()])
+    if not a_grams or not b_grams:
+        return 0.0
+    return len(a_grams & b_grams) / len(a_grams | b_grams)
+
+# ---------------------------------------------------------
+# In-memory fallback
+# ---------------------------------------------------------
+
+
+# Inverted index over one text column, used when the database is not
+# Postgres. Every query word must match an indexed word, either as a
+# prefix or, failing that, by trigram similarity.
+# Accepts: rows (list of (id, text))
+class InvertedIndex:
+    def __init__(self, rows):
+        self.texts = {}
+        self.postings = defaultdict(set)
+        self.word_trigrams = defaultdict(set)
+
+        for row_id, text in rows:
+            self.texts[row_id] = text
+            for word in tokenize(text):
+                self.postings[word].add(row_id)
+
+        for word in self.postings:
+            for gram in trigrams(word):
+                self.word_trigrams[gram].add(word)
+        self.words = sorted(self.postings)
+
+    # Returns: indexed words starting with the prefix (list).
+    def prefixed(self, prefix):
+        start = bisect.bisect_left(self.words, prefix)
+        matches = []
+        for word in self.words[start:]:
+            if not word.startswith(prefix):
+                break
+            matches.append(word)
+        return matches
+
+    # Returns: {id: score} for the rows matching one query word.
+    def match_word(self, term):
+        scores = {}
+        for word in self.prefixed(term):
+            for row_id in self.postings[word]:
+                scores[row_id] = 1.0
+
+        if scores:
+            return scores
+
+        candidates = set()
+        for gram in trigrams(term):
+            candidates |= self.word_trigrams.get(gram, set())
+        for word in candidates:
+            score = similarity(term, word)
+            if score < SIMILARITY_THRESHOLD:
+                continue
+            for row_id in self.postings[word]:
+                scores[row_id] = max(scores.get(row_id, 0), score)
+
+        return scores
+
+    # Returns: (id, rank) pairs, best first (list).
+    def search(self, query):
+        terms = tokenize(query)
+        if not terms:
+            return []
+
+        scores = None
+        for term in terms:
+            matches = self.match_word(term)
+            if scores is None:
+                scores = matches
+            else:
+                scores = {
+                    row_id: score + matches[row_id]
+                    for row_id, score in scores.items() if row_id in matches
+                }
+
+        results = [
+            (row_id, score / len(terms) + similarity(self.texts[row_id], query))
+            for row_id, score in scores.items()
+        ]
+        results.sort(key=lambda result: (-result[1], result[0]))
+        return results
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+# Returns the inverted index for a model's search column, rebuilding it
+# when the table version has moved since it was built.
+def get_index(model):
+    table = model.__tablename__
+    epoch, versions = table_versions.get([table])
+    version = (epoch, versions[table][0])
+
+    with _indexes_lock:
+        cached = _indexes.get(table)
+        if cached and cached[0] == version:
+            return cached[1]
+
+        column = getattr(model, model.search_field)
+        index = InvertedIndex(db.session.query(model.id, column).all())
+        _indexes[table] = (version, index)
+        return index
+
+# ---------------------------------------------------------
+# Search
+# ---------------------------------------------------------
+
+
+# Builds a prefix tsquery such as "anne:* & hath:*" from the query words.
+def prefix_tsquery(query):
+    return ' & '.join(word + ':*' for word in tokenize(query))
+
+
+# Ranks rows with full-text search and pg_trgm similarity. Uses the GIN
+# indexes on to_tsvector('simple', column) and column gin_trgm_ops.
+# Returns: (row, rank) pairs (list).
+def search_postgres(model, query, limit, offset):
+    column = getattr(model, model.search_field)
+    document = func.to_tsvector('simple', column)
+    tsquery = func.to_tsquery('simple', prefix_tsquery(query))
+    rank = func.ts_rank(document, tsquery) + func.similarity(column, query)
+    # pg_trgm's similarity operator; psycopg2 needs the % doubled.
+    similar = '%%' if db.engine.dialect.paramstyle in ('format', 'pyformat') \
+        else '%'
+
+    return (
+        model.query
+        .add_columns(rank.label('rank'))
+        .filter(or_(document.op('@@')(tsquery), column.op(similar)(query)))
+        .order_by(desc('rank'), model.id)
+        .limit(limit)
+        .offset(offset)
+        .all()
+    )
+
+
+# Ranks rows with the in-memory inverted index.
+# Returns: (row, rank) pairs (list).
+def search_memory(model, query, limit, offset):
+    ranked = get_index(model).search(query)[offset:offset + limit]
+    if not ranked:
+        return []
+
+    rows = model.query.filter(model.id.in_([i for i, _ in ranked])).all()
+    rows = {row.id: row for row in rows}
+    return [(rows[i], rank) for i, rank in ranked if i in rows]
+
+
+# Searches a model's search_field for the query.
+# Returns: formatted rows with their rank, best first (list).
+def search(model, query, limit, offset):
+    if not tokenize(query):
+        return []
+
+    if db.engine.dialect.name == 'postgresql':
+        results = search_postgres(model, query, limit, offset)
+    else:
+        results = search_memory(model, query, limit, offset)
+
+    return [
+        dict(row.format(), rank=round(float(rank), 4))
+        for row, rank in results
+    ]
@@ -0,0 +1,78 @@
+# ---------------------------------------------------------
+# Imports
+# ---------------------------------------------------------
+
+import datetime
+import json
+import time
+from flask import current_app
+from .metrics import add_timing
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# ---------------------------------------------------------
+# Fast JSON serialization
+# ---------------------------------------------------------
+
+
+def encode_default(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    raise TypeError('%r is not JSON serializable' % (value,))
+
+
+# Checks whether orjson should be used. JSON_BACKEND is 'auto' (orjson
+# when installed), 'orjson' or 'stdlib'; it's read from the app config
+# unless given.
+# Returns: boolean
+def use_orjson(backend=None):
+    if backend is None:
+        backend = current_app.config.get('JSON_BACKEND', 'auto')
+    if backend == 'orjson' and orjson is None:
+        raise RuntimeError('JSON_BACKEND is orjson but it is not installed')
+    return orjson is not None and backend in ('auto', 'orjson')
+
+
+# Serializes data compactly, with dates as ISO strings.
+# Accepts: data (JSON-serializable, dates allowed), backend (string)
+# Returns: bytes
+def dumps(data, backend=None):
+    if use_orjson(backend):
+        return orjson.dumps(data)
+    return json.dumps(
+        data, default=encode_default, separators=(',', ':')
+    ).encode()
+
+
+# Builds a JSON response like jsonify() does, timing the serialization
+# for the metrics sample.
+# Accepts: data (dictionary)
+# Returns: Response
+def json_response(data):
+    start = time.perf_counter()
+    body = dumps(data) + b'\n'
+    add_timing('serialize', time.perf_counter() - start)
+    return current_app.response_class(
+        body, mimetype=current_app.config['JSONIFY_MIMETYPE']
+    )
+
+
+# Narrows a query to the model's list_fields, so rows come back as plain
+# tuples instead of hydrated ORM objects.
+# Accepts: query (Query), model (db.Model)
+# Returns: query (Query)
+def select_fields(query, model):
+    return query.with_entities(
+        *[getattr(model, field) for field in model.list_fields]
+    )
+
+
+# Turns column rows from select_fields() into dictionaries.
+# Accepts: rows (list of tuples), model (db.Model)
+# Returns: list of dictionaries
+def format_rows(rows, model):
+    fields = model.list_fields
+    return [dict(zip(fields, row)) for row in rows]
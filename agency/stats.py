@@ -0,0 +1,249 @@
+# ---------------------------------------------------------
+# Imports
+# ---------------------------------------------------------
+
+from collections import Counter
+from sqlalchemy import event, false, func, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+from .models import Actor, Movie, catalog_stats, db
+
+# ---------------------------------------------------------
+# Buckets
+# ---------------------------------------------------------
+
+
+def age_bucket(age):
+    if age is None:
+        return 'unknown'
+    start = age // 10 * 10
+    return '%d-%d' % (start, start + 9)
+
+
+def release_year(release):
+    return 'unknown' if release is None else str(release.year)
+
+
+# Metrics per model: (metric, field read, bucket function). The total
+# has a single bucket.
+METRICS = {
+    Actor: [
+        ('actors.total', None, lambda value: ''),
+        ('actors.by_gender', 'gender', lambda value: value or 'unknown'),
+        ('actors.by_age', 'age', age_bucket),
+    ],
+    Movie: [
+        ('movies.total', None, lambda value: ''),
+        ('movies.by_release_year', 'release', release_year),
+    ],
+}
+
+
+# Returns: the fields the metrics of a model read (tuple)
+def stat_fields(model):
+    return tuple(field for _, field, _ in METRICS[model] if field)
+
+
+# Returns: the (metric, bucket) pairs a row counts towards (list)
+def row_buckets(model, row):
+    return [
+        (metric, bucket(row[field] if field else None))
+        for metric, field, bucket in METRICS[model]
+    ]
+
+
+# Computes the counter changes for rows replaced by others: each old row
+# is taken out of its buckets and each new row is added to its own.
+# Accepts: model (db.Model), old and new rows (lists of dictionaries)
+# Returns: deltas (Counter of (metric, bucket) to int)
+def stat_deltas(model, old_rows=(), new_rows=()):
+    deltas = Counter()
+    for row in old_rows:
+        for key in row_buckets(model, row):
+            deltas[key] -= 1
+    for row in new_rows:
+        for key in row_buckets(model, row):
+            deltas[key] += 1
+    return deltas
+
+# ---------------------------------------------------------
+# Incremental maintenance
+# ---------------------------------------------------------
+
+
+# Builds the statements adding deltas to the counters: a row is created
+# for any new bucket, then incremented. Counters are visited in a fixed
+# order so that concurrent transactions lock them in the same order.
+# Accepts: deltas (Counter), dialect (string)
+# Returns: statements (list)
+def delta_statements(deltas, dialect):
+    statements = []
+    for (metric, bucket), delta in sorted(deltas.items()):
+        if not delta:
+            continue
+        values = {'metric': metric, 'bucket': bucket, 'count': 0}
+        if dialect == 'postgresql':
+            statements.append(
+                pg_insert(catalog_stats).values(**values)
+                .on_conflict_do_nothing()
+            )
+        else:
+            statements.append(
+                catalog_stats.insert().prefix_with('OR IGNORE').values(**values)
+            )
+        statements.append(
+            catalog_stats.update()
+            .where(catalog_stats.c.metric == metric)
+            .where(catalog_stats.c.bucket == bucket)
+            .values(count=catalog_stats.c.count + delta)
+        )
+    return statements
+
+
+# Applies deltas in the session's current transaction.
+def apply_deltas(deltas, session=db.session):
+    dialect = session.get_bind().dialect.name
+    for statement in delta_statements(deltas, dialect):
+        session.execute(statement)
+
+
+# Returns: query for the stat fields of rows by id, locking the rows
+# until the transaction ends (Select)
+def stat_rows_query(model, ids):
+    columns = [getattr(model, field) for field in stat_fields(model)]
+    return (
+        select([model.id] + columns).where(model.id.in_(ids))
+        .with_for_update()
+    )
+
+
+# Reads the current stat fields of rows, before a bulk update or delete.
+# Returns: rows by id (dictionary of dictionaries)
+def stat_rows(model, ids):
+    rows = db.session.execute(stat_rows_query(model, ids))
+    return {row['id']: dict(row) for row in rows}
+
+
+# Returns: the current value of a field, or the one it had before the
+# changes being flushed.
+def previous_value(instance, field):
+    history = get_history(instance, field)
+    if history.deleted:
+        return history.deleted[0]
+    return getattr(instance, field)
+
+
+# Keeps the counters in step with ORM writes (insert(), update() and
+# delete() of the models), inside the flushed transaction.
+@event.listens_for(Session, 'after_flush')
+def track_flush(session, flush_context):
+    deltas = Counter()
+    for instance in session.new:
+        model = type(instance)
+        if model in METRICS:
+            row = {f: getattr(instance, f) for f in stat_fields(model)}
+            deltas.update(stat_deltas(model, new_rows=[row]))
+
+    for instance in session.dirty:
+        model = type(instance)
+        if model in METRICS:
+            fields = stat_fields(model)
+            old = {f: previous_value(instance, f) for f in fields}
+            new = {f: getattr(instance, f) for f in fields}
+            if old != new:
+                deltas.update(stat_deltas(model, [old], [new]))
+
+    for instance in session.deleted:
+        model = type(instance)
+        if model in METRICS:
+            row = {f: previous_value(instance, f) for f in stat_fields(model)}
+            deltas.update(stat_deltas(model, old_rows=[row]))
+
+    if deltas:
+        apply_deltas(deltas, session)
+
+# ---------------------------------------------------------
+# Reads and consistency check
+# ---------------------------------------------------------
+
+
+# Returns: the stored counters (Counter of (metric, bucket) to int)
+def read_counters():
+    counters = Counter()
+    for metric, bucket, count in db.session.query(catalog_stats):
+        if count:
+            counters[(metric, bucket)] = count
+    return counters
+
+
+# Computes the counters from scratch, grouping each table by the fields
+# its metrics read.
+# Returns: counters (Counter of (metric, bucket) to int)
+def compute_counters():
+    counters = Counter()
+    for model in METRICS:
+        fields = stat_fields(model)
+        columns = [getattr(model, field) for field in fields]
+        rows = db.session.query(*columns, func.count()).group_by(*columns)
+        for *values, count in rows:
+            for key in row_buckets(model, dict(zip(fields, values))):
+                counters[key] += count
+    return counters
+
+
+# Formats the counters as the /stats response body.
+# Returns: statistics (dictionary)
+def format_stats(counters):
+    stats = {
+        'actors': {'total': 0, 'by_gender': {}, 'by_age': {}},
+        'movies': {'total': 0, 'by_release_year': {}},
+    }
+    for (metric, bucket), count in sorted(counters.items()):
+        table, name = metric.split('.')
+        if name == 'total':
+            stats[table]['total'] = count
+        else:
+            stats[table][name][bucket] = count
+    return stats
+
+
+# Blocks writes to the counters, and so every write to the counted
+# tables, until the current transaction ends. Reads go on.
+def lock_counters(session=db.session):
+    dialect = session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        session.execute('LOCK TABLE catalog_stats IN EXCLUSIVE MODE')
+    else:
+        # Any write statement takes SQLite's database write lock.
+        session.execute(catalog_stats.delete().where(false()))
+
+
+# Rebuilds the counters from scratch and compares them with the stored
+# ones. With fix=True the stored counters are replaced; writes wait
+# meanwhile, so one committed during the rebuild can't be lost or
+# counted twice.
+# Returns: differences (dictionary of (metric, bucket) to
+# (stored, expected))
+def check_counters(fix=False):
+    if fix:
+        lock_counters()
+
+    stored = read_counters()
+    expected = compute_counters()
+    differences = {
+        key: (stored[key], expected[key])
+        for key in set(stored) | set(expected)
+        if stored[key] != expected[key]
+    }
+
+    if fix and differences:
+        db.session.execute(catalog_stats.delete())
+        db.session.execute(catalog_stats.insert(), [
+            {'metric': metric, 'bucket': bucket, 'count': count}
+            for (metric, bucket), count in expected.items()
+        ])
+    if fix:
+        db.session.commit()
+
+    return differences
@@ -0,0 +1,119 @@
+# ---------------------------------------------------------
+# Imports
+# ---------------------------------------------------------
+
+import base64
+import datetime
+import json
+from flask import request, abort, current_app
+from sqlalchemy import and_, or_
+from .models import db, tombstones
+from .pagination import encode_cursor, get_limit
+from .serialize import format_rows, select_fields
+
+# ---------------------------------------------------------
+# Sync tokens
+# ---------------------------------------------------------
+
+
+# Decodes a sync token into the positions reached in the rows and in the
+# tombstones, each [updated_at (ISO string), id (int or None)]. An empty
+# token starts from the beginning.
+# Accepts: token (string)
+# Returns: positions (dictionary)
+def decode_sync_token(token):
+    if not token:
+        return {}
+
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        positions = json.loads(base64.urlsafe_b64decode(padded))
+        return {
+            key: (
+                datetime.datetime.fromisoformat(positions[key][0]),
+                positions[key][1]
+            )
+            for key in ('rows', 'deleted')
+        }
+    except Exception:
+        abort(422)
+
+
+# Keyset condition for rows after a (time, id) position. Without an id
+# every row at that exact time was already returned.
+def after(time_column, id_column, position):
+    since, last_id = position
+    if last_id is None:
+        return time_column > since
+    return or_(
+        time_column > since,
+        and_(time_column == since, id_column > last_id)
+    )
+
+
+# Returns: the position reached by a page of (…, time, id) rows.
+def next_position(rows, has_more, horizon):
+    if has_more:
+        return [rows[-1][-2].isoformat(), rows[-1][-1]]
+    return [horizon.isoformat(), None]
+
+# ---------------------------------------------------------
+# Changes
+# ---------------------------------------------------------
+
+
+# Lists the rows of a model changed, and the ids deleted, since the
+# request's ?changed_since= token, in pages of ?limit= each.
+# Only changes older than SYNC_LAG seconds are returned, so that a
+# transaction still committing when the token was issued can't be
+# skipped. A sync therefore costs O(changes), through the updated_at and
+# tombstone indexes.
+# Accepts: model (db.Model), name (string) of the list in the response
+# Returns: response body (dictionary)
+def changes(model, name):
+    limit = get_limit()
+    positions = decode_sync_token(request.args.get('changed_since'))
+    horizon = datetime.datetime.utcnow() - datetime.timedelta(
+        seconds=current_app.config.get('SYNC_LAG', 2)
+    )
+
+    query = (
+        select_fields(model.query, model)
+        .add_columns(model.updated_at, model.id)
+        .filter(model.updated_at <= horizon)
+    )
+    if 'rows' in positions:
+        query = query.filter(
+            after(model.updated_at, model.id, positions['rows'])
+        )
+    rows = query.order_by(model.updated_at, model.id).limit(limit + 1).all()
+
+    deleted = db.session.query(
+        tombstones.c.row_id, tombstones.c.deleted_at, tombstones.c.id
+    ).filter(
+        tombstones.c.table_name == model.__tablename__,
+        tombstones.c.deleted_at <= horizon
+    )
+    if 'deleted' in positions:
+        deleted = deleted.filter(after(
+            tombstones.c.deleted_at, tombstones.c.id, positions['deleted']
+        ))
+    deleted = deleted.order_by(
+        tombstones.c.deleted_at, tombstones.c.id
+    ).limit(limit + 1).all()
+
+    rows_more = len(rows) > limit
+    deleted_more = len(deleted) > limit
+    rows, deleted = rows[:limit], deleted[:limit]
+
+    token = encode_cursor({
+        'rows': next_position(rows, rows_more, horizon),
+        'deleted': next_position(deleted, deleted_more, horizon)
+    })
+    return {
+        'success': True,
+        name: format_rows(rows, model),
+        'deleted': [row.row_id for row in deleted],
+        'sync_token': token,
+        'has_more': rows_more or deleted_more
+    }
@@ -0,0 +1,76 @@
+# Helpers for signing tokens offline, shared by the tests and the
+# benchmarks. Nothing here is used by the app itself.
+
+# ---------------------------------------------------------
+# Imports
+# ---------------------------------------------------------
+
+import base64
+import time
+from jose import jwt
+from .auth import auth
+
+# ---------------------------------------------------------
+# Auth helpers
+# ---------------------------------------------------------
+
+PERMISSIONS = [
+    'post:actors', 'post:movies', 'patch:actor', 'patch:movie',
+    'delete:actor', 'delete:movie', 'get:queries'
+]
+
+
+# Generates a local RSA key pair so tokens can be signed offline.
+# Returns: private key (PEM string) and public JWK (dictionary).
+def generate_rsa_key(kid='test-key'):
+    try:
+        from Crypto.PublicKey import RSA
+        key = RSA.generate(2048)
+        # exportKey() also exists in the pycryptodome <3.4 that
+        # python-jose-cryptodome pins; export_key() does not.
+        private_pem = key.exportKey().decode()
+        n, e = key.n, key.e
+    except ImportError:
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        key = rsa.generate_private_key(65537, 2048, default_backend())
+        private_pem = key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.TraditionalOpenSSL,
+            serialization.NoEncryption()
+        ).decode()
+        numbers = key.public_key().public_numbers()
+        n, e = numbers.n, numbers.e
+
+    def b64(number):
+        raw = number.to_bytes((number.bit_length() + 7) // 8, 'big')
+        return base64.urlsafe_b64encode(raw).rstrip(b'=').decode()
+
+    jwk = {'kty': 'RSA', 'kid': kid, 'use': 'sig', 'n': b64(n), 'e': b64(e)}
+    return private_pem, jwk
+
+
+PRIVATE_KEY, PUBLIC_JWK = generate_rsa_key()
+
+
+# Signs a token the way Auth0 would for the API audience.
+def make_token(permissions=PERMISSIONS, kid='test-key', key=PRIVATE_KEY,
+               expires_in=3600):
+    claims = {
+        'iss': f'https://{auth.AUTH0_DOMAIN}/',
+        'aud': auth.API_AUDIENCE,
+        'sub': 'test|user',
+        'exp': int(time.time()) + expires_in,
+        'permissions': permissions
+    }
+    return jwt.encode(claims, key, algorithm='RS256', headers={'kid': kid})
+
+
+# Points the JWKS cache at the local key instead of Auth0.
+def use_local_jwks():
+    auth.jwks_cache = auth.JWKSCache(
+        auth.JWKS_URL,
+        fetcher=lambda url: {'keys': [PUBLIC_JWK]}
+    )
+    auth.token_cache = auth.TokenCache()
@@ -2,13 +2,110 @@
 # Imports
 # ---------------------------------------------------------
 
+import itertools
 import json
 import os
+import queue
+import tempfile
+import threading
+import time
 import unittest
-from flask import url_for
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from flask import Response, jsonify, url_for
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
 from .app import create_app
-from .models import setup_db, Actor, Movie
+from .auth import auth
+from .backends import MemoryBackend, RedisBackend
+from .cache import ResponseCache, item_cache, response_cache, setup_cache
+from .events import EventBroker, PostgresChannel, event_broker, setup_events
+from .groupcommit import PendingInsert, group_committer, setup_group_commit
+from .querylog import fingerprint, query_report
+from .search import InvertedIndex
+from .stats import check_counters
+from .testing import PUBLIC_JWK, make_token, use_local_jwks
+from .models import (
+    setup_db, db, create_tables, engine_options, write_listeners, Actor,
+    Movie
+)
+from .versions import TableVersions, setup_versions
+
+try:
+    from starlette.testclient import TestClient
+    from .asgi import create_asgi_app
+except ImportError:
+    TestClient = None
+
+# ---------------------------------------------------------
+# Test doubles
+# ---------------------------------------------------------
+
+
+# Minimal stand-in for a redis.Redis client, shared between "workers".
+class FakeRedis:
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def set(self, key, value, ex=None, nx=False):
+        if nx and key in self.data:
+            return None
+        if not isinstance(value, bytes):
+            value = str(value).encode()
+        self.data[key] = value
+        return True
+
+    def incr(self, key):
+        value = int(self.data.get(key, 0)) + 1
+        self.data[key] = str(value).encode()
+        return value
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+
+# Local HTTP server standing in for the Auth0 JWKS endpoint. Set
+# `status` to make it fail and `delay` to make it slow.
+class JWKSStub:
+    def __init__(self, jwks):
+        self.jwks = jwks
+        self.status = 200
+        self.delay = 0
+        self.requests = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.requests += 1
+                time.sleep(stub.delay)
+                body = json.dumps(stub.jwks).encode()
+                self.send_response(stub.status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%s/.well-known/jwks.json' % (
+            self.server.server_port
+        )
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, args=(0.01,)
+        )
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
 
 # ---------------------------------------------------------
 # Tests
@@ -28,12 +125,25 @@ class AgencyTestCase(unittest.TestCase):
 
         # binds the app to the current context
         with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
+            self.db = db
             self.db.drop_all()
             # create all tables
-            self.db.create_all()
-    
+            create_tables()
+
+        # A single process, so the in-process caches and events are safe
+        # here; the Postgres channel has its own test.
+        self.app.config['CACHE_BACKEND'] = 'memory'
+        self.app.config['EVENTS_BACKEND'] = 'memory'
+        setup_versions(self.app)
+        setup_cache(self.app)
+        setup_events(self.app)
+
+        use_local_jwks()
+        self.headers = {
+            'Content-Type': 'application/json',
+            'Authorization': 'Bearer ' + make_token()
+        }
+
     def tearDown(self):
         """Executed after reach test"""
         pass
@@ -52,6 +162,767 @@ class AgencyTestCase(unittest.TestCase):
         actors = Actor.query.all()
         self.assertEqual(len(data['actors']), len(actors))
 
+    def test_should_paginate_actors_with_limit_and_offset(self):
+        for age in range(5):
+            Actor(name="Actor %s" % age, age=str(age), gender="female").insert()
+
+        res = self.client().get('/actors?limit=2&offset=2&total=1')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([a['name'] for a in data['actors']],
+                         ["Actor 2", "Actor 3"])
+        self.assertEqual(data['total'], 5)
+        self.assertTrue(data['next_cursor'])
+
+    def test_should_page_actors_with_cursor(self):
+        for age in range(5):
+            Actor(name="Actor %s" % age, age=str(age), gender="female").insert()
+
+        names = []
+        cursor = ''
+        while cursor is not None:
+            res = self.client().get('/actors?limit=2&cursor=%s' % cursor)
+            data = json.loads(res.data)
+            names += [a['name'] for a in data['actors']]
+            cursor = data['next_cursor']
+
+        self.assertEqual(names, ["Actor %s" % age for age in range(5)])
+
+    def test_should_filter_and_sort_actors(self):
+        Actor(name="Anne Hathaway", age="37", gender="female").insert()
+        Actor(name="Anna Faris", age="43", gender="female").insert()
+        Actor(name="Annie 100%", age="50", gender="male").insert()
+        Actor(name="Meryl Streep", age="70", gender="female").insert()
+
+        res = self.client().get('/actors?name=Ann&gender=female&order_by=-age')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([a['name'] for a in data['actors']],
+                         ["Anna Faris", "Anne Hathaway"])
+
+        res = self.client().get('/actors?min_age=40&max_age=60&order_by=name')
+        data = json.loads(res.data)
+        self.assertEqual([a['name'] for a in data['actors']],
+                         ["Anna Faris", "Annie 100%"])
+
+        # Ages compare as numbers, not as text.
+        res = self.client().get('/actors?min_age=5&order_by=age')
+        data = json.loads(res.data)
+        self.assertEqual([a['age'] for a in data['actors']], [37, 43, 50, 70])
+
+        res = self.client().get('/actors?name=Annie 1%25')
+        self.assertEqual(len(json.loads(res.data)['actors']), 0)
+
+    def test_should_page_sorted_movies_with_cursor(self):
+        for title in ("C", "A", "B"):
+            Movie(title=title, release="2001-01-01").insert()
+
+        res = self.client().get('/movies?order_by=title&limit=2')
+        data = json.loads(res.data)
+        self.assertEqual([m['title'] for m in data['movies']], ["A", "B"])
+
+        res = self.client().get(
+            '/movies?order_by=title&limit=2&cursor=' + data['next_cursor'])
+        data = json.loads(res.data)
+        self.assertEqual([m['title'] for m in data['movies']], ["C"])
+        self.assertIsNone(data['next_cursor'])
+
+    def test_should_reject_filter_on_unlisted_column(self):
+        res = self.client().get('/movies?order_by=secret')
+        self.assertEqual(res.status_code, 422)
+
+        res = self.client().get('/movies?title=')
+        self.assertEqual(res.status_code, 422)
+
+    def test_should_return_empty_page_of_actors(self):
+        res = self.client().get('/actors')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actors'], [])
+        self.assertIsNone(data['next_cursor'])
+
+    def test_should_reject_invalid_page_arguments(self):
+        for query in ('limit=0', 'limit=abc', 'offset=-1', 'cursor=!!'):
+            res = self.client().get('/movies?' + query)
+            self.assertEqual(res.status_code, 422)
+
+    def test_should_stream_movies_as_ndjson(self):
+        for year in range(3):
+            Movie(title="Movie %s" % year, release="200%s-01-01" % year).insert()
+
+        res = self.client().get(
+            '/movies', headers={'Accept': 'application/x-ndjson'})
+        lines = res.get_data(as_text=True).splitlines()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual([json.loads(line)['title'] for line in lines],
+                         ["Movie 0", "Movie 1", "Movie 2"])
+
+        res = self.client().get('/movies?stream=1')
+        self.assertEqual(len(res.get_data(as_text=True).splitlines()), 3)
+
+    def test_should_answer_unchanged_actors_with_304(self):
+        Actor(name="Cached", age="30", gender="male").insert()
+
+        res = self.client().get('/actors')
+        etag = res.headers['ETag']
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client().get('/actors', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+
+        res = self.client().get('/actors?limit=1', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+
+    def test_should_not_tag_or_cache_without_cache_backend(self):
+        self.app.config['CACHE_BACKEND'] = 'none'
+        setup_versions(self.app)
+        setup_cache(self.app)
+        actor = Actor(name="Uncached", age="30", gender="male")
+        actor.insert()
+        actor_id = actor.id
+
+        res = self.client().get('/actors', headers={'If-None-Match': '"x"'})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('ETag', res.headers)
+
+        hits = item_cache.hits
+        self.client().get('/actors/%s' % actor_id)
+        self.client().get('/actors/%s' % actor_id)
+        self.assertEqual(item_cache.hits, hits)
+
+    def test_should_not_answer_304_for_write_in_same_second(self):
+        Movie(title="First", release="2020-01-01").insert()
+        res = self.client().get('/movies')
+        since = res.headers['Last-Modified']
+
+        Movie(title="Second", release="2020-01-01").insert()
+        res = self.client().get('/movies', headers={'If-Modified-Since': since})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(json.loads(res.data)['movies']), 2)
+
+    def test_should_change_etag_after_write(self):
+        res = self.client().get('/movies')
+        etag = res.headers['ETag']
+
+        Movie(title="New", release="2020-01-01").insert()
+
+        res = self.client().get('/movies', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(json.loads(res.data)['movies']), 1)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_should_serve_actors_from_response_cache(self):
+        Actor(name="Cached", age="30", gender="male").insert()
+
+        first = self.client().get('/actors')
+        hits = response_cache.hits
+        second = self.client().get('/actors')
+
+        self.assertEqual(response_cache.hits, hits + 1)
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(second.headers['Content-Type'],
+                         first.headers['Content-Type'])
+
+    def test_response_cache_should_keep_headers(self):
+        cache = ResponseCache(MemoryBackend())
+        cache.set('key', Response(b'{}', headers={
+            'Content-Type': 'application/json; charset=utf-8',
+            'Cache-Control': 'private, max-age=60',
+            'Server-Timing': 'db;dur=1.5',
+            'X-Other': 'dropped'
+        }))
+
+        response = cache.get('key')
+        self.assertEqual(response.get_data(), b'{}')
+        self.assertEqual(response.headers['Content-Type'],
+                         'application/json; charset=utf-8')
+        self.assertEqual(response.headers['Cache-Control'],
+                         'private, max-age=60')
+        self.assertNotIn('Server-Timing', response.headers)
+        self.assertNotIn('X-Other', response.headers)
+
+    def test_should_invalidate_response_cache_on_write(self):
+        actor = Actor(name="Before", age="30", gender="male")
+        actor.insert()
+        actor_id = actor.id
+        self.client().get('/actors')
+
+        patch = json.dumps({'name': "After"})
+        self.client().patch('/actors/%s' % actor_id, data=patch, headers=self.headers)
+
+        data = json.loads(self.client().get('/actors').data)
+        self.assertEqual(data['actors'][0]['name'], "After")
+
+    def test_should_share_cache_between_workers_through_redis(self):
+        client = FakeRedis()
+        setup_versions(self.app, RedisBackend(client))
+        setup_cache(self.app, RedisBackend(client))
+        Movie(title="Shared", release="2020-01-01").insert()
+
+        res = self.client().get('/movies')
+        self.assertEqual(len(json.loads(res.data)['movies']), 1)
+
+        # A write committed by another worker bumps the shared version.
+        other_worker = TableVersions(RedisBackend(client))
+        with self.app.app_context():
+            db.session.execute(Movie.__table__.delete())
+            db.session.commit()
+        other_worker.bump('movies')
+
+        res = self.client().get('/movies')
+        self.assertEqual(json.loads(res.data)['movies'], [])
+
+    def test_should_return_single_actor(self):
+        actor = Actor(name="Single", age="30", gender="female")
+        actor.insert()
+        actor_id = actor.id
+
+        res = self.client().get('/actors/%s' % actor_id)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actor']['name'], "Single")
+
+        hits = item_cache.hits
+        self.client().get('/actors/%s' % actor_id)
+        self.assertEqual(item_cache.hits, hits + 1)
+
+    def test_should_not_return_single_movie_if_not_found(self):
+        res = self.client().get('/movies/9999')
+        self.assertEqual(res.status_code, 404)
+
+    def test_should_refresh_single_movie_after_update(self):
+        movie = Movie(title="Old title", release="2001-01-01")
+        movie.insert()
+        movie_id = movie.id
+        self.client().get('/movies/%s' % movie_id)
+
+        with self.app.app_context():
+            movie = Movie.query.get(movie_id)
+            movie.title = "New title"
+            movie.update()
+
+        data = json.loads(self.client().get('/movies/%s' % movie_id).data)
+        self.assertEqual(data['movie']['title'], "New title")
+
+        with self.app.app_context():
+            Movie.query.get(movie_id).delete()
+
+        res = self.client().get('/movies/%s' % movie_id)
+        self.assertEqual(res.status_code, 404)
+
+    def test_should_report_db_health(self):
+        res = self.client().get('/health/db')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertGreaterEqual(data['latency_ms'], 0)
+        self.assertIn('class', data['pool'])
+
+    def test_should_configure_postgres_pool(self):
+        config = {
+            'DB_POOL_SIZE': 3, 'DB_MAX_OVERFLOW': 2, 'DB_POOL_TIMEOUT': 5,
+            'DB_POOL_RECYCLE': 60, 'DB_POOL_PRE_PING': True,
+            'DB_STATEMENT_TIMEOUT': 1500
+        }
+        options = engine_options(config, 'postgres://localhost/agency')
+
+        self.assertEqual(options['pool_size'], 3)
+        self.assertEqual(options['max_overflow'], 2)
+        self.assertEqual(options['connect_args'],
+                         {'options': '-c statement_timeout=1500'})
+        self.assertNotIn('pool_size', engine_options(config, 'sqlite://'))
+
+    def test_should_search_actors_and_movies(self):
+        Actor(name="Anne Hathaway", age="37", gender="female").insert()
+        Actor(name="Anthony Hopkins", age="82", gender="male").insert()
+        Movie(title="The Devil Wears Prada", release="2006-06-30").insert()
+
+        res = self.client().get('/search?q=hath')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([a['name'] for a in data['actors']], ["Anne Hathaway"])
+        self.assertEqual(data['movies'], [])
+
+        # A typo still finds the closest name.
+        res = self.client().get('/search?q=Hathawey&type=actors')
+        data = json.loads(res.data)
+        self.assertEqual(data['actors'][0]['name'], "Anne Hathaway")
+        self.assertNotIn('movies', data)
+
+        res = self.client().get('/search?q=devil prada&type=movies')
+        data = json.loads(res.data)
+        self.assertEqual(data['movies'][0]['title'], "The Devil Wears Prada")
+
+    def test_should_rank_and_page_search_results(self):
+        Actor(name="Ann Smith", age="30", gender="female").insert()
+        Actor(name="Anne Hathaway", age="37", gender="female").insert()
+
+        res = self.client().get('/search?q=ann&type=actors&limit=1')
+        data = json.loads(res.data)
+        self.assertEqual([a['name'] for a in data['actors']], ["Ann Smith"])
+
+        res = self.client().get('/search?q=ann&type=actors&limit=1&offset=1')
+        data = json.loads(res.data)
+        self.assertEqual([a['name'] for a in data['actors']], ["Anne Hathaway"])
+
+        # New rows are searchable right away.
+        Actor(name="Annabelle Wallis", age="35", gender="female").insert()
+        res = self.client().get('/search?q=annab&type=actors')
+        self.assertEqual(len(json.loads(res.data)['actors']), 1)
+
+    def test_should_not_search_without_query(self):
+        self.assertEqual(self.client().get('/search').status_code, 422)
+        self.assertEqual(self.client().get('/search?q=x&type=x').status_code, 422)
+
+    def test_should_assign_and_unassign_cast(self):
+        movie = Movie(title="Titanic", release="1997-12-19")
+        movie.insert()
+        leo = Actor(name="Leonardo DiCaprio", age="45", gender="male")
+        leo.insert()
+        kate = Actor(name="Kate Winslet", age="44", gender="female")
+        kate.insert()
+        movie_id, leo_id, kate_id = movie.id, leo.id, kate.id
+
+        body = json.dumps({'actor_ids': [leo_id, kate_id]})
+        res = self.client().post('/movies/%s/cast' % movie_id, data=body, headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([a['id'] for a in data['movie']['cast']], [leo_id, kate_id])
+
+        res = self.client().get('/actors/%s?embed=movies' % leo_id)
+        data = json.loads(res.data)
+        self.assertEqual([m['title'] for m in data['actor']['movies']], ["Titanic"])
+
+        res = self.client().delete('/movies/%s/cast/%s' % (movie_id, kate_id), headers=self.headers)
+        data = json.loads(res.data)
+        self.assertEqual([a['id'] for a in data['movie']['cast']], [leo_id])
+
+        res = self.client().get('/movies?embed=cast')
+        data = json.loads(res.data)
+        self.assertEqual([a['id'] for a in data['movies'][0]['cast']], [leo_id])
+
+    def test_should_not_assign_missing_actor_to_cast(self):
+        movie = Movie(title="Titanic", release="1997-12-19")
+        movie.insert()
+        movie_id = movie.id
+
+        body = json.dumps({'actor_id': 9999})
+        res = self.client().post('/movies/%s/cast' % movie_id, data=body, headers=self.headers)
+        self.assertEqual(res.status_code, 404)
+
+        res = self.client().delete('/movies/%s/cast/9999' % movie_id, headers=self.headers)
+        self.assertEqual(res.status_code, 404)
+
+        res = self.client().get('/movies?embed=secrets')
+        self.assertEqual(res.status_code, 422)
+
+    def test_should_reject_boolean_cast_ids(self):
+        movie = Movie(title="Titanic", release="1997-12-19")
+        movie.insert()
+        Actor(name="Leonardo DiCaprio", age="45", gender="male").insert()
+        movie_id = movie.id
+
+        for body in ({'actor_ids': [True]}, {'actor_id': False}):
+            res = self.client().post('/movies/%s/cast' % movie_id,
+                                     data=json.dumps(body), headers=self.headers)
+            self.assertEqual(res.status_code, 422)
+
+    def test_should_remove_cast_when_actors_deleted_in_bulk(self):
+        movie = Movie(title="Titanic", release="1997-12-19")
+        movie.insert()
+        actor = Actor(name="Leonardo DiCaprio", age="45", gender="male")
+        actor.insert()
+        movie.add_cast([actor])
+        actor_id = actor.id
+
+        self.client().get('/movies?embed=cast')
+        body = json.dumps({'ids': [actor_id]})
+        self.client().delete('/actors', data=body, headers=self.headers)
+
+        data = json.loads(self.client().get('/movies?embed=cast').data)
+        self.assertEqual(data['movies'][0]['cast'], [])
+
+    def count_queries(self, path):
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with self.app.app_context():
+            engine = self.db.engine
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            res = self.client().get(path)
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+        self.assertEqual(res.status_code, 200)
+        return len(statements)
+
+    def test_should_embed_cast_with_constant_query_count(self):
+        actors = [Actor(name="Actor %s" % i, age="30", gender="male") for i in range(3)]
+        for actor in actors:
+            actor.insert()
+
+        def add_movies(count):
+            for i in range(count):
+                movie = Movie(title="Movie %s" % i, release="2001-01-01")
+                movie.insert()
+                movie.add_cast(actors)
+
+        add_movies(5)
+        few = self.count_queries('/movies?embed=cast&limit=500')
+        add_movies(100)
+        many = self.count_queries('/movies?embed=cast&limit=500')
+
+        self.assertEqual(few, many)
+        self.assertLessEqual(many, 3)
+
+    def test_should_add_server_timing_to_sampled_requests(self):
+        self.app.config['METRICS_SAMPLE_RATE'] = 1
+        Actor(name="Timed", age="30", gender="male").insert()
+
+        res = self.client().get('/actors?limit=5')
+        timing = res.headers['Server-Timing']
+
+        self.assertIn('db;dur=', timing)
+        self.assertNotIn('"0 queries"', timing)
+        self.assertIn('serialize;dur=', timing)
+        self.assertIn('total;dur=', timing)
+
+        self.app.config['METRICS_SAMPLE_RATE'] = 0
+        res = self.client().get('/actors?limit=5')
+        self.assertNotIn('Server-Timing', res.headers)
+
+    def test_should_expose_prometheus_metrics(self):
+        self.app.config['METRICS_SAMPLE_RATE'] = 1
+        self.client().delete('/actors/9999', headers=self.headers)
+        self.client().get('/movies')
+
+        res = self.client().get('/metrics')
+        body = res.get_data(as_text=True)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('agency_request_duration_seconds_bucket{route="/movies",method="GET",le="+Inf"}', body)
+        self.assertIn('agency_requests_total{route="/actors/<int:actor_id>",method="DELETE",status="404"}', body)
+        self.assertIn('phase="auth"', body)
+        self.assertIn('agency_token_cache_total{result="misses"}', body)
+
+    def test_should_flag_repeated_statements_as_n_plus_one(self):
+        self.app.config.update(QUERY_LOG=True, N_PLUS_ONE_THRESHOLD=2)
+        query_report.clear()
+
+        # Lazy-loads each actor's movies: one query per actor.
+        @self.app.route('/lazy-actors')
+        def lazy_actors():
+            return jsonify([actor.format(embed=True) for actor in Actor.query.all()])
+
+        for i in range(3):
+            Actor(name="Actor %s" % i, age="30", gender="male").insert()
+
+        with self.assertLogs('agency.queries', level='WARNING') as logs:
+            self.client().get('/lazy-actors')
+        self.assertIn('Possible N+1: 3 runs on GET /lazy-actors', logs.output[0])
+
+        res = self.client().get('/debug/queries', headers=self.headers)
+        queries = json.loads(res.data)['queries']
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(queries[0]['n_plus_one_max_repeats'], 3)
+        self.assertEqual(queries[0]['routes'], ['/lazy-actors'])
+
+        # Embedding through the endpoint batches the lookups instead.
+        query_report.clear()
+        self.client().get('/actors?embed=movies')
+        self.assertEqual(query_report.summary(), [])
+
+    def test_should_log_slow_queries(self):
+        self.app.config.update(QUERY_LOG=True, SLOW_QUERY_MS=0)
+        query_report.clear()
+        with self.assertLogs('agency.queries', level='WARNING') as logs:
+            self.client().get('/movies')
+        self.assertIn('Slow query', logs.output[0])
+        self.assertEqual(query_report.summary()[0]['routes'], ['/movies'])
+
+    def test_should_hide_query_report_when_disabled(self):
+        self.app.config['QUERY_LOG'] = False
+        res = self.client().get('/debug/queries', headers=self.headers)
+        self.assertEqual(res.status_code, 404)
+
+    def test_should_require_permission_for_query_report(self):
+        self.app.config['QUERY_LOG'] = True
+        self.assertEqual(self.client().get('/debug/queries').status_code, 401)
+
+        token = make_token(permissions=['post:actors'])
+        res = self.client().get(
+            '/debug/queries', headers={'Authorization': 'Bearer ' + token})
+        self.assertEqual(res.status_code, 403)
+
+    def test_should_create_tables_from_cli_in_lazy_mode(self):
+        os.environ['LAZY_STARTUP'] = '1'
+        try:
+            app = create_app()
+            # Only ever drop the tables of the test database.
+            setup_db(app, self.database_path)
+        finally:
+            del os.environ['LAZY_STARTUP']
+
+        with app.app_context():
+            db.drop_all()
+        self.assertTrue(app.config['LAZY_STARTUP'])
+
+        result = app.test_cli_runner().invoke(args=['create-db'])
+        self.assertEqual(result.exit_code, 0)
+        with app.app_context():
+            self.assertIn('actors', db.engine.table_names())
+
+    def test_should_sync_changes_and_deletes_since_token(self):
+        self.app.config['SYNC_LAG'] = 0
+        kept = Actor(name="Kept", age="30", gender="female")
+        kept.insert()
+        doomed = Actor(name="Doomed", age="40", gender="male")
+        doomed.insert()
+        kept_id, doomed_id = kept.id, doomed.id
+
+        first = json.loads(self.client().get('/actors?changed_since=').data)
+        self.assertEqual([a['name'] for a in first['actors']], ['Kept', 'Doomed'])
+        self.assertEqual(first['deleted'], [])
+
+        # Nothing changed: an empty page, and the token still works.
+        res = self.client().get('/actors?changed_since=' + first['sync_token'])
+        self.assertEqual(json.loads(res.data)['actors'], [])
+
+        self.client().patch('/actors/%s' % kept_id, json={'age': 31}, headers=self.headers)
+        self.client().delete('/actors/%s' % doomed_id, headers=self.headers)
+        self.client().delete('/actors', json={'ids': [kept_id]}, headers=self.headers)
+        Actor(name="New", age="20", gender="female").insert()
+
+        res = self.client().get('/actors?limit=1&changed_since=' + first['sync_token'])
+        second = json.loads(res.data)
+        self.assertEqual([a['name'] for a in second['actors']], ['New'])
+        self.assertEqual(second['deleted'], [doomed_id])
+        self.assertTrue(second['has_more'])
+
+        res = self.client().get('/actors?limit=1&changed_since=' + second['sync_token'])
+        third = json.loads(res.data)
+        self.assertEqual(third['actors'], [])
+        self.assertEqual(third['deleted'], [kept_id])
+        self.assertFalse(third['has_more'])
+
+    def test_should_hold_back_changes_newer_than_sync_lag(self):
+        self.app.config['SYNC_LAG'] = 60
+        Actor(name="Fresh", age="30", gender="female").insert()
+
+        data = json.loads(self.client().get('/actors?changed_since=').data)
+        self.assertEqual(data['actors'], [])
+
+        res = self.client().get('/actors?changed_since=bogus')
+        self.assertEqual(res.status_code, 422)
+
+    def test_should_stream_write_events(self):
+        res = self.client().get('/events', buffered=False)
+        stream = iter(res.response)
+        self.assertEqual(res.mimetype, 'text/event-stream')
+        self.assertEqual(next(stream), b'retry: 3000\n\n')
+
+        self.client().post('/add-actor', headers=self.headers, data=json.dumps(
+            {'name': 'Streamed', 'age': 30, 'gender': 'female'}))
+        actor = Actor.query.filter_by(name='Streamed').one()
+        message = next(stream).decode()
+        res.close()
+
+        self.assertIn('event: actor.created\n', message)
+        self.assertIn('data: {"ids": [%d]}' % actor.id, message)
+
+    def test_should_resume_events_after_last_event_id(self):
+        first = Movie(title="First", release="2020-01-01")
+        first.insert()
+        second = Movie(title="Second", release="2020-01-01")
+        second.insert()
+        second.delete()
+        first_id = event_broker.history[0]['id']
+
+        res = self.client().get(
+            '/events', buffered=False, headers={'Last-Event-ID': first_id})
+        messages = [m.decode() for m in itertools.islice(res.response, 3)]
+        res.close()
+        self.assertIn('event: movie.created\n', messages[1])
+        self.assertIn('data: {"ids": [%d]}' % second.id, messages[1])
+        self.assertIn('event: movie.deleted\n', messages[2])
+
+        # Events older than the history get a reset instead.
+        res = self.client().get('/events?last_event_id=unknown', buffered=False)
+        messages = list(itertools.islice(res.response, 2))
+        res.close()
+        self.assertIn(b'event: reset\n', messages[1])
+
+    def test_should_limit_open_event_streams(self):
+        self.app.config['EVENTS_MAX_STREAMS'] = 1
+        first = self.client().get('/events', buffered=False)
+        self.assertEqual(first.status_code, 200)
+
+        res = self.client().get('/events', buffered=False)
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(json.loads(res.data)['error'], 503)
+
+        # Closing a stream frees its slot, even if it was never read.
+        first.close()
+        res = self.client().get('/events', buffered=False)
+        self.assertEqual(res.status_code, 200)
+        res.close()
+
+    def test_should_stop_replaced_event_channel(self):
+        broker = EventBroker()
+        broker.configure({
+            'EVENTS_BACKEND': 'postgres',
+            'SQLALCHEMY_DATABASE_URI': 'postgres://localhost:5432/agency'
+        })
+        channel = broker._channel()
+        self.assertIsInstance(channel, PostgresChannel)
+
+        broker.configure({'EVENTS_BACKEND': 'memory'})
+        self.assertTrue(channel.stopped.is_set())
+        self.assertIsNone(broker._channel())
+
+    def test_should_fan_out_events_through_postgres(self):
+        if db.engine.dialect.name != 'postgresql':
+            self.skipTest('needs Postgres')
+
+        channel = PostgresChannel(
+            str(db.engine.url), name='agency_test_events'
+        )
+        received = queue.Queue()
+        try:
+            channel.listen(received.put)
+            self.assertTrue(channel.listening.wait(10))
+
+            event = {'id': 'abc', 'event': 'actor.created',
+                     'data': {'ids': [1]}}
+            channel.publish(event)
+            self.assertEqual(received.get(timeout=10), event)
+        finally:
+            channel.stop()
+
+    def test_should_keep_catalog_stats_in_step_with_writes(self):
+        first = Actor(name="First", age="30", gender="female")
+        first.insert()
+        second = Actor(name="Second", age="35", gender="male")
+        second.insert()
+        third = Actor(name="Third", age="41", gender="female")
+        third.insert()
+        first_id, second_id, third_id = first.id, second.id, third.id
+
+        self.client().patch('/actors/%s' % second_id, headers=self.headers,
+                            data=json.dumps({'age': 52}))
+        self.client().delete('/actors/%s' % third_id, headers=self.headers)
+        self.client().post('/add-actors', headers=self.headers, data=json.dumps(
+            [{'name': "Bulk", 'age': 20, 'gender': "male"}]))
+        self.client().patch('/actors', headers=self.headers, data=json.dumps(
+            {'ids': [first_id], 'changes': {'gender': 'male'}}))
+        self.client().post('/add-movie', headers=self.headers, data=json.dumps(
+            {'title': "Devil Wears Prada", 'release': "2006-06-30"}))
+
+        res = self.client().get('/stats')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actors'], {
+            'total': 3,
+            'by_gender': {'male': 3},
+            'by_age': {'20-29': 1, '30-39': 1, '50-59': 1}
+        })
+        self.assertEqual(data['movies'], {
+            'total': 1, 'by_release_year': {'2006': 1}
+        })
+
+    def test_check_stats_should_report_and_fix_drift(self):
+        Actor(name="Counted", age="30", gender="female").insert()
+        with self.app.app_context():
+            db.session.execute(
+                "UPDATE catalog_stats SET count = 5 "
+                "WHERE metric = 'actors.total'"
+            )
+            db.session.commit()
+
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(args=['check-stats'])
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn('actors.total -: stored 5, expected 1', result.output)
+
+        result = runner.invoke(args=['check-stats', '--fix'])
+        self.assertEqual(result.exit_code, 0)
+        result = runner.invoke(args=['check-stats'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('Counters are consistent.', result.output)
+
+    def test_check_stats_should_lock_counters_before_reading(self):
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement.split()[0].upper())
+
+        with self.app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                check_counters(fix=True)
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+
+        self.assertIn(statements[0], ('LOCK', 'DELETE'))
+        self.assertIn('SELECT', statements[1:])
+
+    def test_should_group_concurrent_inserts_into_one_commit(self):
+        self.app.config['GROUP_COMMIT'] = True
+        self.app.config['GROUP_COMMIT_WINDOW_MS'] = 200
+        setup_group_commit(self.app)
+        commits = group_committer.commits
+        barrier = threading.Barrier(6)
+        responses = []
+
+        def add_actor(i):
+            barrier.wait()
+            res = self.client().post('/add-actor', headers=self.headers, data=json.dumps(
+                {'name': 'Grouped %s' % i, 'age': 30 + i, 'gender': 'male'}))
+            responses.append(json.loads(res.data))
+
+        try:
+            threads = [
+                threading.Thread(target=add_actor, args=(i,)) for i in range(6)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            self.app.config['GROUP_COMMIT'] = False
+            setup_group_commit(self.app)
+
+        ids = {r['actor']['id'] for r in responses if r['success']}
+        self.assertEqual(len(ids), 6)
+        self.assertLess(group_committer.commits - commits, 6)
+        with self.app.app_context():
+            self.assertEqual(Actor.query.count(), 6)
+            self.assertEqual(check_counters(), {})
+
+    def test_group_commit_should_isolate_failed_inserts(self):
+        good = PendingInsert(Actor, {'name': 'Good', 'age': 30, 'gender': 'male'})
+        # A value the driver can't bind makes the INSERT fail.
+        bad = PendingInsert(Actor, {'name': object(), 'age': 30, 'gender': 'male'})
+
+        with self.app.app_context():
+            group_committer.commit([bad, good])
+            self.assertIsNotNone(bad.future.exception())
+            actor = Actor.query.get(good.future.result())
+            self.assertEqual(actor.name, 'Good')
+
     def test_get_actors_dont_accept_post_request(self):
         res = self.client().post('/actors')
         self.assertEqual(res.status_code, 405)
@@ -70,6 +941,21 @@ class AgencyTestCase(unittest.TestCase):
         movies = Movie.query.all()
         self.assertEqual(len(data['movies']), len(movies))
 
+    def test_should_serialize_list_the_same_with_either_json_backend(self):
+        Movie(title="Devil Wears Prada", release="June 30, 2006").insert()
+        self.app.config['CACHE_BACKEND'] = 'none'
+        setup_cache(self.app)
+
+        self.app.config['JSON_BACKEND'] = 'stdlib'
+        stdlib = json.loads(self.client().get('/movies').data)
+        self.app.config['JSON_BACKEND'] = 'auto'
+        auto = json.loads(self.client().get('/movies').data)
+
+        self.assertEqual(stdlib, auto)
+        self.assertEqual(stdlib['movies'], [
+            {'id': 1, 'title': "Devil Wears Prada", 'release': '2006-06-30'}
+        ])
+
     def test_get_movies_dont_accept_post_request(self):
         res = self.client().post('/movies')
         self.assertEqual(res.status_code, 405)
@@ -77,11 +963,11 @@ class AgencyTestCase(unittest.TestCase):
     def test_should_create_new_actor(self):
         new_actor_data = {
             'name': "New actor name worked.",
-            'age': "New actor age worked.",
+            'age': 36,
             'gender': "New actor gender worked."
         } 
 
-        res = self.client().post('/add-actor', data=json.dumps(new_actor_data), headers={'Content-Type': 'application/json'})
+        res = self.client().post('/add-actor', data=json.dumps(new_actor_data), headers=self.headers)
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 200)
@@ -99,20 +985,107 @@ class AgencyTestCase(unittest.TestCase):
             'gender': "male"
         } 
 
-        res = self.client().post('/add-actor', data=json.dumps(new_actor_data), headers={'Content-Type': 'application/json'})
+        res = self.client().post('/add-actor', data=json.dumps(new_actor_data), headers=self.headers)
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 422)
         self.assertEqual(data['error'], 422)
         self.assertFalse(data['success'])
 
+    def test_should_create_actors_in_bulk(self):
+        actors = [
+            {'name': "Actor %s" % i, 'age': str(20 + i), 'gender': "male"}
+            for i in range(3)
+        ]
+        actors.append({'name': "Missing age", 'gender': "female"})
+
+        res = self.client().post('/add-actors', data=json.dumps(actors), headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual(data['created'], 3)
+        self.assertEqual([e['index'] for e in data['errors']], [3])
+        self.assertEqual(Actor.query.count(), 3)
+
+    def test_should_notify_bulk_inserts_with_their_ids(self):
+        Actor(name="Existing", age="30", gender="male").insert()
+        self.app.config['BULK_CHUNK_SIZE'] = 2
+        subscription, _ = event_broker.subscribe()
+        try:
+            actors = [
+                {'name': "Actor %s" % i, 'age': "30", 'gender': "male"}
+                for i in range(3)
+            ]
+            self.client().post('/add-actors', data=json.dumps(actors),
+                               headers=self.headers)
+            event = subscription.get(1)
+        finally:
+            event_broker.unsubscribe(subscription)
+
+        ids = [actor.id for actor in Actor.query.filter(Actor.name != "Existing")]
+        self.assertEqual(event['event'], 'actor.created')
+        self.assertEqual(sorted(event['data']['ids']), sorted(ids))
+
+    def test_should_create_movies_in_bulk_from_ndjson(self):
+        body = '\n'.join([
+            json.dumps({'title': "Movie A", 'release': "May 1, 2001"}),
+            'not json',
+            json.dumps({'title': "Movie B", 'release': "May 2, 2002"})
+        ])
+        headers = dict(self.headers, **{'Content-Type': 'application/x-ndjson'})
+
+        res = self.client().post('/add-movies', data=body, headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['created'], 2)
+        self.assertEqual([e['index'] for e in data['errors']], [1])
+
+    def test_should_not_create_actors_in_bulk_without_valid_records(self):
+        res = self.client().post('/add-actors', data=json.dumps([{'name': "x"}]), headers=self.headers)
+        self.assertEqual(res.status_code, 422)
+
+        res = self.client().post('/add-actors', data=json.dumps({}), headers=self.headers)
+        self.assertEqual(res.status_code, 422)
+
+    def test_should_not_allow_new_actor_with_invalid_age(self):
+        new_actor_data = {'name': "Invalid age", 'age': "old", 'gender': "male"}
+
+        res = self.client().post('/add-actor', data=json.dumps(new_actor_data), headers=self.headers)
+        self.assertEqual(res.status_code, 422)
+
+    def test_should_parse_movie_release_dates(self):
+        new_movie_data = {'title': "The Shining", 'release': "May 23rd, 1980"}
+
+        res = self.client().post('/add-movie', data=json.dumps(new_movie_data), headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movie']['release'], "1980-05-23")
+
+        new_movie_data['release'] = "sometime"
+        res = self.client().post('/add-movie', data=json.dumps(new_movie_data), headers=self.headers)
+        self.assertEqual(res.status_code, 422)
+
+    def test_should_filter_movies_by_release_range(self):
+        for year in (1997, 2006, 2020):
+            Movie(title="Movie %s" % year, release="%s-06-01" % year).insert()
+
+        res = self.client().get('/movies?release_from=2000-01-01&release_to=2010-12-31')
+        data = json.loads(res.data)
+        self.assertEqual([m['title'] for m in data['movies']], ["Movie 2006"])
+
+        res = self.client().get('/movies?release_from=soon')
+        self.assertEqual(res.status_code, 422)
+
     def test_should_create_new_movie(self):
         new_movie_data = {
             'title': "New movie title worked.",
-            'release': "New movie release date worked.",
+            'release': "2017-11-03",
         }
 
-        res = self.client().post('/add-movie', data=json.dumps(new_movie_data), headers={'Content-Type': 'application/json'})
+        res = self.client().post('/add-movie', data=json.dumps(new_movie_data), headers=self.headers)
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 200)
@@ -128,7 +1101,7 @@ class AgencyTestCase(unittest.TestCase):
             'title': "Testing a new movie with missing data."
         } 
 
-        res = self.client().post('/add-movie', data=json.dumps(new_movie_data), headers={'Content-Type': 'application/json'})
+        res = self.client().post('/add-movie', data=json.dumps(new_movie_data), headers=self.headers)
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 422)
@@ -140,13 +1113,13 @@ class AgencyTestCase(unittest.TestCase):
         actor.insert()
 
         actor_data_patch = {
-            'age': '37'
+            'age': 37
         } 
 
         res = self.client().patch(
             f'/actors/%s' % (actor.id),
             data=json.dumps(actor_data_patch),
-            headers={'Content-Type': 'application/json'}
+            headers=self.headers
         )
         data = json.loads(res.data)
 
@@ -164,7 +1137,7 @@ class AgencyTestCase(unittest.TestCase):
             'age': '1'
         } 
 
-        res = self.client().patch('/actors/9999', data=json.dumps(actor_data_patch), headers={'Content-Type': 'application/json'})
+        res = self.client().patch('/actors/9999', data=json.dumps(actor_data_patch), headers=self.headers)
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 404)
@@ -175,7 +1148,8 @@ class AgencyTestCase(unittest.TestCase):
         actor = Actor(name="Anne Hathaway", age="37", gender="female")
         actor.insert()
 
-        res = self.client().delete(f'/actors/%s' % actor.id)
+        res = self.client().delete(
+            f'/actors/%s' % actor.id, headers=self.headers)
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 200)
@@ -183,25 +1157,86 @@ class AgencyTestCase(unittest.TestCase):
         self.assertEqual(data['actor_id'], actor.id)
 
     def test_should_not_delete_existing_actor_if_not_found(self):
-        res = self.client().delete('/actors/9999')
+        res = self.client().delete('/actors/9999', headers=self.headers)
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 404)
         self.assertEqual(data['error'], 404)
         self.assertFalse(data['success'])
 
+    def test_should_update_actors_in_bulk(self):
+        first = Actor(name="First", age="30", gender="male")
+        first.insert()
+        second = Actor(name="Second", age="40", gender="male")
+        second.insert()
+        ids = [first.id, second.id]
+
+        patch = {'ids': ids + [9999], 'changes': {'gender': 'female'}}
+        res = self.client().patch('/actors', data=json.dumps(patch), headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['updated'], ids)
+        self.assertEqual(data['missing'], [9999])
+        genders = [a.gender for a in Actor.query.order_by(Actor.id)]
+        self.assertEqual(genders, ['female', 'female'])
+
+    def test_should_update_movies_in_bulk_by_id_map(self):
+        first = Movie(title="First", release="2001-01-01")
+        first.insert()
+        second = Movie(title="Second", release="2002-01-01")
+        second.insert()
+        first_id, second_id = first.id, second.id
+
+        patch = {'updates': {
+            str(first_id): {'title': "First cut"},
+            str(second_id): {'release': "2003-01-01"}
+        }}
+        res = self.client().patch('/movies', data=json.dumps(patch), headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(sorted(data['updated']), [first_id, second_id])
+        self.assertEqual(Movie.query.get(first_id).title, "First cut")
+        self.assertEqual(Movie.query.get(second_id).release.isoformat(), "2003-01-01")
+
+    def test_should_reject_bulk_updates_with_non_string_fields(self):
+        patch = {'updates': {'1': {'title': ["First cut"]}}}
+        res = self.client().patch('/movies', data=json.dumps(patch), headers=self.headers)
+
+        self.assertEqual(res.status_code, 422)
+
+    def test_should_delete_movies_in_bulk(self):
+        movie = Movie(title="Doomed", release="2001-01-01")
+        movie.insert()
+        movie_id = movie.id
+
+        body = json.dumps({'ids': [movie_id, 9999]})
+        res = self.client().delete('/movies', data=body, headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['deleted'], [movie_id])
+        self.assertEqual(data['missing'], [9999])
+        self.assertEqual(Movie.query.count(), 0)
+
+    def test_should_not_delete_in_bulk_without_ids(self):
+        body = json.dumps({'ids': ['one']})
+        res = self.client().delete('/actors', data=body, headers=self.headers)
+        self.assertEqual(res.status_code, 422)
+
     def test_should_update_existing_movie_data(self):
         movie = Movie(title="Invisible Man", release="March 20, 1998")
         movie.insert()
 
         movie_data_patch = {
-            'release': 'March 20, 2020'
+            'release': '2020-03-20'
         } 
 
         res = self.client().patch(
             f'/movies/%s' % (movie.id),
             data=json.dumps(movie_data_patch),
-            headers={'Content-Type': 'application/json'}
+            headers=self.headers
         )
         data = json.loads(res.data)
 
@@ -218,7 +1253,7 @@ class AgencyTestCase(unittest.TestCase):
             'title': 'Foo'
         } 
 
-        res = self.client().patch('/movies/9999', data=json.dumps(movie_data_patch), headers={'Content-Type': 'application/json'})
+        res = self.client().patch('/movies/9999', data=json.dumps(movie_data_patch), headers=self.headers)
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 404)
@@ -229,7 +1264,8 @@ class AgencyTestCase(unittest.TestCase):
         movie = Movie(title="Invisible Man", release="March 20, 2020")
         movie.insert()
 
-        res = self.client().delete(f'/movies/%s' % movie.id)
+        res = self.client().delete(
+            f'/movies/%s' % movie.id, headers=self.headers)
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 200)
@@ -237,13 +1273,394 @@ class AgencyTestCase(unittest.TestCase):
         self.assertEqual(data['movie_id'], movie.id)
 
     def test_should_not_delete_existing_movie_if_not_found(self):
-        res = self.client().delete('/movies/9999')
+        res = self.client().delete('/movies/9999', headers=self.headers)
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 404)
         self.assertEqual(data['error'], 404)
         self.assertFalse(data['success'])
 
+    def test_should_reject_request_without_token(self):
+        res = self.client().post('/add-movie', data=json.dumps({}))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 401)
+        self.assertFalse(data['success'])
+
+    def test_should_forbid_token_without_permission(self):
+        headers = {
+            'Content-Type': 'application/json',
+            'Authorization': 'Bearer ' + make_token(permissions=[])
+        }
+        res = self.client().delete('/movies/1', headers=headers)
+
+        self.assertEqual(res.status_code, 403)
+
+
+class JWKSCacheTestCase(unittest.TestCase):
+    """This class covers the in-process JWKS cache"""
+
+    def setUp(self):
+        self.now = 0
+        self.calls = 0
+        self.jwks = {'keys': [PUBLIC_JWK]}
+
+        def fetcher(url):
+            self.calls += 1
+            return self.jwks
+
+        self.cache = auth.JWKSCache(
+            auth.JWKS_URL,
+            fetcher=fetcher,
+            ttl=60,
+            refresh_cooldown=10,
+            clock=lambda: self.now
+        )
+
+    def test_should_fetch_keys_once_within_ttl(self):
+        for _ in range(5):
+            self.assertEqual(self.cache.get_key('test-key'), PUBLIC_JWK)
+        self.assertEqual(self.calls, 1)
+
+    def test_should_refetch_keys_after_ttl(self):
+        self.cache.get_key('test-key')
+        self.now = 61
+        self.cache.get_key('test-key')
+        self.assertEqual(self.calls, 2)
+
+    def test_should_refresh_on_unknown_kid_after_cooldown(self):
+        self.cache.get_key('test-key')
+        self.assertIsNone(self.cache.get_key('rotated'))
+        self.assertEqual(self.calls, 1)
+
+        rotated = dict(PUBLIC_JWK, kid='rotated')
+        self.jwks = {'keys': [PUBLIC_JWK, rotated]}
+        self.now = 11
+        self.assertEqual(self.cache.get_key('rotated'), rotated)
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(self.cache.version, 2)
+
+        # Unknown kids inside the cooldown don't trigger another fetch.
+        self.cache.get_key('bogus')
+        self.assertEqual(self.calls, 2)
+
+    def test_should_keep_last_keys_when_fetch_fails(self):
+        self.cache.get_key('test-key')
+        self.jwks = False
+        self.now = 61
+        self.assertEqual(self.cache.get_key('test-key'), PUBLIC_JWK)
+
+    def test_should_raise_auth_error_without_keys(self):
+        self.jwks = False
+        with self.assertRaises(auth.AuthError):
+            self.cache.get_key('test-key')
+
+    def test_should_rate_limit_fetches_after_failure(self):
+        self.jwks = False
+        for _ in range(5):
+            with self.assertRaises(auth.AuthError):
+                self.cache.get_key('test-key')
+        self.assertEqual(self.calls, 1)
+
+        self.jwks = {'keys': [PUBLIC_JWK]}
+        self.now = 10
+        self.assertEqual(self.cache.get_key('test-key'), PUBLIC_JWK)
+        self.assertEqual(self.calls, 2)
+
+    def test_should_fetch_once_for_concurrent_requests(self):
+        import threading
+        import time
+
+        def slow_fetcher(url):
+            self.calls += 1
+            time.sleep(0.05)
+            return self.jwks
+
+        self.cache.fetcher = slow_fetcher
+        threads = [
+            threading.Thread(target=self.cache.get_key, args=('test-key',))
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.calls, 1)
+
+
+@unittest.skipIf(TestClient is None, 'async mode dependencies not installed')
+class AsgiTestCase(unittest.TestCase):
+    """This class covers the async serving mode"""
+
+    def setUp(self):
+        self.app = create_app()
+        self.database_name = "agency_test"
+        self.database_path = "postgres://{}/{}".format('localhost:5432', self.database_name)
+        setup_db(self.app, self.database_path)
+        with self.app.app_context():
+            db.drop_all()
+            create_tables()
+
+        use_local_jwks()
+        auth.jwks_cache.refresh()
+        self.headers = {'Authorization': 'Bearer ' + make_token()}
+
+    def test_should_serve_same_shapes_as_sync_app(self):
+        with TestClient(create_asgi_app(self.database_path)) as client:
+            res = client.post('/add-movie', headers=self.headers, json={
+                'title': 'Titanic', 'release': 'December 19, 1997'
+            })
+            self.assertEqual(res.status_code, 200)
+            movie_id = res.json()['movie']['id']
+
+            async_list = client.get('/movies?limit=10').json()
+            async_item = client.get('/movies/%s' % movie_id).json()
+
+        sync_client = self.app.test_client()
+        self.assertEqual(async_list, json.loads(sync_client.get('/movies?limit=10').data))
+        self.assertEqual(async_item, json.loads(sync_client.get('/movies/%s' % movie_id).data))
+        self.assertEqual(async_item['movie']['release'], '1997-12-19')
+
+    def test_should_page_filter_and_embed(self):
+        with self.app.app_context():
+            movie = Movie(title="Titanic", release="1997-12-19")
+            movie.insert()
+            actors = [Actor(name="Actor %s" % i, age=20 + i, gender="female") for i in range(3)]
+            for actor in actors:
+                actor.insert()
+            movie.add_cast(actors[:2])
+
+        with TestClient(create_asgi_app(self.database_path)) as client:
+            first = client.get('/actors?limit=2&min_age=20&total=1').json()
+            second = client.get('/actors?limit=2&cursor=' + first['next_cursor']).json()
+            embedded = client.get('/movies/1?embed=cast').json()
+            bad = client.get('/actors?order_by=secret')
+
+        self.assertEqual([a['name'] for a in first['actors']], ['Actor 0', 'Actor 1'])
+        self.assertEqual(first['total'], 3)
+        self.assertEqual([a['name'] for a in second['actors']], ['Actor 2'])
+        self.assertEqual([a['id'] for a in embedded['movie']['cast']], [1, 2])
+        self.assertEqual(bad.status_code, 422)
+        self.assertEqual(bad.json()['message'], 'Request could not be processed.')
+
+    def test_should_update_and_delete_with_auth(self):
+        with TestClient(create_asgi_app(self.database_path)) as client:
+            self.assertEqual(client.post('/add-actor', json={}).status_code, 401)
+            actor = client.post('/add-actor', headers=self.headers, json={
+                'name': 'Leo', 'age': 45, 'gender': 'male'
+            }).json()['actor']
+
+            res = client.patch('/actors/%s' % actor['id'], headers=self.headers, json={'age': 46})
+            self.assertEqual(res.json()['actor']['age'], 46)
+
+            res = client.delete('/actors/%s' % actor['id'], headers=self.headers)
+            self.assertEqual(res.json(), {'success': True, 'actor_id': actor['id']})
+            self.assertEqual(client.get('/actors/%s' % actor['id']).status_code, 404)
+
+        with self.app.app_context():
+            self.assertEqual(check_counters(), {})
+
+    def test_should_notify_writes_off_the_event_loop(self):
+        import asyncio
+        from . import asgi
+        self.assertNotIn('app', vars(asgi))
+
+        loops = []
+
+        def listener(table, action, ids):
+            try:
+                loops.append(asyncio.get_running_loop())
+            except RuntimeError:
+                loops.append(None)
+
+        write_listeners.append(listener)
+        try:
+            with TestClient(create_asgi_app(self.database_path)) as client:
+                client.post('/add-actor', headers=self.headers, json={
+                    'name': 'Leo', 'age': 45, 'gender': 'male'
+                })
+        finally:
+            write_listeners.remove(listener)
+        self.assertEqual(loops, [None])
+
+    def test_should_fetch_jwks_without_blocking(self):
+        import asyncio
+        from . import asgi
+        stub = JWKSStub({'keys': [PUBLIC_JWK]})
+        try:
+            auth.jwks_cache = auth.JWKSCache(stub.url)
+            asyncio.run(asgi.ensure_jwks('test-key'))
+            self.assertEqual(auth.jwks_cache.get_key('test-key'), PUBLIC_JWK)
+            self.assertEqual(stub.requests, 1)
+
+            stub.status = 500
+            auth.jwks_cache = auth.JWKSCache(stub.url)
+            with self.assertRaises(auth.AuthError):
+                asyncio.run(asgi.ensure_jwks('test-key'))
+        finally:
+            stub.close()
+
+
+class JWKSRefresherTestCase(unittest.TestCase):
+    """This class covers background JWKS refreshes against a local stub"""
+
+    def setUp(self):
+        self.stub = JWKSStub({'keys': [PUBLIC_JWK]})
+        self.cache = auth.JWKSCache(self.stub.url, ttl=60)
+        self.refresher = auth.JWKSRefresher(
+            self.cache, retry_min=0.01, retry_max=0.05
+        )
+
+    def tearDown(self):
+        self.refresher.stop()
+        self.stub.close()
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(condition())
+
+    def test_should_prefetch_keys_in_background(self):
+        self.refresher.start()
+        self.wait_for(lambda: self.cache.fetches == 1)
+
+        self.assertEqual(self.cache.get_key('test-key'), PUBLIC_JWK)
+        self.assertEqual(self.stub.requests, 1)
+
+    def test_should_retry_with_backoff_and_keep_last_keys(self):
+        self.refresher.refresh()
+        self.stub.status = 500
+        self.refresher.start()
+        self.wait_for(lambda: self.refresher.failures >= 3)
+
+        self.assertEqual(self.cache.get_key('test-key'), PUBLIC_JWK)
+
+        self.stub.status = 200
+        self.wait_for(lambda: self.refresher.failures == 0)
+
+    def test_should_time_out_slow_fetches(self):
+        self.stub.delay = 0.5
+        start = time.monotonic()
+        with self.assertRaises(Exception):
+            auth.get_json_data(self.stub.url, timeout=0.1)
+        self.assertLess(time.monotonic() - start, 0.4)
+
+    def test_should_jitter_delays(self):
+        refresher = auth.JWKSRefresher(
+            self.cache, refresh_ahead=0.8, retry_min=1, retry_max=8,
+            rand=lambda: 1.0
+        )
+        self.assertAlmostEqual(refresher.next_delay(), 60 * 0.8 * 1.1)
+
+        refresher.failures = 10
+        self.assertEqual(refresher.next_delay(), 8)
+        refresher.rand = lambda: 0.0
+        self.assertEqual(refresher.next_delay(), 4)
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    """This class covers the verified-token cache"""
+
+    def setUp(self):
+        use_local_jwks()
+        self.token = make_token()
+
+    def test_should_skip_decode_for_cached_token(self):
+        first = auth.verify_decode_jwt(self.token)
+        second = auth.verify_decode_jwt(self.token)
+
+        self.assertEqual(first, second)
+        stats = auth.token_cache.stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 1)
+
+    def test_should_evict_expired_token(self):
+        now = [time.time()]
+        cache = auth.TokenCache(clock=lambda: now[0])
+        payload = {'exp': now[0] + 10}
+        cache.set(self.token, payload, 1)
+        self.assertEqual(cache.get(self.token, 1), payload)
+
+        now[0] += 11
+        self.assertIsNone(cache.get(self.token, 1))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_should_evict_all_tokens_on_key_rotation(self):
+        cache = auth.TokenCache()
+        cache.set(self.token, {'exp': time.time() + 60}, 1)
+        self.assertIsNone(cache.get(self.token, 2))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_should_bound_cache_size(self):
+        cache = auth.TokenCache(maxsize=2)
+        for token in ('a', 'b', 'c'):
+            cache.set(token, {'exp': time.time() + 60}, 1)
+
+        self.assertIsNone(cache.get('a', 1))
+        self.assertIsNotNone(cache.get('c', 1))
+        self.assertEqual(cache.stats()['size'], 2)
+
+
+class MemorySearchTestCase(unittest.TestCase):
+    """This class covers the in-memory search used off Postgres"""
+
+    def setUp(self):
+        self.app = create_app()
+        self.client = self.app.test_client
+        self.path = os.path.join(tempfile.gettempdir(), 'agency_search.db')
+        setup_db(self.app, 'sqlite:///' + self.path)
+        with self.app.app_context():
+            db.drop_all()
+            create_tables()
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_should_match_prefixes_before_trigrams(self):
+        index = InvertedIndex([
+            (1, "Anne Hathaway"), (2, "Ann Smith"), (3, "Anthony Hopkins")
+        ])
+
+        self.assertEqual([i for i, _ in index.search("ann")], [2, 1])
+        self.assertEqual([i for i, _ in index.search("hathawey")], [1])
+        self.assertEqual([i for i, _ in index.search("ann hath")], [1])
+        self.assertEqual(index.search("zzz"), [])
+        self.assertEqual(index.search("  "), [])
+
+    def test_should_search_sqlite_database_in_memory(self):
+        Actor(name="Anne Hathaway", age="37", gender="female").insert()
+        Movie(title="The Devil Wears Prada", release="2006-06-30").insert()
+
+        res = self.client().get('/search?q=prada')
+        data = json.loads(res.data)
+
+        self.assertEqual(db.engine.dialect.name, 'sqlite')
+        self.assertEqual(data['actors'], [])
+        self.assertEqual([m['title'] for m in data['movies']],
+                         ["The Devil Wears Prada"])
+
+        Actor(name="Anne Bancroft", age="73", gender="female").insert()
+        res = self.client().get('/search?q=anne&type=actors')
+        self.assertEqual(len(json.loads(res.data)['actors']), 2)
+
+
+class QueryFingerprintTestCase(unittest.TestCase):
+    """This class covers SQL fingerprinting for the query detector"""
+
+    def test_should_ignore_literals_and_parameters(self):
+        self.assertEqual(
+            fingerprint("SELECT * FROM actors WHERE id = 5 AND name = 'Leo'"),
+            fingerprint("SELECT *  FROM actors\nWHERE id = %(id_1)s AND name = ?")
+        )
+
+    def test_should_collapse_in_lists(self):
+        self.assertEqual(
+            fingerprint("DELETE FROM movies WHERE id IN (1, 2, 3)"),
+            "delete from movies where id in (...)"
+        )
+
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,173 @@
+# ---------------------------------------------------------
+# Imports
+# ---------------------------------------------------------
+
+import calendar
+import hashlib
+import time
+import uuid
+from functools import wraps
+from flask import g, request, make_response
+from werkzeug.http import http_date, parse_date
+from .backends import MemoryBackend, backend_from_config
+from .models import write_listeners
+
+# ---------------------------------------------------------
+# Table versions
+# ---------------------------------------------------------
+
+
+# Per-table version counters, bumped after every committed write.
+# Counters live in a key-value backend: in-process, or shared by every
+# worker when the backend is Redis. The epoch is replaced whenever the
+# counters are lost (a restart or a flushed Redis), so tags handed out
+# before never match again. Validators and caches built on the versions
+# are only used when `enabled`: in-process counters don't see writes
+# made by other workers.
+# Accepts: backend (MemoryBackend or RedisBackend)
+class TableVersions:
+    def __init__(self, backend=None):
+        self.backend = backend or MemoryBackend()
+        self.enabled = True
+        self._started = time.time()
+
+    # Returns: epoch (string) and, per table, version (int) and last
+    # modification time (epoch seconds).
+    def get(self, tables):
+        keys = ['epoch']
+        for table in tables:
+            keys += ['version:' + table, 'modified:' + table]
+
+        values = self.backend.get_many(keys)
+        epoch = values[0]
+        if epoch is None:
+            self.backend.set('epoch', uuid.uuid4().hex[:8], only_new=True)
+            epoch = self.backend.get('epoch')
+        if isinstance(epoch, bytes):
+            epoch = epoch.decode()
+
+        versions = {}
+        for i, table in enumerate(tables):
+            version, modified = values[1 + 2 * i:3 + 2 * i]
+            versions[table] = (
+                int(version or 0),
+                float(modified) if modified else self._started
+            )
+
+        return epoch, versions
+
+    def bump(self, table):
+        self.backend.incr('version:' + table)
+        self.backend.set('modified:' + table, time.time())
+
+
+table_versions = TableVersions()
+write_listeners.append(
+    lambda table, action, ids: table_versions.bump(table)
+)
+
+
+# Points the version counters at the configured backend. With
+# CACHE_BACKEND=none (the default) the counters are still kept, but
+# ETags, 304s and the caches are turned off.
+def setup_versions(app, backend=None):
+    table_versions.backend = backend or backend_from_config(app.config)
+    table_versions.enabled = (
+        backend is not None or app.config.get('CACHE_BACKEND') != 'none'
+    )
+
+# ---------------------------------------------------------
+# Conditional GET
+# ---------------------------------------------------------
+
+
+# Tables may be given as names or as one callable returning the names
+# the current request depends on.
+# Returns: table names (tuple)
+def resolve_tables(tables):
+    if len(tables) == 1 and callable(tables[0]):
+        return tuple(tables[0]())
+    return tables
+
+
+# Builds a strong ETag for the current request from the table versions,
+# the full path with its query string and the Accept header. The result
+# is remembered for the rest of the request.
+# Accepts: tables (tuple of strings)
+# Returns: etag (string) and last modification time (epoch seconds)
+def current_etag(tables):
+    etags = g.setdefault('etags', {})
+    if tables not in etags:
+        etags[tables] = compute_etag(tables)
+    return etags[tables]
+
+
+def compute_etag(tables):
+    epoch, versions = table_versions.get(tables)
+    parts = [epoch, request.full_path, request.headers.get('Accept', '')]
+    last_modified = 0
+    for table in tables:
+        version, modified = versions[table]
+        parts.append('%s:%s' % (table, version))
+        last_modified = max(last_modified, modified)
+
+    digest = hashlib.sha1('|'.join(parts).encode()).hexdigest()
+    return digest, last_modified
+
+
+# HTTP dates have whole seconds, so a write later in the same second
+# would carry the same Last-Modified. While that second isn't over, the
+# time is sent one second early: the client's next If-Modified-Since
+# then gets a 200 instead of a stale 304.
+# Returns: Last-Modified time (int, epoch seconds)
+def last_modified_second(last_modified):
+    second = int(last_modified)
+    if second >= int(time.time()):
+        second -= 1
+    return second
+
+
+# Checks the request's validators against the current ETag and
+# modification time. If-None-Match, based on the table versions, wins
+# over If-Modified-Since.
+# Returns: boolean, True if the client's copy is still current.
+def is_not_modified(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+
+    since = request.headers.get('If-Modified-Since')
+    if since:
+        since = parse_date(since)
+        if since is not None:
+            return int(last_modified) <= calendar.timegm(since.utctimetuple())
+
+    return False
+
+
+# Decorator answering GET requests with 304 Not Modified when none of the
+# given tables changed since the client's copy, without querying the
+# database. Other responses are tagged with ETag and Last-Modified.
+# Does nothing while the table versions are disabled.
+def conditional(*tables):
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if not table_versions.enabled:
+                return f(*args, **kwargs)
+
+            etag, last_modified = current_etag(resolve_tables(tables))
+            if is_not_modified(etag, last_modified):
+                response = make_response('', 304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag)
+            response.headers['Last-Modified'] = http_date(
+                last_modified_second(last_modified)
+            )
+            return response
+
+        return wrapper
+    return conditional_decorator
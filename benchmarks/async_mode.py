@@ -0,0 +1,167 @@
+# ---------------------------------------------------------
+# Imports
+# ---------------------------------------------------------
+
+import argparse
+import asyncio
+import logging
+import os
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Compare the serving modes themselves, not the response cache.
+os.environ['CACHE_BACKEND'] = 'none'
+
+# benchmarks.load picks the database, so it is imported first.
+from benchmarks.load import (  # noqa: E402
+    drive_server, scenarios, seed, summarize
+)
+from agency import application  # noqa: E402
+from agency.testing import make_token, use_local_jwks  # noqa: E402
+import uvicorn  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+from sqlalchemy.engine import Engine  # noqa: E402
+from werkzeug.serving import BaseWSGIServer  # noqa: E402
+from agency.asgi import create_asgi_app  # noqa: E402
+from agency.models import database_path  # noqa: E402
+
+# ---------------------------------------------------------
+# Servers
+# ---------------------------------------------------------
+
+
+# WSGI server handling requests on a fixed number of threads, like a
+# sync gunicorn worker started with --threads.
+class PooledWSGIServer(socketserver.ThreadingMixIn, BaseWSGIServer):
+    def __init__(self, threads, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool = ThreadPoolExecutor(threads)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+# Serves the Flask app on `threads` threads while the block runs; every
+# SQL statement sleeps for `delay` seconds first, holding its thread.
+class SyncServer:
+    def __init__(self, threads, delay):
+        self.threads = threads
+        self.delay = delay
+
+    def slow_statement(self, *args):
+        time.sleep(self.delay)
+
+    def __enter__(self):
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        event.listen(Engine, 'before_cursor_execute', self.slow_statement)
+        self.server = PooledWSGIServer(
+            self.threads, '127.0.0.1', 0, application
+        )
+        self.url = 'http://127.0.0.1:%s' % self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.pool.shutdown()
+        event.remove(Engine, 'before_cursor_execute', self.slow_statement)
+
+
+# Serves the ASGI app with uvicorn while the block runs; every database
+# call awaits `delay` seconds first, without holding the event loop.
+class AsyncServer:
+    def __init__(self, delay):
+        self.delay = delay
+
+    def slow_down(self, database):
+        for name in ('fetch_all', 'fetch_one', 'fetch_val', 'execute'):
+            method = getattr(database, name)
+
+            async def slow(*args, _method=method, **kwargs):
+                await asyncio.sleep(self.delay)
+                return await _method(*args, **kwargs)
+
+            setattr(database, name, slow)
+
+    def __enter__(self):
+        app = create_asgi_app(database_path)
+        self.slow_down(app.state.database)
+        port = free_port()
+        self.server = uvicorn.Server(uvicorn.Config(
+            app, host='127.0.0.1', port=port, log_level='warning'
+        ))
+        self.url = 'http://127.0.0.1:%s' % port
+        self.thread = threading.Thread(target=self.server.run)
+        self.thread.daemon = True
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, *exc):
+        self.server.should_exit = True
+        self.thread.join()
+
+# ---------------------------------------------------------
+# Benchmark
+# ---------------------------------------------------------
+
+
+def run(args):
+    use_local_jwks()
+    token = make_token()
+    with application.app_context():
+        seed(args.actors, args.actors)
+    cases = scenarios(args.actors, args.actors)
+
+    results = {}
+    servers = {
+        'sync': lambda: SyncServer(args.threads, args.delay),
+        'async': lambda: AsyncServer(args.delay),
+    }
+    for mode, server in servers.items():
+        with server() as running:
+            for name in args.scenario:
+                drive_server(running.url, cases[name], args.concurrency,
+                             token, args.concurrency)
+                results[(mode, name)] = summarize(*drive_server(
+                    running.url, cases[name], args.requests, token,
+                    args.concurrency))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare the sync and async serving modes against a '
+                    'slow database.')
+    parser.add_argument('--actors', type=int, default=1000)
+    parser.add_argument('--delay', type=float, default=0.05,
+                        help='simulated seconds per database call')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='threads of the sync server')
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--requests', type=int, default=640)
+    parser.add_argument('--scenario', action='append',
+                        help='scenario from benchmarks.load (repeatable)')
+    args = parser.parse_args()
+    args.scenario = args.scenario or ['list_actors', 'list_movies']
+
+    results = run(args)
+    print('%-6s %-12s %9s %7s %9s %9s %9s' % (
+        'mode', 'scenario', 'rps', 'errors', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for (mode, name), r in results.items():
+        print('%-6s %-12s %9.1f %7d %9.2f %9.2f %9.2f' % (
+            mode, name, r['rps'], r['errors'],
+            r['p50_ms'], r['p95_ms'], r['p99_ms']))
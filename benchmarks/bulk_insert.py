@@ -0,0 +1,71 @@
+# ---------------------------------------------------------
+# Imports
+# ---------------------------------------------------------
+
+import argparse
+import os
+import tempfile
+import time
+
+# The app connects on import, so pick the database first.
+os.environ.setdefault(
+    'DATABASE_URL',
+    'sqlite:///' + os.path.join(tempfile.gettempdir(), 'agency_bench.db')
+)
+
+from agency import application  # noqa: E402
+from agency.bulk import insert_records  # noqa: E402
+from agency.models import db, Actor  # noqa: E402
+
+# ---------------------------------------------------------
+# Benchmark
+# ---------------------------------------------------------
+
+
+def make_rows(count):
+    return [
+        (i, {'name': 'Actor %s' % i, 'age': str(i % 90), 'gender': 'female'})
+        for i in range(count)
+    ]
+
+
+def reset_tables():
+    db.drop_all()
+    db.create_all()
+
+
+# Inserts rows one at a time through Actor.insert(), one commit each.
+def per_item(rows):
+    for _, row in rows:
+        Actor(**row).insert()
+
+
+# Inserts rows through the chunked path used by POST /add-actors.
+def bulk(rows):
+    insert_records(Actor, rows)
+
+
+def run(rows):
+    results = {}
+    with application.app_context():
+        for name, insert in (('per_item', per_item), ('bulk', bulk)):
+            reset_tables()
+            start = time.perf_counter()
+            insert(rows)
+            elapsed = time.perf_counter() - start
+            assert Actor.query.count() == len(rows)
+            results[name] = len(rows) / elapsed
+        reset_tables()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare per-item and bulk actor inserts.')
+    parser.add_argument('--rows', type=int, default=10000)
+    args = parser.parse_args()
+
+    results = run(make_rows(args.rows))
+    for name, rate in results.items():
+        print('%-9s %10.0f rows/s' % (name, rate))
+    print('speedup   %10.1fx' % (results['bulk'] / results['per_item']))
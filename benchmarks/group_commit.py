@@ -0,0 +1,102 @@
+# ---------------------------------------------------------
+# Imports
+# ---------------------------------------------------------
+
+import argparse
+import os
+import threading
+import time
+
+# Measure commits, not the response cache.
+os.environ['CACHE_BACKEND'] = 'none'
+
+# benchmarks.load picks the database, so it is imported first.
+from benchmarks.load import (  # noqa: E402
+    LocalServer, drive_server, scenarios, seed, summarize
+)
+from agency import application  # noqa: E402
+from agency.testing import make_token, use_local_jwks  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+from sqlalchemy.engine import Engine  # noqa: E402
+from agency.groupcommit import setup_group_commit  # noqa: E402
+
+# ---------------------------------------------------------
+# Commit counting
+# ---------------------------------------------------------
+
+
+# Counts committed transactions while the block runs. Every commit first
+# sleeps for `delay` seconds, standing in for the fsync a durable commit
+# waits for on a real database server.
+class CommitCounter:
+    def __init__(self, delay):
+        self.delay = delay
+        self.commits = 0
+        self._lock = threading.Lock()
+
+    def on_commit(self, connection):
+        time.sleep(self.delay)
+        with self._lock:
+            self.commits += 1
+
+    def __enter__(self):
+        event.listen(Engine, 'commit', self.on_commit)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(Engine, 'commit', self.on_commit)
+
+# ---------------------------------------------------------
+# Benchmark
+# ---------------------------------------------------------
+
+
+def run(args):
+    use_local_jwks()
+    token = make_token()
+    with application.app_context():
+        seed(0, 0)
+    add_actor = scenarios(0, 0)['add_actor']
+
+    results = {}
+    for mode in ('off', 'on'):
+        application.config['GROUP_COMMIT'] = mode == 'on'
+        application.config['GROUP_COMMIT_WINDOW_MS'] = args.window_ms
+        setup_group_commit(application)
+
+        with LocalServer() as server:
+            drive_server(server.url, add_actor, args.concurrency, token,
+                         args.concurrency)
+            with CommitCounter(args.commit_delay) as counter:
+                latencies, errors, wall = drive_server(
+                    server.url, add_actor, args.requests, token,
+                    args.concurrency)
+
+        result = summarize(latencies, errors, wall)
+        result['commits_per_s'] = round(counter.commits / wall, 1)
+        result['inserts_per_commit'] = round(
+            (len(latencies) - errors) / max(counter.commits, 1), 2)
+        results[mode] = result
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare single-row inserts with and without group '
+                    'commit.')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--commit-delay', type=float, default=0.005,
+                        help='simulated seconds per commit (fsync)')
+    parser.add_argument('--window-ms', type=float, default=2,
+                        help='GROUP_COMMIT_WINDOW_MS for the grouped run')
+    args = parser.parse_args()
+
+    results = run(args)
+    print('%-12s %10s %10s %10s %7s %9s %9s' % (
+        'group commit', 'inserts/s', 'commits/s', 'per commit', 'errors',
+        'p50 ms', 'p95 ms'))
+    for mode, r in results.items():
+        print('%-12s %10.1f %10.1f %10.2f %7d %9.2f %9.2f' % (
+            mode, r['rps'], r['commits_per_s'], r['inserts_per_commit'],
+            r['errors'], r['p50_ms'], r['p95_ms']))
@@ -0,0 +1,87 @@
+# ---------------------------------------------------------
+# Imports
+# ---------------------------------------------------------
+
+import argparse
+import datetime
+import json
+import os
+import tempfile
+import time
+
+# The app connects on import, so pick the database first.
+os.environ.setdefault(
+    'DATABASE_URL',
+    'sqlite:///' + os.path.join(tempfile.gettempdir(), 'agency_bench.db')
+)
+
+from agency import application  # noqa: E402
+from agency.models import db, Movie  # noqa: E402
+from agency.serialize import (  # noqa: E402
+    dumps, format_rows, orjson, select_fields
+)
+
+# ---------------------------------------------------------
+# Benchmark
+# ---------------------------------------------------------
+
+
+def seed(count):
+    db.drop_all()
+    db.create_all()
+    db.session.execute(Movie.__table__.insert(), [
+        {'title': 'Movie %s' % i, 'release': datetime.date(
+            1990 + i % 30, 1 + i % 12, 1 + i % 28)}
+        for i in range(count)
+    ])
+    db.session.commit()
+
+
+# The previous path: hydrate ORM objects, format() each, stdlib json.
+def orm_stdlib():
+    movies = Movie.query.order_by(Movie.id).all()
+    return json.dumps({'movies': [movie.format() for movie in movies]})
+
+
+# Column rows straight to dictionaries, then the configured encoder.
+def columns():
+    rows = select_fields(Movie.query, Movie).order_by(Movie.id).all()
+    return dumps({'movies': format_rows(rows, Movie)})
+
+
+def best_of(f, repeat):
+    times = []
+    for _ in range(repeat):
+        db.session.expunge_all()
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def run(count, repeat):
+    results = {}
+    with application.test_request_context():
+        seed(count)
+        results['orm + format + json'] = best_of(orm_stdlib, repeat)
+        application.config['JSON_BACKEND'] = 'stdlib'
+        results['columns + json'] = best_of(columns, repeat)
+        if orjson is not None:
+            application.config['JSON_BACKEND'] = 'orjson'
+            results['columns + orjson'] = best_of(columns, repeat)
+        db.drop_all()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare ways of serializing a large list of movies.')
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    results = run(args.rows, args.repeat)
+    baseline = results['orm + format + json']
+    for name, seconds in results.items():
+        print('%-22s %8.1f ms  %5.1fx' % (
+            name, seconds * 1000, baseline / seconds))
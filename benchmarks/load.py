@@ -0,0 +1,302 @@
+# ---------------------------------------------------------
+# Imports
+# ---------------------------------------------------------
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+# The app connects when agency.application is first built, so pick the
+# database first. --compare never builds it.
+os.environ.setdefault(
+    'DATABASE_URL',
+    'sqlite:///' + os.path.join(tempfile.gettempdir(), 'agency_bench.db')
+)
+# The benchmark server is a single process, so the in-process cache is
+# safe and is measured unless turned off.
+os.environ.setdefault('CACHE_BACKEND', 'memory')
+
+import agency  # noqa: E402
+from werkzeug.serving import make_server  # noqa: E402
+from agency.models import db, create_tables, Actor, Movie  # noqa: E402
+from agency.testing import make_token, use_local_jwks  # noqa: E402
+
+# ---------------------------------------------------------
+# Seeding
+# ---------------------------------------------------------
+
+SEED_CHUNK_SIZE = 10000
+
+
+# Recreates the tables and fills them with generated rows in chunks,
+# so that a million rows don't have to fit in memory at once.
+# Accepts: number of actors and movies (integers)
+def seed(actors, movies):
+    db.drop_all()
+    create_tables()
+    release = datetime.date(1990, 1, 1)
+
+    for start in range(0, actors, SEED_CHUNK_SIZE):
+        db.session.execute(Actor.__table__.insert(), [
+            {'name': 'Actor %s' % i, 'age': i % 90,
+             'gender': 'female' if i % 2 else 'male'}
+            for i in range(start, min(start + SEED_CHUNK_SIZE, actors))
+        ])
+        db.session.commit()
+
+    for start in range(0, movies, SEED_CHUNK_SIZE):
+        db.session.execute(Movie.__table__.insert(), [
+            {'title': 'Movie %s' % i,
+             'release': release + datetime.timedelta(days=i % 10000)}
+            for i in range(start, min(start + SEED_CHUNK_SIZE, movies))
+        ])
+        db.session.commit()
+
+# ---------------------------------------------------------
+# Scenarios
+# ---------------------------------------------------------
+
+
+# Each scenario builds a (method, path, body, needs auth) request.
+def scenarios(actors, movies):
+    return {
+        'list_actors': lambda: ('GET', '/actors?limit=50', None, False),
+        'list_movies': lambda: ('GET', '/movies?limit=50&order_by=-release',
+                                None, False),
+        'get_actor': lambda: (
+            'GET', '/actors/%s' % random.randint(1, actors), None, False),
+        'search': lambda: (
+            'GET', '/search?q=actor+%s' % random.randint(1, actors),
+            None, False),
+        'add_actor': lambda: ('POST', '/add-actor', {
+            'name': 'Bench Actor', 'age': 30, 'gender': 'female'}, True),
+        'patch_movie': lambda: (
+            'PATCH', '/movies/%s' % random.randint(1, movies),
+            {'title': 'Movie %s' % random.randint(1, movies)}, True),
+    }
+
+# ---------------------------------------------------------
+# Drivers
+# ---------------------------------------------------------
+
+
+# Sends requests through the Flask test client, one at a time.
+# Returns: latencies in seconds (list), errors (integer), wall time
+def drive_client(build, count, token):
+    client = agency.application.test_client()
+    latencies, errors = [], 0
+    wall = time.perf_counter()
+    for _ in range(count):
+        method, path, body, needs_auth = build()
+        headers = {'Authorization': 'Bearer ' + token} if needs_auth else {}
+        start = time.perf_counter()
+        res = client.open(path, method=method, json=body, headers=headers)
+        latencies.append(time.perf_counter() - start)
+        errors += res.status_code >= 400
+    return latencies, errors, time.perf_counter() - wall
+
+
+# Serves the app with a threaded local WSGI server for the duration of
+# a `with` block.
+class LocalServer:
+    def __enter__(self):
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        self.server = make_server(
+            '127.0.0.1', 0, agency.application, threaded=True
+        )
+        self.url = 'http://127.0.0.1:%s' % self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.thread.join()
+
+
+def send(url, build, token):
+    method, path, body, needs_auth = build()
+    data = json.dumps(body).encode() if body is not None else None
+    req = urllib.request.Request(url + path, data=data, method=method)
+    req.add_header('Content-Type', 'application/json')
+    if needs_auth:
+        req.add_header('Authorization', 'Bearer ' + token)
+
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req) as res:
+            res.read()
+        failed = False
+    except (urllib.error.URLError, ConnectionError):
+        failed = True
+    return time.perf_counter() - start, failed
+
+
+# Sends requests over HTTP from concurrent client threads.
+# Returns: latencies in seconds (list), errors (integer), wall time
+def drive_server(url, build, count, token, concurrency):
+    wall = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(
+            lambda _: send(url, build, token), range(count)
+        ))
+    wall = time.perf_counter() - wall
+    return [r[0] for r in results], sum(r[1] for r in results), wall
+
+# ---------------------------------------------------------
+# Results
+# ---------------------------------------------------------
+
+
+# Nearest-rank percentile of a sorted list, 0 when it is empty.
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    index = max(0, int(round(pct / 100 * len(values))) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+def summarize(latencies, errors, wall):
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': round(len(latencies) / wall, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    use_local_jwks()
+    token = make_token()
+    modes = ['client', 'server'] if args.mode == 'both' else [args.mode]
+    results = {mode: {} for mode in modes}
+
+    with agency.application.app_context():
+        seed(args.actors, args.movies)
+        dialect = db.engine.dialect.name
+    cases = scenarios(args.actors, args.movies)
+    selected = args.scenario or list(cases)
+
+    if 'client' in modes:
+        for name in selected:
+            drive_client(cases[name], args.warmup, token)
+            results['client'][name] = summarize(
+                *drive_client(cases[name], args.requests, token))
+
+    if 'server' in modes:
+        with LocalServer() as server:
+            for name in selected:
+                drive_server(server.url, cases[name], args.warmup, token,
+                             args.concurrency)
+                results['server'][name] = summarize(*drive_server(
+                    server.url, cases[name], args.requests, token,
+                    args.concurrency))
+
+    return {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+            'database': dialect,
+            'actors': args.actors,
+            'movies': args.movies,
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'python': platform.python_version(),
+        },
+        'results': results
+    }
+
+
+def print_results(report):
+    print('%-8s %-12s %9s %7s %9s %9s %9s' % (
+        'mode', 'scenario', 'rps', 'errors', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for mode, cases in report['results'].items():
+        for name, r in cases.items():
+            print('%-8s %-12s %9.1f %7d %9.2f %9.2f %9.2f' % (
+                mode, name, r['rps'], r['errors'],
+                r['p50_ms'], r['p95_ms'], r['p99_ms']))
+
+
+# Compares two result files and lists scenarios whose p95 latency rose,
+# or whose throughput fell, by more than the threshold.
+# Accepts: baseline and candidate reports (dictionaries), threshold
+# Returns: regressions (list of strings)
+def compare(base, new, threshold):
+    regressions = []
+    print('%-8s %-12s %10s %10s' % ('mode', 'scenario', 'p95', 'rps'))
+    for mode, cases in new['results'].items():
+        for name, r in cases.items():
+            old = base['results'].get(mode, {}).get(name)
+            if not old:
+                continue
+            p95 = r['p95_ms'] / old['p95_ms'] - 1 if old['p95_ms'] else 0
+            rps = r['rps'] / old['rps'] - 1 if old['rps'] else 0
+            print('%-8s %-12s %+9.1f%% %+9.1f%%' % (
+                mode, name, p95 * 100, rps * 100))
+            if p95 > threshold or rps < -threshold:
+                regressions.append('%s/%s' % (mode, name))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Load-test the API offline and record the results.')
+    parser.add_argument('--actors', type=int, default=1000)
+    parser.add_argument('--movies', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=500,
+                        help='requests per scenario')
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--mode', choices=['client', 'server', 'both'],
+                        default='both')
+    parser.add_argument('--scenario', action='append',
+                        help='run only this scenario (repeatable)')
+    parser.add_argument('--output', help='write the results to this file')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'),
+                        help='compare two result files instead of running')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='allowed p95/rps change when comparing')
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            base = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        regressions = compare(base, new, args.threshold)
+        if regressions:
+            print('Regressed: ' + ', '.join(regressions))
+            sys.exit(1)
+        sys.exit(0)
+
+    report = run(args)
+    print_results(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
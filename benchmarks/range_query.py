@@ -0,0 +1,89 @@
+# ---------------------------------------------------------
+# Imports
+# ---------------------------------------------------------
+
+import argparse
+import os
+import random
+import tempfile
+import time
+
+# The app connects on import, so pick the database first.
+os.environ.setdefault(
+    'DATABASE_URL',
+    'sqlite:///' + os.path.join(tempfile.gettempdir(), 'agency_bench.db')
+)
+
+from sqlalchemy import text  # noqa: E402
+from agency import application  # noqa: E402
+from agency.models import db, Actor  # noqa: E402
+
+# ---------------------------------------------------------
+# Benchmark
+# ---------------------------------------------------------
+
+# A correct age range on the old text column needs a cast, which the
+# index on the text column can't serve.
+TEXT_QUERY = (
+    'SELECT count(*) FROM actors_text '
+    'WHERE CAST(age AS INTEGER) BETWEEN :low AND :high'
+)
+TYPED_QUERY = 'SELECT count(*) FROM actors WHERE age BETWEEN :low AND :high'
+
+
+def seed(count):
+    db.drop_all()
+    db.create_all()
+    db.session.execute(text('DROP TABLE IF EXISTS actors_text'))
+    db.session.execute(text(
+        'CREATE TABLE actors_text '
+        '(id INTEGER PRIMARY KEY, name VARCHAR, age VARCHAR, gender VARCHAR)'
+    ))
+    db.session.execute(text('CREATE INDEX ix_text_age ON actors_text (age)'))
+
+    rows = [
+        {'name': 'Actor %s' % i, 'age': random.randint(0, 99),
+         'gender': 'female'}
+        for i in range(count)
+    ]
+    db.session.execute(Actor.__table__.insert(), rows)
+    db.session.execute(
+        text('INSERT INTO actors_text (name, age, gender) '
+             'VALUES (:name, :age, :gender)'),
+        [dict(row, age=str(row['age'])) for row in rows]
+    )
+    db.session.commit()
+
+
+def time_query(query, repeat):
+    params = {'low': 30, 'high': 31}
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = db.session.execute(text(query), params).scalar()
+    return (time.perf_counter() - start) / repeat, result
+
+
+def run(count, repeat):
+    with application.app_context():
+        seed(count)
+        text_time, text_count = time_query(TEXT_QUERY, repeat)
+        typed_time, typed_count = time_query(TYPED_QUERY, repeat)
+        assert text_count == typed_count
+
+        db.session.execute(text('DROP TABLE actors_text'))
+        db.session.commit()
+        db.drop_all()
+    return text_time, typed_time
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare age range queries on text and integer columns.')
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    text_time, typed_time = run(args.rows, args.repeat)
+    print('text   %8.2f ms/query' % (text_time * 1000))
+    print('typed  %8.2f ms/query' % (typed_time * 1000))
+    print('speedup %7.1fx' % (text_time / typed_time))
@@ -0,0 +1,94 @@
+# ---------------------------------------------------------
+# Imports
+# ---------------------------------------------------------
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# ---------------------------------------------------------
+# Benchmark
+# ---------------------------------------------------------
+
+# Cold start budget for a LAZY_STARTUP worker: process start until the
+# first response is sent.
+TARGET_MS = 800
+
+# Runs in a fresh interpreter: builds the app and serves one request,
+# then prints how long the app took to become ready.
+WORKER = '''
+import json, time
+start = time.perf_counter()
+from agency import application
+ready = time.perf_counter() - start
+status = application.test_client().get('/actors?limit=1').status_code
+print(json.dumps({'ready': ready, 'status': status}))
+'''
+
+
+def database_url():
+    return os.environ.get(
+        'DATABASE_URL',
+        'sqlite:///' + os.path.join(
+            tempfile.gettempdir(), 'agency_bench.db')
+    )
+
+
+def prepare(env):
+    subprocess.check_call(
+        [sys.executable, '-m', 'flask', 'create-db'],
+        env=dict(env, FLASK_APP='agency', LAZY_STARTUP='1'),
+        stdout=subprocess.DEVNULL
+    )
+
+
+# Starts a fresh worker process and times it.
+# Returns: seconds until the app was ready, and until the first response
+def cold_start(env):
+    start = time.perf_counter()
+    output = subprocess.check_output([sys.executable, '-c', WORKER], env=env)
+    total = time.perf_counter() - start
+    result = json.loads(output.decode().strip().splitlines()[-1])
+    assert result['status'] == 200, result
+    return result['ready'], total
+
+
+def run(repeat):
+    env = dict(os.environ, DATABASE_URL=database_url())
+    prepare(env)
+
+    results = {}
+    for mode, lazy in (('eager', '0'), ('lazy', '1')):
+        runs = [cold_start(dict(env, LAZY_STARTUP=lazy))
+                for _ in range(repeat)]
+        results[mode] = {
+            'ready_ms': statistics.median(r[0] for r in runs) * 1000,
+            'first_response_ms': statistics.median(r[1] for r in runs) * 1000
+        }
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Measure worker cold start with and without '
+                    'LAZY_STARTUP.')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--target-ms', type=float, default=TARGET_MS)
+    args = parser.parse_args()
+
+    results = run(args.repeat)
+    for mode, r in results.items():
+        print('%-6s app ready %7.1f ms   first response %7.1f ms' % (
+            mode, r['ready_ms'], r['first_response_ms']))
+
+    lazy = results['lazy']['first_response_ms']
+    if lazy > args.target_ms:
+        print('Lazy cold start %.0f ms is over the %.0f ms target.' % (
+            lazy, args.target_ms))
+        sys.exit(1)
+    print('Lazy cold start is within the %.0f ms target.' % args.target_ms)
@@ -0,0 +1,26 @@
+# Gunicorn settings, loaded automatically from the working directory.
+import os
+
+# Threaded workers. An open /events stream still holds one thread until
+# the client leaves; EVENTS_MAX_STREAMS caps them per worker, below the
+# thread count, so other requests keep threads to run on.
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+
+# Refuses to start several workers with CACHE_BACKEND=memory: each
+# worker would keep its own table versions and answer with stale 304s
+# and cached bodies after writes made by the others.
+def on_starting(server):
+    if server.cfg.workers > 1 and os.environ.get('CACHE_BACKEND') == 'memory':
+        raise RuntimeError(
+            'CACHE_BACKEND=memory needs a single worker; '
+            'use CACHE_BACKEND=redis with several workers.'
+        )
+
+
+# Prefetches the Auth0 key set in each new worker and keeps it fresh in
+# the background, so the first authenticated request doesn't wait on it.
+def post_fork(server, worker):
+    from agency.auth.auth import start_jwks_refresher
+    start_jwks_refresher()
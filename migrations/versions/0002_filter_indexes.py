@@ -0,0 +1,48 @@
+"""B-tree indexes for actor and movie filters and sorting
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 10:00:00
+
+Name and title indexes use text_pattern_ops on Postgres so that prefix
+filters (LIKE 'abc%') can use them regardless of the collation.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+INDEXES = [
+    ('ix_actors_name', 'actors', ['name'], {'name': 'text_pattern_ops'}),
+    ('ix_actors_gender_age', 'actors', ['gender', 'age'], {}),
+    ('ix_actors_age', 'actors', ['age'], {}),
+    ('ix_movies_title', 'movies', ['title'], {'title': 'text_pattern_ops'}),
+    ('ix_movies_release', 'movies', ['release'], {}),
+]
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    existing = {
+        index['name']
+        for table in ('actors', 'movies')
+        for index in inspector.get_indexes(table)
+    }
+
+    for name, table, columns, ops in INDEXES:
+        if name not in existing:
+            op.create_index(name, table, columns, postgresql_ops=ops)
+
+
+def downgrade():
+    op.drop_index('ix_movies_release', table_name='movies')
+    op.drop_index('ix_movies_title', table_name='movies')
+    op.drop_index('ix_actors_age', table_name='actors')
+    op.drop_index('ix_actors_gender_age', table_name='actors')
+    op.drop_index('ix_actors_name', table_name='actors')
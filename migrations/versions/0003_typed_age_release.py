@@ -0,0 +1,135 @@
+"""Store actors.age as integer and movies.release as date
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 11:00:00
+
+Existing text values are parsed and copied into new typed columns, which
+then replace the old ones. The upgrade stops, without changing anything,
+if a row can't be parsed. The downgrade writes the values back as text
+(ages as digits, release dates as YYYY-MM-DD).
+"""
+import datetime
+import re
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+RELEASE_FORMATS = ('%Y-%m-%d', '%B %d, %Y', '%b %d, %Y', '%B %d %Y')
+
+
+def parse_age(value):
+    if not value.strip().isdigit() or not 0 <= int(value) <= 150:
+        raise ValueError(value)
+    return int(value)
+
+
+def parse_release(value):
+    value = re.sub(r'(\d)(st|nd|rd|th)\b', r'\1', value.strip())
+    for release_format in RELEASE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, release_format).date()
+        except ValueError:
+            continue
+    raise ValueError(value)
+
+
+# Reads every non-null value of a column and converts it.
+# Returns: list of {'row_id', 'value'} parameters for an UPDATE.
+def convert(bind, table, column, parser):
+    rows = bind.execute(sa.text(
+        'SELECT id, %s FROM %s WHERE %s IS NOT NULL' % (column, table, column)
+    ))
+
+    converted = []
+    invalid = []
+    for row_id, value in rows:
+        try:
+            converted.append({'row_id': row_id, 'value': parser(value)})
+        except ValueError:
+            invalid.append((row_id, value))
+
+    if invalid:
+        raise RuntimeError(
+            'Cannot convert %s.%s for rows: %s' % (table, column, invalid)
+        )
+
+    return converted
+
+
+# Replaces a column with a new one of another type, copying the values.
+def retype(table, column, new_type, values, indexes):
+    bind = op.get_bind()
+    for name, columns in indexes:
+        op.drop_index(name, table_name=table)
+
+    op.add_column(table, sa.Column(column + '_new', new_type, nullable=True))
+    if values:
+        bind.execute(
+            sa.text(
+                'UPDATE %s SET %s_new = :value WHERE id = :row_id'
+                % (table, column)
+            ),
+            values
+        )
+
+    with op.batch_alter_table(table) as batch:
+        batch.drop_column(column)
+        batch.alter_column(column + '_new', new_column_name=column)
+
+    for name, columns in indexes:
+        op.create_index(name, table, columns)
+
+
+ACTOR_INDEXES = [
+    ('ix_actors_gender_age', ['gender', 'age']),
+    ('ix_actors_age', ['age']),
+]
+MOVIE_INDEXES = [('ix_movies_release', ['release'])]
+
+
+# Checks whether a column already has the given type, as it does when
+# the table was created by db.create_all() from the current models.
+def has_type(bind, table, column, column_type):
+    for info in sa.inspect(bind).get_columns(table):
+        if info['name'] == column:
+            return isinstance(info['type'], column_type)
+    return False
+
+
+def upgrade():
+    bind = op.get_bind()
+    retype_actors = not has_type(bind, 'actors', 'age', sa.Integer)
+    retype_movies = not has_type(bind, 'movies', 'release', sa.Date)
+
+    # Convert both tables before touching either, so a bad row aborts
+    # the whole upgrade.
+    if retype_actors:
+        ages = convert(bind, 'actors', 'age', parse_age)
+    if retype_movies:
+        releases = convert(bind, 'movies', 'release', parse_release)
+
+    if retype_actors:
+        retype('actors', 'age', sa.Integer(), ages, ACTOR_INDEXES)
+    if retype_movies:
+        retype('movies', 'release', sa.Date(), releases, MOVIE_INDEXES)
+
+
+def downgrade():
+    bind = op.get_bind()
+    ages = convert(bind, 'actors', 'age', str)
+    releases = convert(
+        bind, 'movies', 'release',
+        lambda value: value.isoformat() if hasattr(value, 'isoformat')
+        else str(value)
+    )
+
+    retype('actors', 'age', sa.String(), ages, ACTOR_INDEXES)
+    retype('movies', 'release', sa.String(), releases, MOVIE_INDEXES)
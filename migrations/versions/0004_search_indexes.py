@@ -0,0 +1,44 @@
+"""Full-text and trigram search indexes on actor names and movie titles
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 12:00:00
+
+Postgres only: other databases use the in-memory index in search.py.
+Creating the pg_trgm extension needs a role allowed to do so.
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ('ix_actors_name_tsv', 'actors', "to_tsvector('simple', name)"),
+    ('ix_actors_name_trgm', 'actors', 'name gin_trgm_ops'),
+    ('ix_movies_title_tsv', 'movies', "to_tsvector('simple', title)"),
+    ('ix_movies_title_trgm', 'movies', 'title gin_trgm_ops'),
+]
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for name, table, expression in INDEXES:
+        op.execute(
+            'CREATE INDEX IF NOT EXISTS %s ON %s USING gin (%s)'
+            % (name, table, expression)
+        )
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    for name, table, expression in INDEXES:
+        op.execute('DROP INDEX IF EXISTS %s' % name)
@@ -0,0 +1,39 @@
+"""Movie cast association table
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18 13:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if 'movie_cast' in sa.inspect(op.get_bind()).get_table_names():
+        return
+
+    op.create_table(
+        'movie_cast',
+        sa.Column('movie_id', sa.Integer(), nullable=False),
+        sa.Column('actor_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ['movie_id'], ['movies.id'], ondelete='CASCADE'
+        ),
+        sa.ForeignKeyConstraint(
+            ['actor_id'], ['actors.id'], ondelete='CASCADE'
+        ),
+        sa.PrimaryKeyConstraint('movie_id', 'actor_id')
+    )
+    op.create_index('ix_movie_cast_actor_id', 'movie_cast', ['actor_id'])
+
+
+def downgrade():
+    op.drop_index('ix_movie_cast_actor_id', table_name='movie_cast')
+    op.drop_table('movie_cast')
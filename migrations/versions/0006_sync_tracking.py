@@ -0,0 +1,87 @@
+"""Timestamps on actors and movies, and delete tombstones
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18 14:00:00
+
+Existing rows get the time of the upgrade as both created_at and
+updated_at, so the first ?changed_since= sync returns all of them.
+"""
+import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0006'
+down_revision = '0005'
+branch_labels = None
+depends_on = None
+
+TABLES = ('actors', 'movies')
+
+
+def has_column(bind, table, column):
+    return column in {
+        info['name'] for info in sa.inspect(bind).get_columns(table)
+    }
+
+
+# Adds created_at and updated_at, filling them for the existing rows
+# before they are made NOT NULL.
+def add_timestamps(table):
+    op.add_column(table, sa.Column('created_at', sa.DateTime(), nullable=True))
+    op.add_column(table, sa.Column('updated_at', sa.DateTime(), nullable=True))
+    op.get_bind().execute(
+        sa.text(
+            'UPDATE %s SET created_at = :now, updated_at = :now' % table
+        ),
+        now=datetime.datetime.utcnow()
+    )
+
+    with op.batch_alter_table(table) as batch:
+        batch.alter_column(
+            'created_at', existing_type=sa.DateTime(), nullable=False
+        )
+        batch.alter_column(
+            'updated_at', existing_type=sa.DateTime(), nullable=False
+        )
+
+    op.create_index(
+        'ix_%s_updated_at' % table, table, ['updated_at', 'id']
+    )
+
+
+def upgrade():
+    bind = op.get_bind()
+    for table in TABLES:
+        if not has_column(bind, table, 'updated_at'):
+            add_timestamps(table)
+
+    if 'tombstones' in sa.inspect(bind).get_table_names():
+        return
+
+    op.create_table(
+        'tombstones',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('table_name', sa.String(), nullable=False),
+        sa.Column('row_id', sa.Integer(), nullable=False),
+        sa.Column('deleted_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(
+        'ix_tombstones_table_deleted_at', 'tombstones',
+        ['table_name', 'deleted_at', 'id']
+    )
+
+
+def downgrade():
+    op.drop_index('ix_tombstones_table_deleted_at', table_name='tombstones')
+    op.drop_table('tombstones')
+
+    for table in TABLES:
+        op.drop_index('ix_%s_updated_at' % table, table_name=table)
+        with op.batch_alter_table(table) as batch:
+            batch.drop_column('updated_at')
+            batch.drop_column('created_at')
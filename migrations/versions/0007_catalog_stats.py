@@ -0,0 +1,91 @@
+"""Catalog statistics counters
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-18 15:00:00
+
+The counters are filled from the existing rows here, also when the
+table was already created by db.create_all(); afterwards every
+write keeps them up to date. `flask check-stats` compares them with a
+fresh count.
+"""
+from collections import Counter
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0007'
+down_revision = '0006'
+branch_labels = None
+depends_on = None
+
+actors = sa.table(
+    'actors', sa.column('gender', sa.String), sa.column('age', sa.Integer)
+)
+movies = sa.table('movies', sa.column('release', sa.Date))
+
+
+def age_bucket(age):
+    if age is None:
+        return 'unknown'
+    start = age // 10 * 10
+    return '%d-%d' % (start, start + 9)
+
+
+# Counts the existing rows per metric and bucket, like agency.stats.
+def count_rows(bind):
+    counters = Counter()
+    rows = bind.execute(
+        sa.select([actors.c.gender, actors.c.age, sa.func.count()])
+        .group_by(actors.c.gender, actors.c.age)
+    )
+    for gender, age, count in rows:
+        counters[('actors.total', '')] += count
+        counters[('actors.by_gender', gender or 'unknown')] += count
+        counters[('actors.by_age', age_bucket(age))] += count
+
+    rows = bind.execute(
+        sa.select([movies.c.release, sa.func.count()])
+        .group_by(movies.c.release)
+    )
+    for release, count in rows:
+        # SQLite returns dates as strings here.
+        year = 'unknown' if release is None else str(release)[:4]
+        counters[('movies.total', '')] += count
+        counters[('movies.by_release_year', year)] += count
+
+    return counters
+
+
+def upgrade():
+    bind = op.get_bind()
+    # db.create_all() at startup may already have created the table,
+    # empty or counting only the writes since then, so the counters are
+    # always rebuilt from the rows.
+    if 'catalog_stats' in sa.inspect(bind).get_table_names():
+        catalog_stats = sa.table(
+            'catalog_stats', sa.column('metric', sa.String),
+            sa.column('bucket', sa.String), sa.column('count', sa.Integer)
+        )
+        op.execute(catalog_stats.delete())
+    else:
+        catalog_stats = op.create_table(
+            'catalog_stats',
+            sa.Column('metric', sa.String(), nullable=False),
+            sa.Column('bucket', sa.String(), nullable=False),
+            sa.Column('count', sa.Integer(), nullable=False),
+            sa.PrimaryKeyConstraint('metric', 'bucket')
+        )
+
+    counters = count_rows(bind)
+    if counters:
+        op.bulk_insert(catalog_stats, [
+            {'metric': metric, 'bucket': bucket, 'count': count}
+            for (metric, bucket), count in counters.items()
+        ])
+
+
+def downgrade():
+    op.drop_table('catalog_stats')